@@ -331,6 +331,9 @@ def run():
 
             # 更新文档状态
             DocumentService.update_by_id(id, info)
+            # 取消解析时删除增量重解析暂存且尚未重建的旧块
+            if str(req["run"]) == TaskStatus.CANCEL.value:
+                DocumentService.delete_stale_chunks(id, TaskService.query(doc_id=id))
             # 获取租户ID
             tenant_id = DocumentService.get_tenant_id(id)
             if not tenant_id:
@@ -346,6 +349,7 @@ def run():
                 # 如果索引存在，则删除索引中的文档数据
                 if settings.docStoreConn.indexExist(search.index_name(tenant_id), doc.kb_id):
                     settings.docStoreConn.delete({"doc_id": id}, search.index_name(tenant_id), doc.kb_id)
+                DocumentService.clear_reparse_stash(id)
 
             # 如果是运行状态，则创建解析任务
             if str(req["run"]) == TaskStatus.RUNNING.value:
@@ -13,9 +13,10 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
-import json
 import os
 
+import networkx as nx
+import trio
 from flask import request
 from flask_login import login_required, current_user
 
@@ -31,6 +32,7 @@ from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db.db_models import File
 from api.utils.api_utils import get_json_result
 from api import settings
+from graphrag.utils import load_graph, rebuild_graph
 from rag.nlp import search
 from api.constants import DATASET_NAME_LIMIT
 from rag.settings import PAGERANK_FLD
@@ -295,26 +297,18 @@ def knowledge_graph(kb_id):
             code=settings.RetCode.AUTHENTICATION_ERROR
         )
     _, kb = KnowledgebaseService.get_by_id(kb_id)
-    req = {
-        "kb_id": [kb_id],
-        "knowledge_graph_kwd": ["graph"]
-    }
 
     obj = {"graph": {}, "mind_map": {}}
     if not settings.docStoreConn.indexExist(search.index_name(kb.tenant_id), kb_id):
         return get_json_result(data=obj)
-    sres = settings.retrievaler.search(req, search.index_name(kb.tenant_id), [kb_id])
-    if not len(sres.ids):
+    try:
+        res = load_graph(kb.tenant_id, kb_id)
+        graph = res[0] if res is not None else trio.run(rebuild_graph, kb.tenant_id, kb_id)[0]
+    except Exception:
+        graph = None
+    if graph is None:
         return get_json_result(data=obj)
-
-    for id in sres.ids[:1]:
-        ty = sres.field[id]["knowledge_graph_kwd"]
-        try:
-            content_json = json.loads(sres.field[id]["content_with_weight"])
-        except Exception:
-            continue
-
-        obj[ty] = content_json
+    obj["graph"] = nx.node_link_data(graph, edges="edges")
 
     if "nodes" in obj["graph"]:
         obj["graph"]["nodes"] = sorted(obj["graph"]["nodes"], key=lambda x: x.get("pagerank", 0), reverse=True)[:256]
@@ -125,6 +125,7 @@ def set_api_key():
                 api_base=llm_config["api_base"],
                 max_tokens=llm_config["max_tokens"]
             )
+    TenantLLMService.invalidate_models(current_user.id)
 
     return get_json_result(data=True)
 
@@ -275,6 +276,7 @@ def add_llm():
             [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == factory,
              TenantLLM.llm_name == llm["llm_name"]], llm):
         TenantLLMService.save(**llm)
+    TenantLLMService.invalidate_models(current_user.id)
 
     return get_json_result(data=True)
 
@@ -287,6 +289,7 @@ def delete_llm():
     TenantLLMService.filter_delete(
         [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == req["llm_factory"],
          TenantLLM.llm_name == req["llm_name"]])
+    TenantLLMService.invalidate_models(current_user.id)
     return get_json_result(data=True)
 
 
@@ -297,6 +300,7 @@ def delete_factory():
     req = request.json
     TenantLLMService.filter_delete(
         [TenantLLM.tenant_id == current_user.id, TenantLLM.llm_factory == req["llm_factory"]])
+    TenantLLMService.invalidate_models(current_user.id)
     return get_json_result(data=True)
 
 
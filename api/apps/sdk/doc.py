@@ -675,6 +675,7 @@ def parse(tenant_id, dataset_id):
         info["token_num"] = 0
         DocumentService.update_by_id(id, info)
         settings.docStoreConn.delete({"doc_id": id}, search.index_name(tenant_id), dataset_id)
+        DocumentService.clear_reparse_stash(id)
         TaskService.filter_delete([Task.doc_id == id])
         e, doc = DocumentService.get_by_id(id)
         doc = doc.to_dict()
@@ -739,6 +740,7 @@ def stop_parsing(tenant_id, dataset_id):
         info = {"run": "2", "progress": 0, "chunk_num": 0}
         DocumentService.update_by_id(id, info)
         settings.docStoreConn.delete({"doc_id": doc[0].id}, search.index_name(tenant_id), dataset_id)
+        DocumentService.clear_reparse_stash(doc[0].id)
     return get_result()
 
 
@@ -36,6 +36,7 @@ from rag.utils.storage_factory import STORAGE_IMPL, STORAGE_IMPL_TYPE
 from timeit import default_timer as timer
 
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE
 
 
 @manager.route("/version", methods=["GET"])  # noqa: F821
@@ -166,6 +167,7 @@ def status():
     except Exception:
         logging.exception("get task executor heartbeats failed!")
     res["task_executor_heartbeats"] = task_executor_heartbeats
+    res["retrieval_cache"] = RETRIEVAL_CACHE.stats()
 
     return get_json_result(data=res)
 
@@ -699,6 +699,7 @@ def set_tenant_info():
     try:
         tid = req.pop("tenant_id")
         TenantService.update_by_id(tid, req)
+        TenantLLMService.invalidate_models(tid)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -29,9 +29,11 @@ from peewee import fn
 from api.db.db_utils import bulk_insert_into_db
 from api import settings
 from api.utils import current_timestamp, get_format_time, get_uuid
-from rag.settings import SVR_QUEUE_NAME
+from rag.settings import REPARSE_CHUNKS
+from rag.utils.redis_conn import REDIS_CONN
 from rag.utils.storage_factory import STORAGE_IMPL
 from rag.nlp import search, rag_tokenizer
+from graphrag.utils import invalidate_graph
 
 from api.db import FileType, TaskStatus, ParserType, LLMType
 from api.db.db_models import DB, Knowledgebase, Tenant, Task, UserTenant
@@ -39,7 +41,7 @@ from api.db.db_models import Document
 from api.db.services.common_service import CommonService
 from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db import StatusEnum
-from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.task_queue import LANE_BACKGROUND, queue_task
 
 
 class DocumentService(CommonService):
@@ -98,17 +100,19 @@ class DocumentService(CommonService):
         try:
             settings.docStoreConn.delete({"doc_id": doc.id}, search.index_name(tenant_id), doc.kb_id)
             settings.docStoreConn.update(
-                {"kb_id": doc.kb_id, "knowledge_graph_kwd": ["entity", "relation", "graph", "community_report"], "source_id": doc.id},
+                {"kb_id": doc.kb_id, "knowledge_graph_kwd": ["entity", "relation", "graph", "subgraph", "community_report"], "source_id": doc.id},
                 {"remove": {"source_id": doc.id}},
                 search.index_name(tenant_id),
                 doc.kb_id,
             )
             settings.docStoreConn.update({"kb_id": doc.kb_id, "knowledge_graph_kwd": ["graph"]}, {"removed_kwd": "Y"}, search.index_name(tenant_id), doc.kb_id)
             settings.docStoreConn.delete(
-                {"kb_id": doc.kb_id, "knowledge_graph_kwd": ["entity", "relation", "graph", "community_report"], "must_not": {"exists": "source_id"}}, search.index_name(tenant_id), doc.kb_id
+                {"kb_id": doc.kb_id, "knowledge_graph_kwd": ["entity", "relation", "graph", "subgraph", "community_report"], "must_not": {"exists": "source_id"}}, search.index_name(tenant_id), doc.kb_id
             )
+            invalidate_graph(doc.kb_id, [doc.id])
         except Exception:
             pass
+        cls.clear_reparse_stash(doc.id)
         return cls.delete_by_id(doc.id)
 
     @classmethod
@@ -146,9 +150,11 @@ class DocumentService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def get_unfinished_docs(cls):
+    def get_unfinished_docs(cls, doc_ids=None):
         fields = [cls.model.id, cls.model.process_begin_at, cls.model.parser_config, cls.model.progress_msg, cls.model.run, cls.model.parser_id]
         docs = cls.model.select(*fields).where(cls.model.status == StatusEnum.VALID.value, ~(cls.model.type == FileType.VIRTUAL.value), cls.model.progress < 1, cls.model.progress > 0)
+        if doc_ids is not None:
+            docs = docs.where(cls.model.id.in_(doc_ids))
         return list(docs.dicts())
 
     @classmethod
@@ -332,11 +338,21 @@ class DocumentService(CommonService):
 
     @classmethod
     @DB.connection_context()
-    def update_progress(cls):
-        docs = cls.get_unfinished_docs()
+    def update_progress(cls, doc_ids=None):
+        """
+        Fold task progress into the unfinished documents, all of them or only `doc_ids`.
+        Tasks are fetched in one query and the documents are updated in one transaction.
+        """
+        docs = cls.get_unfinished_docs(doc_ids)
+        if not docs:
+            return
+        tasks = {}
+        for t in Task.select().where(Task.doc_id.in_([d["id"] for d in docs])).order_by(Task.create_time):
+            tasks.setdefault(t.doc_id, []).append(t)
+        updates = {}
         for d in docs:
             try:
-                tsks = Task.query(doc_id=d["id"], order_by=Task.create_time)
+                tsks = tasks.get(d["id"])
                 if not tsks:
                     continue
                 msg = []
@@ -345,8 +361,7 @@ class DocumentService(CommonService):
                 bad = 0
                 has_raptor = False
                 has_graphrag = False
-                e, doc = DocumentService.get_by_id(d["id"])
-                status = doc.run  # TaskStatus.RUNNING.value
+                status = d["run"]  # TaskStatus.RUNNING.value
                 for t in tsks:
                     if 0 <= t.progress < 1:
                         finished = False
@@ -359,6 +374,8 @@ class DocumentService(CommonService):
                     elif t.task_type == "graphrag":
                         has_graphrag = True
                 prg /= len(tsks)
+                if finished:
+                    cls.delete_stale_chunks(d["id"], tsks)
                 if finished and bad:
                     prg = -1
                     status = TaskStatus.FAIL.value
@@ -378,10 +395,45 @@ class DocumentService(CommonService):
                     info["progress"] = prg
                 if msg:
                     info["progress_msg"] = msg
-                cls.update_by_id(d["id"], info)
+                updates[d["id"]] = info
             except Exception as e:
                 if str(e).find("'0'") < 0:
                     logging.exception("fetch task exception")
+        with DB.atomic():
+            for doc_id, info in updates.items():
+                cls.update_by_id(doc_id, info)
+
+    @classmethod
+    def delete_stale_chunks(cls, doc_id, tasks):
+        """
+        Finish an incremental re-parse of `doc_id`: delete the chunks stored before it that none of `tasks` rebuilt.
+        """
+        key = f"{REPARSE_CHUNKS}:{doc_id}"
+        pending = REDIS_CONN.get(key)
+        if not pending:
+            return
+        pending = json.loads(pending)
+        rebuilt = set()
+        for t in tasks:
+            rebuilt.update((t.chunk_ids or "").split())
+        stale = [i for i in pending["chunk_ids"] if i not in rebuilt]
+        if stale:
+            settings.docStoreConn.delete({"id": stale}, search.index_name(pending["tenant_id"]), pending["kb_id"])
+        cls.clear_reparse_stash(doc_id)
+        logging.info(f"Incremental re-parse of {doc_id} kept {len(pending['chunk_ids']) - len(stale)} chunks, deleted {len(stale)}")
+
+    @classmethod
+    def clear_reparse_stash(cls, doc_id):
+        """Forget the chunks stashed for an incremental re-parse of `doc_id`, once they are deleted along with the document's."""
+        REDIS_CONN.delete(f"{REPARSE_CHUNKS}:{doc_id}")
+
+    @classmethod
+    @DB.connection_context()
+    def update_progress_of_tasks(cls, task_ids):
+        """Re-aggregate only the documents owning `task_ids`, the tasks whose progress changed."""
+        doc_ids = [t.doc_id for t in Task.select(Task.doc_id).where(Task.id.in_(task_ids)).distinct()]
+        if doc_ids:
+            cls.update_progress(doc_ids)
 
     @classmethod
     @DB.connection_context()
@@ -415,7 +467,7 @@ def queue_raptor_o_graphrag_tasks(doc, ty):
     hasher.update(ty.encode("utf-8"))
     task["digest"] = hasher.hexdigest()
     bulk_insert_into_db(Task, [task], True)
-    assert REDIS_CONN.queue_product(SVR_QUEUE_NAME, message=task), "Can't access Redis. Please check the Redis' status."
+    assert queue_task(task, chunking_config["tenant_id"], LANE_BACKGROUND), "Can't access Redis. Please check the Redis' status."
 
 
 def doc_upload_and_parse(conversation_id, file_objs, user_id):
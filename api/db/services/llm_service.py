@@ -13,9 +13,16 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import atexit
 import json
 import logging
 import os
+import threading
+import time
+from collections import Counter
+
+import xxhash
+from cachetools import TTLCache
 
 from api.db.services.user_service import TenantService
 from api.utils.file_utils import get_project_base_directory
@@ -24,6 +31,16 @@ from api.db import LLMType
 from api.db.db_models import DB
 from api.db.db_models import LLMFactories, LLM, TenantLLM
 from api.db.services.common_service import CommonService
+from rag.utils.embedding_cache import EMBEDDING_CACHE
+from rag.utils.redis_conn import REDIS_CONN
+
+# Seconds between writes of accumulated token usage, 0 to write on every model call.
+TOKEN_USAGE_FLUSH_INTERVAL = float(os.environ.get("TOKEN_USAGE_FLUSH_INTERVAL", "5"))
+# Seconds a constructed model client and its settings are reused, 0 to build them for every bundle.
+MODEL_CACHE_TTL = int(os.environ.get("MODEL_CACHE_TTL", "300"))
+MODEL_CACHE_SIZE = int(os.environ.get("MODEL_CACHE_SIZE", "512"))
+MODEL_VERSION_CHECK_INTERVAL = float(os.environ.get("MODEL_VERSION_CHECK_INTERVAL", "2"))
+TENANT_LLM_VERSION = "rag_flow_tenant_llm_version"
 
 
 class LLMFactoriesService(CommonService):
@@ -77,8 +94,18 @@ class TenantLLMService(CommonService):
         return model_name, None
 
     @classmethod
-    @DB.connection_context()
     def get_model_config(cls, tenant_id, llm_type, llm_name=None):
+        key = (tenant_id, llm_type, llm_name)
+        version = MODEL_CACHE.version(tenant_id)
+        model_config = MODEL_CACHE.get(MODEL_CACHE.configs, key, version)
+        if model_config is None:
+            model_config = cls.load_model_config(tenant_id, llm_type, llm_name)
+            MODEL_CACHE.put(MODEL_CACHE.configs, key, version, model_config)
+        return dict(model_config)
+
+    @classmethod
+    @DB.connection_context()
+    def load_model_config(cls, tenant_id, llm_type, llm_name=None):
         e, tenant = TenantService.get_by_id(tenant_id)
         if not e:
             raise LookupError("Tenant not found")
@@ -117,9 +144,30 @@ class TenantLLMService(CommonService):
         return model_config
 
     @classmethod
-    @DB.connection_context()
     def model_instance(cls, tenant_id, llm_type, llm_name=None, lang="Chinese"):
+        """
+        Return the model client for the tenant, shared by every caller asking for the same model with the
+        same credentials until the tenant's model settings change. Clients keeping per-call state on the
+        instance (a `system` prompt) are built anew for every caller.
+        """
         model_config = TenantLLMService.get_model_config(tenant_id, llm_type, llm_name)
+        key = (tenant_id, llm_type, llm_name, lang, model_config["llm_factory"], model_config["llm_name"], model_config.get("api_base"),
+               xxhash.xxh64(str(model_config.get("api_key"))).hexdigest())
+        version = MODEL_CACHE.version(tenant_id)
+        mdl = MODEL_CACHE.get(MODEL_CACHE.instances, key, version)
+        if mdl is None:
+            mdl = cls.build_model(model_config, llm_type, lang)
+            if mdl is not None and not hasattr(mdl, "system"):
+                MODEL_CACHE.put(MODEL_CACHE.instances, key, version, mdl)
+        return mdl
+
+    @classmethod
+    def invalidate_models(cls, tenant_id):
+        """Drop the cached model settings and clients of the tenant, in every process. Call after changing them."""
+        MODEL_CACHE.invalidate(tenant_id)
+
+    @staticmethod
+    def build_model(model_config, llm_type, lang="Chinese"):
         if llm_type == LLMType.EMBEDDING.value:
             if model_config["llm_factory"] not in EmbeddingModel:
                 return
@@ -161,6 +209,48 @@ class TenantLLMService(CommonService):
             logging.error(f"Tenant not found: {tenant_id}")
             return 0
 
+        mdlnm = cls.usage_model_name(tenant, llm_type, llm_name)
+        if mdlnm is None:
+            logging.error(f"LLM type error: {llm_type}")
+            return 0
+
+        try:
+            return cls.add_used_tokens(tenant_id, mdlnm, used_tokens)
+        except Exception:
+            logging.exception("TenantLLMService.increase_usage got exception,Failed to update used_tokens for tenant_id=%s, llm_name=%s", tenant_id, mdlnm)
+            return 0
+
+    @classmethod
+    @DB.connection_context()
+    def increase_usage_batch(cls, usage: dict) -> dict:
+        """
+        Add token usage given as {(tenant_id, llm_type, llm_name): used_tokens}, looking every tenant up once
+        and writing each model with a single UPDATE. Returns the part of `usage` that failed to be written.
+        """
+        tenants = {t.id: t for t in TenantService.get_by_ids(list(set([k[0] for k in usage])))}
+        by_model = {}
+        for key, used_tokens in usage.items():
+            tenant_id, llm_type, llm_name = key
+            if tenant_id not in tenants:
+                logging.error(f"Tenant not found: {tenant_id}")
+                continue
+            mdlnm = cls.usage_model_name(tenants[tenant_id], llm_type, llm_name)
+            if mdlnm is None:
+                logging.error(f"LLM type error: {llm_type}")
+                continue
+            by_model.setdefault((tenant_id, mdlnm), []).append((key, used_tokens))
+
+        failed = {}
+        for (tenant_id, mdlnm), items in by_model.items():
+            try:
+                cls.add_used_tokens(tenant_id, mdlnm, sum([n for _, n in items]))
+            except Exception:
+                logging.exception("TenantLLMService.increase_usage_batch failed to update used_tokens for tenant_id=%s, llm_name=%s", tenant_id, mdlnm)
+                failed.update(dict(items))
+        return failed
+
+    @staticmethod
+    def usage_model_name(tenant, llm_type, llm_name=None):
         llm_map = {
             LLMType.EMBEDDING.value: tenant.embd_id,
             LLMType.SPEECH2TEXT.value: tenant.asr_id,
@@ -169,25 +259,16 @@ class TenantLLMService(CommonService):
             LLMType.RERANK.value: tenant.rerank_id if not llm_name else llm_name,
             LLMType.TTS.value: tenant.tts_id if not llm_name else llm_name,
         }
+        return llm_map.get(llm_type)
 
-        mdlnm = llm_map.get(llm_type)
-        if mdlnm is None:
-            logging.error(f"LLM type error: {llm_type}")
-            return 0
-
+    @classmethod
+    def add_used_tokens(cls, tenant_id, mdlnm, used_tokens):
         llm_name, llm_factory = TenantLLMService.split_model_name_and_factory(mdlnm)
-
-        try:
-            num = (
-                cls.model.update(used_tokens=cls.model.used_tokens + used_tokens)
-                .where(cls.model.tenant_id == tenant_id, cls.model.llm_name == llm_name, cls.model.llm_factory == llm_factory if llm_factory else True)
-                .execute()
-            )
-        except Exception:
-            logging.exception("TenantLLMService.increase_usage got exception,Failed to update used_tokens for tenant_id=%s, llm_name=%s", tenant_id, llm_name)
-            return 0
-
-        return num
+        return (
+            cls.model.update(used_tokens=cls.model.used_tokens + used_tokens)
+            .where(cls.model.tenant_id == tenant_id, cls.model.llm_name == llm_name, cls.model.llm_factory == llm_factory if llm_factory else True)
+            .execute()
+        )
 
     @classmethod
     @DB.connection_context()
@@ -196,6 +277,111 @@ class TenantLLMService(CommonService):
         return list(objs)
 
 
+class TokenUsageAccumulator:
+    """
+    Collects the token usage of model calls in memory and writes it to tenant_llm from a background
+    thread every TOKEN_USAGE_FLUSH_INTERVAL seconds, one UPDATE per model, so model calls never wait
+    for the database. Usage still pending at exit is flushed by an atexit hook, and usage whose flush
+    failed is kept for the next one.
+    """
+
+    def __init__(self):
+        self.pending = Counter()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.thread = None
+        atexit.register(self.flush)
+
+    def add(self, tenant_id, llm_type, used_tokens, llm_name=None):
+        if not used_tokens:
+            return True
+        if TOKEN_USAGE_FLUSH_INTERVAL <= 0:
+            return TenantLLMService.increase_usage(tenant_id, llm_type, used_tokens, llm_name)
+        with self.lock:
+            self.pending[(tenant_id, llm_type, llm_name)] += used_tokens
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.flush_loop_, daemon=True)
+                self.thread.start()
+        return True
+
+    def flush_loop_(self):
+        while True:
+            time.sleep(TOKEN_USAGE_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("TokenUsageAccumulator.flush got exception")
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, Counter()
+            if not pending:
+                return
+            failed = pending
+            try:
+                failed = TenantLLMService.increase_usage_batch(pending)
+            finally:
+                if failed:
+                    with self.lock:
+                        self.pending.update(failed)
+
+
+TOKEN_USAGE = TokenUsageAccumulator()
+
+
+class ModelCache:
+    """
+    Process-wide cache of tenant model settings and constructed model clients, so bundles reuse the
+    clients' HTTP connection pools instead of opening new ones.
+
+    Entries expire after MODEL_CACHE_TTL seconds and carry the version of the tenant's model settings
+    they were built from. Versions live in Redis, are bumped by `invalidate`, and are re-read at most
+    every MODEL_VERSION_CHECK_INTERVAL seconds, so other processes pick up changes within that interval.
+    """
+
+    def __init__(self):
+        self.configs = TTLCache(maxsize=max(MODEL_CACHE_SIZE, 1), ttl=MODEL_CACHE_TTL)
+        self.instances = TTLCache(maxsize=max(MODEL_CACHE_SIZE, 1), ttl=MODEL_CACHE_TTL)
+        self.versions = TTLCache(maxsize=max(MODEL_CACHE_SIZE, 1), ttl=MODEL_VERSION_CHECK_INTERVAL)
+        self.lock = threading.Lock()
+
+    def version(self, tenant_id):
+        with self.lock:
+            if tenant_id in self.versions:
+                return self.versions[tenant_id]
+        version = REDIS_CONN.get(f"{TENANT_LLM_VERSION}:{tenant_id}")
+        with self.lock:
+            self.versions[tenant_id] = version
+        return version
+
+    def get(self, cache, key, version):
+        if MODEL_CACHE_TTL <= 0:
+            return None
+        with self.lock:
+            entry = cache.get(key)
+        if entry is None or entry[0] != version:
+            return None
+        return entry[1]
+
+    def put(self, cache, key, version, value):
+        if MODEL_CACHE_TTL <= 0:
+            return
+        with self.lock:
+            cache[key] = (version, value)
+
+    def invalidate(self, tenant_id):
+        REDIS_CONN.set(f"{TENANT_LLM_VERSION}:{tenant_id}", str(time.time_ns()), MODEL_CACHE_TTL * 2)
+        with self.lock:
+            self.versions.pop(tenant_id, None)
+            for cache in [self.configs, self.instances]:
+                for key in [k for k in cache.keys() if k[0] == tenant_id]:
+                    cache.pop(key, None)
+
+
+MODEL_CACHE = ModelCache()
+
+
 class LLMBundle:
     def __init__(self, tenant_id, llm_type, llm_name=None, lang="Chinese"):
         self.tenant_id = tenant_id
@@ -205,55 +391,59 @@ class LLMBundle:
         assert self.mdl, "Can't find model for {}/{}/{}".format(tenant_id, llm_type, llm_name)
         model_config = TenantLLMService.get_model_config(tenant_id, llm_type, llm_name)
         self.max_length = model_config.get("max_tokens", 8192)
+        # identifies the model itself for caches shared across tenants, a model served from another endpoint may differ
+        self.model_key = "{}/{}".format(model_config.get("llm_factory", ""), model_config.get("llm_name") or llm_name)
+        if model_config.get("api_base"):
+            self.model_key += "@" + xxhash.xxh64(model_config["api_base"].rstrip("/").encode("utf-8")).hexdigest()
 
     def encode(self, texts: list):
-        embeddings, used_tokens = self.mdl.encode(texts)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
+        embeddings, used_tokens = EMBEDDING_CACHE.encode(self.model_key, texts, self.mdl.encode)
+        if used_tokens and not TOKEN_USAGE.add(self.tenant_id, self.llm_type, used_tokens):
             logging.error("LLMBundle.encode can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, used_tokens))
         return embeddings, used_tokens
 
     def encode_queries(self, query: str):
-        emd, used_tokens = self.mdl.encode_queries(query)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
+        emd, used_tokens = EMBEDDING_CACHE.encode_query(self.model_key, query, self.mdl.encode_queries)
+        if used_tokens and not TOKEN_USAGE.add(self.tenant_id, self.llm_type, used_tokens):
             logging.error("LLMBundle.encode_queries can't update token usage for {}/EMBEDDING used_tokens: {}".format(self.tenant_id, used_tokens))
         return emd, used_tokens
 
     def similarity(self, query: str, texts: list):
         sim, used_tokens = self.mdl.similarity(query, texts)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
+        if not TOKEN_USAGE.add(self.tenant_id, self.llm_type, used_tokens):
             logging.error("LLMBundle.similarity can't update token usage for {}/RERANK used_tokens: {}".format(self.tenant_id, used_tokens))
         return sim, used_tokens
 
     def describe(self, image, max_tokens=300):
         txt, used_tokens = self.mdl.describe(image, max_tokens)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
+        if not TOKEN_USAGE.add(self.tenant_id, self.llm_type, used_tokens):
             logging.error("LLMBundle.describe can't update token usage for {}/IMAGE2TEXT used_tokens: {}".format(self.tenant_id, used_tokens))
         return txt
 
     def transcription(self, audio):
         txt, used_tokens = self.mdl.transcription(audio)
-        if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens):
+        if not TOKEN_USAGE.add(self.tenant_id, self.llm_type, used_tokens):
             logging.error("LLMBundle.transcription can't update token usage for {}/SEQUENCE2TXT used_tokens: {}".format(self.tenant_id, used_tokens))
         return txt
 
     def tts(self, text):
         for chunk in self.mdl.tts(text):
             if isinstance(chunk, int):
-                if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, chunk, self.llm_name):
+                if not TOKEN_USAGE.add(self.tenant_id, self.llm_type, chunk, self.llm_name):
                     logging.error("LLMBundle.tts can't update token usage for {}/TTS".format(self.tenant_id))
                 return
             yield chunk
 
     def chat(self, system, history, gen_conf):
         txt, used_tokens = self.mdl.chat(system, history, gen_conf)
-        if isinstance(txt, int) and not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, used_tokens, self.llm_name):
+        if isinstance(txt, int) and not TOKEN_USAGE.add(self.tenant_id, self.llm_type, used_tokens, self.llm_name):
             logging.error("LLMBundle.chat can't update token usage for {}/CHAT llm_name: {}, used_tokens: {}".format(self.tenant_id, self.llm_name, used_tokens))
         return txt
 
     def chat_streamly(self, system, history, gen_conf):
         for txt in self.mdl.chat_streamly(system, history, gen_conf):
             if isinstance(txt, int):
-                if not TenantLLMService.increase_usage(self.tenant_id, self.llm_type, txt, self.llm_name):
+                if not TOKEN_USAGE.add(self.tenant_id, self.llm_type, txt, self.llm_name):
                     logging.error("LLMBundle.chat_streamly can't update token usage for {}/CHAT llm_name: {}, content: {}".format(self.tenant_id, self.llm_name, txt))
                 return
             yield txt
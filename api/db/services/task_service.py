@@ -13,6 +13,8 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import json
+import logging
 import os
 import random
 import xxhash
@@ -26,13 +28,19 @@ from api.db.db_models import Task, Document, Knowledgebase, Tenant
 from api.db.services.common_service import CommonService
 from api.db.services.document_service import DocumentService
 from api.utils import current_timestamp, get_uuid
-from rag.settings import SVR_QUEUE_NAME
+from api.utils.file_utils import RangedReader, pdf_page_profile
+from rag.settings import CHUNK_ENRICH_DIGEST, DOC_PROGRESS_EVENTS, INCREMENTAL_REPARSE, REPARSE_CHUNKS, REPARSE_CHUNKS_TTL
 from rag.utils.storage_factory import STORAGE_IMPL
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.task_queue import LANE_BULK, LANE_INTERACTIVE, TASK_BULK_THRESHOLD, queue_task
 from api import settings
 from rag.nlp import search
 
 
+# 扫描页（无文本层，需要OCR）相对于文本页的解析代价
+PDF_SCANNED_PAGE_COST = float(os.environ.get("PDF_SCANNED_PAGE_COST", "3"))
+
+
 def trim_header_by_lines(text: str, max_length) -> str:
     len_text = len(text)
     if len_text <= max_length:
@@ -49,6 +57,21 @@ class TaskService(CommonService):
     @classmethod
     @DB.connection_context()
     def get_task(cls, task_id):
+        task = cls.get_task_batch([task_id]).get(task_id)
+        if task:
+            task.pop("doc_run")
+            task.pop("doc_progress")
+        return task
+
+    @classmethod
+    @DB.connection_context()
+    def get_task_batch(cls, task_ids):
+        """
+        Fetch the tasks to run for a batch of queued task ids with one joined query and mark them
+        received, as get_task does for one. Returns {task_id: task}; each task also carries its
+        document's "doc_run" and "doc_progress" for the cancel check. Tasks tried 3 times are abandoned
+        and left out.
+        """
         fields = [
             cls.model.id,
             cls.model.doc_id,
@@ -71,34 +94,36 @@ class TaskService(CommonService):
             Tenant.asr_id,
             Tenant.llm_id,
             cls.model.update_time,
+            Document.run.alias("doc_run"),
+            Document.progress.alias("doc_progress"),
         ]
         docs = (
             cls.model.select(*fields)
             .join(Document, on=(cls.model.doc_id == Document.id))
             .join(Knowledgebase, on=(Document.kb_id == Knowledgebase.id))
             .join(Tenant, on=(Knowledgebase.tenant_id == Tenant.id))
-            .where(cls.model.id == task_id)
+            .where(cls.model.id.in_(list(set(task_ids))))
         )
         docs = list(docs.dicts())
         if not docs:
-            return None
-
-        msg = f"\n{datetime.now().strftime('%H:%M:%S')} Task has been received."
-        prog = random.random() / 10.0
-        if docs[0]["retry_count"] >= 3:
-            msg = "\nERROR: Task is abandoned after 3 times attempts."
-            prog = -1
-
-        cls.model.update(
-            progress_msg=cls.model.progress_msg + msg,
-            progress=prog,
-            retry_count=docs[0]["retry_count"] + 1,
-        ).where(cls.model.id == docs[0]["id"]).execute()
-
-        if docs[0]["retry_count"] >= 3:
-            return None
-
-        return docs[0]
+            return {}
+
+        received = [d["id"] for d in docs if d["retry_count"] < 3]
+        abandoned = [d["id"] for d in docs if d["retry_count"] >= 3]
+        if received:
+            cls.model.update(
+                progress_msg=cls.model.progress_msg + f"\n{datetime.now().strftime('%H:%M:%S')} Task has been received.",
+                progress=random.random() / 10.0,
+                retry_count=cls.model.retry_count + 1,
+            ).where(cls.model.id.in_(received)).execute()
+        if abandoned:
+            cls.model.update(
+                progress_msg=cls.model.progress_msg + "\nERROR: Task is abandoned after 3 times attempts.",
+                progress=-1,
+                retry_count=cls.model.retry_count + 1,
+            ).where(cls.model.id.in_(abandoned)).execute()
+
+        return {d["id"]: d for d in docs if d["retry_count"] < 3}
 
     @classmethod
     @DB.connection_context()
@@ -119,7 +144,11 @@ class TaskService(CommonService):
     @classmethod
     @DB.connection_context()
     def update_chunk_ids(cls, id: str, chunk_ids: str):
-        cls.model.update(chunk_ids=chunk_ids).where(cls.model.id == id).execute()
+        num = cls.model.update(chunk_ids=chunk_ids).where(cls.model.id == id).execute()
+        # MySQL reports 0 affected rows when the value is unchanged, so only a missing row is an error.
+        if not num and not cls.model.select(cls.model.id).where(cls.model.id == id).exists():
+            raise cls.model.DoesNotExist(f"Task {id} does not exist")
+        return num
 
     @classmethod
     @DB.connection_context()
@@ -165,8 +194,7 @@ class TaskService(CommonService):
     @classmethod
     @DB.connection_context()
     def do_cancel(cls, id):
-        task = cls.model.get_by_id(id)
-        _, doc = DocumentService.get_by_id(task.doc_id)
+        doc = Document.select(Document.run, Document.progress).join(cls.model, on=(cls.model.doc_id == Document.id)).where(cls.model.id == id).get()
         return doc.run == TaskStatus.CANCEL.value or doc.progress < 0
 
     @classmethod
@@ -189,6 +217,47 @@ class TaskService(CommonService):
             if "progress" in info:
                 cls.model.update(progress=info["progress"]).where(cls.model.id == id).execute()
 
+    @classmethod
+    @DB.connection_context()
+    def get_progress_msgs(cls, ids):
+        return {t.id: t.progress_msg or "" for t in cls.model.select(cls.model.id, cls.model.progress_msg).where(cls.model.id.in_(ids))}
+
+    @classmethod
+    @DB.connection_context()
+    def update_progress_batch(cls, progress: dict):
+        """
+        Write the progress of several tasks, {task_id: {"progress_msg": ..., "progress": ...}}, in one
+        transaction. progress_msg is the full, already trimmed text: unlike update_progress there is no
+        read-modify-write, so no global lock is taken and only the executor running a task may call this.
+        """
+        with DB.atomic():
+            for id, info in progress.items():
+                cls.model.update(**info).where(cls.model.id == id).execute()
+
+
+def plan_pdf_pages(bucket: str, name: str, page_size: int):
+    """
+    估算PDF的拆分方式，返回(总页数, 每个任务的页数)。
+
+    只解析PDF的页树和资源字典来获取真实页数及文本层比例。存储支持按范围读取时只下载
+    文件尾部的交叉引用表和抽样页所在的数据块，不下载整个文件。扫描页需要OCR，
+    按PDF_SCANNED_PAGE_COST折算成文本页，使每个任务的代价约等于page_size个文本页。
+    读取失败时退化为整个文档一个任务。
+    """
+    try:
+        if hasattr(STORAGE_IMPL, "get_range"):
+            blob = RangedReader(STORAGE_IMPL.get_size(bucket, name), lambda offset, length: STORAGE_IMPL.get_range(bucket, name, offset, length))
+        else:
+            blob = STORAGE_IMPL.get(bucket, name)
+        pages, text_ratio = pdf_page_profile(blob)
+    except Exception:
+        logging.exception(f"Can't read the page count of {bucket}/{name}, parse it as one task")
+        return 10**5, 10**9
+    if not pages:
+        return 10**5, 10**9
+    page_cost = text_ratio + (1 - text_ratio) * PDF_SCANNED_PAGE_COST
+    return pages, max(1, min(page_size, int(page_size / page_cost)))
+
 
 def queue_tasks(doc: dict, bucket: str, name: str):
     """
@@ -227,16 +296,14 @@ def queue_tasks(doc: dict, bucket: str, name: str):
     if doc["type"] == FileType.PDF.value:
         # 获取布局识别方式，默认为"DeepDOC"
         do_layout = doc["parser_config"].get("layout_recognize", "DeepDOC")
-        # 获取PDF总页数
-        pages = 1
-        # 获取每个任务处理的页数，默认为12页
-        page_size = doc["parser_config"].get("task_page_size", 12)
-        # 对于学术论文类型，默认任务页数为22
-        if doc["parser_id"] == "paper":
-            page_size = doc["parser_config"].get("task_page_size", 22)
-        # 对于特定解析器或非DeepDOC布局识别，将整个文档作为一个任务处理
+        # 获取每个任务处理的页数，默认为12页；对于学术论文类型，默认任务页数为22
+        page_size = doc["parser_config"].get("task_page_size", 22 if doc["parser_id"] == "paper" else 12)
+        # 对于特定解析器或非DeepDOC布局识别，将整个文档作为一个任务处理，无需读取文件
         if doc["parser_id"] in ["one", "knowledge_graph"] or do_layout != "DeepDOC":
-            page_size = 10**9
+            pages, page_size = 10**5, 10**9
+        else:
+            # 读取真实页数和文本层比例，按代价估算每个任务的页数
+            pages, page_size = plan_pdf_pages(bucket, name, page_size)
         # 获取需要处理的页面范围，默认为全部页面
         page_ranges = doc["parser_config"].get("pages") or [(1, 10**5)]
         # 根据页面范围和任务页数分割任务
@@ -290,14 +357,17 @@ def queue_tasks(doc: dict, bucket: str, name: str):
             ck_num += reuse_prev_task_chunks(task, prev_tasks, chunking_config)
         # 删除文档之前的任务记录
         TaskService.filter_delete([Task.doc_id == doc["id"]])
-        # 收集需要删除的块ID
+        # 收集未被整体重用的旧块ID
         chunk_ids = []
         for task in prev_tasks:
             if task["chunk_ids"]:
                 chunk_ids.extend(task["chunk_ids"].split())
-        # 从文档存储中删除这些块
+        # 增量重解析时旧块暂时保留，由执行器按块ID重用，文档解析完成后再删除未重建的块；否则直接从文档存储中删除
+        chunk_ids = stash_chunks_for_reparse(doc, chunking_config, chunk_ids)
         if chunk_ids:
             settings.docStoreConn.delete({"id": chunk_ids}, search.index_name(chunking_config["tenant_id"]), chunking_config["kb_id"])
+    # 记录本次解析的块生成配置，供下次重解析判断能否重用
+    REDIS_CONN.set(f"{CHUNK_ENRICH_DIGEST}:{doc['id']}", chunk_enrich_digest(doc, chunking_config), REPARSE_CHUNKS_TTL * 8)
     # 更新文档的块数量
     DocumentService.update_by_id(doc["id"], {"chunk_num": ck_num})
 
@@ -306,11 +376,53 @@ def queue_tasks(doc: dict, bucket: str, name: str):
     # 开始解析文档
     DocumentService.begin2parse(doc["id"])
 
+    # 重用结果的任务已完成，通知服务端汇总文档进度
+    REDIS_CONN.sadd_many(DOC_PROGRESS_EVENTS, [task["id"] for task in parse_task_array if task["progress"] >= 1.0])
+
     # 筛选出未完成的任务
     unfinished_task_array = [task for task in parse_task_array if task["progress"] < 1.0]
-    # 将未完成的任务加入Redis队列
+    # 按租户排队；拆分出大量任务的文档走批量通道，避免阻塞其他用户的交互式上传
+    lane = LANE_BULK if len(unfinished_task_array) > TASK_BULK_THRESHOLD else LANE_INTERACTIVE
     for unfinished_task in unfinished_task_array:
-        assert REDIS_CONN.queue_product(SVR_QUEUE_NAME, message=unfinished_task), "Can't access Redis. Please check the Redis' status."
+        assert queue_task(unfinished_task, chunking_config["tenant_id"], lane), "Can't access Redis. Please check the Redis' status."
+
+
+def chunk_enrich_digest(doc: dict, chunking_config: dict) -> str:
+    """
+    计算影响单个块向量和关键词/问题生成的配置摘要。
+
+    块ID只取决于块内容，摘要相同时，内容相同的块可以直接沿用已存储的向量、关键词和问题。
+    """
+    hasher = xxhash.xxh64()
+    parser_config = chunking_config["parser_config"]
+    for v in [doc["name"], chunking_config["embd_id"], chunking_config["llm_id"],
+              parser_config.get("filename_embd_weight", 0.1), parser_config.get("auto_keywords", 0), parser_config.get("auto_questions", 0)]:
+        hasher.update(str(v).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def stash_chunks_for_reparse(doc: dict, chunking_config: dict, chunk_ids: list[str]) -> list[str]:
+    """
+    增量重解析时将旧块ID登记到Redis，旧块留待执行器按块ID重用，返回需要立即删除的块ID。
+
+    上次解析的块生成配置与本次不同（或未知）时不能重用，旧块需全部删除后重新生成。
+    上一次增量重解析尚未结束时，其未处理的旧块一并登记或删除。
+    登记的旧块立即停止参与检索，重建时随新块一起恢复；登记不设过期时间，
+    在文档解析完成、取消解析或删除文档时清理。
+    """
+    key = f"{REPARSE_CHUNKS}:{doc['id']}"
+    pending = REDIS_CONN.get(key)
+    if pending:
+        chunk_ids = list(set(chunk_ids) | set(json.loads(pending)["chunk_ids"]))
+    if INCREMENTAL_REPARSE and chunk_ids and REDIS_CONN.get(f"{CHUNK_ENRICH_DIGEST}:{doc['id']}") == chunk_enrich_digest(doc, chunking_config):
+        record = {"tenant_id": chunking_config["tenant_id"], "kb_id": chunking_config["kb_id"], "chunk_ids": chunk_ids}
+        if REDIS_CONN.set_obj(key, record, None):
+            settings.docStoreConn.bulkUpdate({i: {"available_int": 0} for i in chunk_ids},
+                                             search.index_name(chunking_config["tenant_id"]), chunking_config["kb_id"])
+            return []
+    if pending:
+        REDIS_CONN.delete(key)
+    return chunk_ids
 
 
 def reuse_prev_task_chunks(task: dict, prev_tasks: list[dict], chunking_config: dict):
@@ -18,22 +18,37 @@ from api.db.services.document_service import DocumentService
 from api.utils import show_configs
 from api.utils.log_utils import initRootLogger
 from api.versions import get_ragflow_version
-from rag.settings import print_rag_settings
-from rag.utils.redis_conn import RedisDistributedLock
+from rag.settings import DOC_PROGRESS_EVENTS, print_rag_settings
+from rag.utils.redis_conn import REDIS_CONN, RedisDistributedLock
 
 initRootLogger("ragflow_server")
 
 stop_event = threading.Event()
 
+DOC_PROGRESS_INTERVAL = float(os.environ.get("DOC_PROGRESS_INTERVAL", "2"))
+# Full re-scan of unfinished documents, catching up on any progress event that was lost.
+DOC_PROGRESS_FULL_SCAN_INTERVAL = float(os.environ.get("DOC_PROGRESS_FULL_SCAN_INTERVAL", "300"))
+DOC_PROGRESS_BATCH = int(os.environ.get("DOC_PROGRESS_BATCH", "1000"))
+
 
 def update_progress():
     redis_lock = RedisDistributedLock("update_progress", timeout=60)
+    last_full_scan = 0
     while not stop_event.is_set():
         try:
             if not redis_lock.acquire():
                 continue
-            DocumentService.update_progress()
-            stop_event.wait(6)
+            if time.time() - last_full_scan >= DOC_PROGRESS_FULL_SCAN_INTERVAL:
+                last_full_scan = time.time()
+                DocumentService.update_progress()
+            else:
+                # only the documents whose tasks reported progress since the last round
+                while not stop_event.is_set():
+                    task_ids = REDIS_CONN.spop(DOC_PROGRESS_EVENTS, DOC_PROGRESS_BATCH)
+                    if not task_ids:
+                        break
+                    DocumentService.update_progress_of_tasks(task_ids)
+            stop_event.wait(DOC_PROGRESS_INTERVAL)
         except Exception:
             logging.exception("update_progress exception")
         finally:
@@ -19,7 +19,7 @@ import os
 import re
 import sys
 import threading
-from io import BytesIO
+from io import SEEK_CUR, SEEK_END, SEEK_SET, BytesIO, RawIOBase
 
 import pdfplumber
 from PIL import Image
@@ -238,6 +238,114 @@ def thumbnail(filename, blob):
         return ''
 
 
+class RangedReader(RawIOBase):
+    """
+    Read-only seekable file of `size` bytes, fetched on demand in blocks of `block_size`
+    through `read_range(offset, length)`, so parsing a file reads only the parts it needs.
+    """
+
+    def __init__(self, size, read_range, block_size=256 * 1024):
+        self.size = size
+        self.read_range = read_range
+        self.block_size = block_size
+        self.blocks = {}
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            offset += self.pos
+        elif whence == SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def block(self, i):
+        if i not in self.blocks:
+            offset = i * self.block_size
+            self.blocks[i] = self.read_range(offset, min(self.block_size, self.size - offset))
+        return self.blocks[i]
+
+    def readinto(self, b):
+        end = min(self.pos + len(b), self.size)
+        n = 0
+        while self.pos < end:
+            i, start = divmod(self.pos, self.block_size)
+            data = self.block(i)[start:start + end - self.pos]
+            if not data:
+                break
+            b[n:n + len(data)] = data
+            n += len(data)
+            self.pos += len(data)
+        return n
+
+
+def pdf_page_profile(blob, sample=8):
+    """
+    Return (page count, fraction of sampled pages with a text layer) of a PDF, given as bytes
+    or as a seekable file.
+
+    Only the trailer, the path of the page tree down to up to `sample` evenly spread pages and
+    their resources are parsed; no content stream is decoded. A page without fonts is taken as
+    scanned. The strict reader is tried first since the lenient one checks every object offset.
+    """
+    from pypdf import PdfReader
+
+    stream = blob if hasattr(blob, "read") else BytesIO(blob)
+    try:
+        reader = PdfReader(stream, strict=True)
+        root = reader.trailer["/Root"]["/Pages"]
+    except Exception:
+        reader = PdfReader(stream)
+        root = reader.trailer["/Root"]["/Pages"]
+    pages = int(root.get("/Count", 0)) or len(reader.pages)
+    if not pages:
+        return 0, 1.0
+    step = max(1, pages // max(sample, 1))
+    picked = list(range(0, pages, step))[:sample]
+    text_pages = 0
+    for i in picked:
+        try:
+            resources = pdf_page_resources(root, i)
+        except Exception:
+            resources = reader.pages[i].get("/Resources")
+        if hasattr(resources, "get_object"):
+            resources = resources.get_object()
+        if (resources or {}).get("/Font"):
+            text_pages += 1
+    return pages, text_pages / len(picked)
+
+
+def pdf_page_resources(node, i):
+    """Resources of the `i`th page under the page tree `node`, resolving only the nodes on its path."""
+    resources = node.get("/Resources")
+    while node.get("/Type") != "/Page":
+        kids = node["/Kids"]
+        if int(node.get("/Count", 0)) == len(kids):
+            # every kid is a single page
+            node = kids[i].get_object()
+        else:
+            for kid in kids:
+                kid = kid.get_object()
+                count = int(kid.get("/Count", 1)) if kid.get("/Type") == "/Pages" else 1
+                if i < count:
+                    node = kid
+                    break
+                i -= count
+            else:
+                raise IndexError("page out of range")
+        resources = node.get("/Resources", resources)
+    return resources
+
+
 def traversal_files(base):
     for root, ds, fs in os.walk(base):
         for f in fs:
@@ -15,8 +15,11 @@
 #
 import logging
 import itertools
+import math
+import os
 import re
 import time
+from collections import Counter, defaultdict
 from dataclasses import dataclass
 from typing import Any, Callable
 
@@ -33,6 +36,10 @@ from graphrag.utils import perform_variable_replacements, chat_limiter
 DEFAULT_RECORD_DELIMITER = "##"
 DEFAULT_ENTITY_INDEX_DELIMITER = "<|>"
 DEFAULT_RESOLUTION_RESULT_DELIMITER = "&&"
+# Candidate pairs asked about in one prompt.
+ENTITY_RESOLUTION_BATCH_SIZE = int(os.environ.get("ENTITY_RESOLUTION_BATCH_SIZE", "100"))
+# Blocking keys shared by more entities than this are too common to tell anything.
+ENTITY_RESOLUTION_MAX_BLOCK = int(os.environ.get("ENTITY_RESOLUTION_MAX_BLOCK", "500"))
 
 
 @dataclass
@@ -93,16 +100,15 @@ class EntityResolution(Extractor):
 
         candidate_resolution = {entity_type: [] for entity_type in entity_types}
         for k, v in node_clusters.items():
-            candidate_resolution[k] = [(a, b) for a, b in itertools.combinations(v, 2) if self.is_similarity(a, b)]
+            candidate_resolution[k] = await trio.to_thread.run_sync(lambda: self._candidate_pairs(v))
         num_candidates = sum([len(candidates) for _, candidates in candidate_resolution.items()])
         callback(msg=f"Identified {num_candidates} candidate pairs")
 
         resolution_result = set()
         async with trio.open_nursery() as nursery:
-            for candidate_resolution_i in candidate_resolution.items():
-                if not candidate_resolution_i[1]:
-                    continue
-                nursery.start_soon(lambda: self._resolve_candidate(candidate_resolution_i, resolution_result))
+            for entity_type, candidates in candidate_resolution.items():
+                for i in range(0, len(candidates), ENTITY_RESOLUTION_BATCH_SIZE):
+                    nursery.start_soon(lambda: self._resolve_candidate((entity_type, candidates[i:i + ENTITY_RESOLUTION_BATCH_SIZE]), resolution_result))
         callback(msg=f"Resolved {num_candidates} candidate pairs, {len(resolution_result)} of them are selected to merge.")
 
         connect_graph = nx.Graph()
@@ -212,12 +218,61 @@ class EntityResolution(Extractor):
 
         return ans_list
 
+    def _blocking_keys(self, name) -> set:
+        if is_english(name):
+            name = f" {name.lower()} "
+            return set(name[i:i + 2] for i in range(len(name) - 1))
+        return self._char_pairs(name)
+
+    def _char_pairs(self, name) -> set:
+        return set(itertools.combinations(sorted(set(name)), 2))
+
+    def _candidate_pairs(self, names: list) -> list:
+        """
+        Similar pairs of `names`, found without comparing every pair.
+
+        English names are compared by edit distance and join the blocks of their rarest character
+        bigrams, enough of them that two names sharing half of their bigrams meet in a block. Other
+        names must share two characters or more, so they join a block per pair of their characters;
+        English names join those blocks as well to meet the other names they are compared with.
+        Blocks yielding more pairs than a block of ENTITY_RESOLUTION_MAX_BLOCK names are skipped.
+        """
+        english = [is_english(n) for n in names]
+        keys = [self._blocking_keys(n) for n in names]
+        freq = Counter(k for ks in keys for k in ks)
+        blocks = defaultdict(list)
+        for i, ks in enumerate(keys):
+            if english[i]:
+                ks = sorted(ks, key=lambda k: (freq[k], k))
+                ks = ks[:len(ks) - math.ceil(len(ks) * 0.5) + 1]
+            for k in ks:
+                blocks[k].append(i)
+        english_blocks = defaultdict(list)
+        for i, n in enumerate(names):
+            if english[i]:
+                for k in self._char_pairs(n) & freq.keys():
+                    english_blocks[k].append(i)
+
+        max_pairs = ENTITY_RESOLUTION_MAX_BLOCK * (ENTITY_RESOLUTION_MAX_BLOCK - 1) // 2
+        pairs = set()
+        for k, ids in blocks.items():
+            others = english_blocks.get(k, [])
+            if len(ids) < 2 and not others or len(ids) * (len(ids) - 1) // 2 + len(ids) * len(others) > max_pairs:
+                continue
+            pairs.update(itertools.combinations(ids, 2))
+            pairs.update((min(a, b), max(a, b)) for a in ids for b in others)
+        return [(names[a], names[b]) for a, b in sorted(pairs) if self.is_similarity(names[a], names[b])]
+
     def is_similarity(self, a, b):
         if is_english(a) and is_english(b):
-            if editdistance.eval(a, b) <= min(len(a), len(b)) // 2:
+            k = min(len(a), len(b)) // 2
+            if abs(len(a) - len(b)) <= k and editdistance.eval(a, b) <= k:
                 return True
 
-        if len(set(a) & set(b)) > 0:
-            return True
+            return False
 
-        return False
+        # an abbreviation keeps most characters of the shorter name, as 北大 of 北京大学,
+        # while one shared character alone tells nothing
+        a, b = set(a), set(b)
+        shared = len(a & b)
+        return shared >= 2 and shared >= min(len(a), len(b)) * 0.6
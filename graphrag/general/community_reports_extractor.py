@@ -17,7 +17,7 @@ from graphrag.general.community_report_prompt import COMMUNITY_REPORT_PROMPT
 from graphrag.general.extractor import Extractor
 from graphrag.general.leiden import add_community_info2graph
 from rag.llm.chat_model import Base as CompletionLLM
-from graphrag.utils import perform_variable_replacements, dict_has_keys_with_types, chat_limiter
+from graphrag.utils import perform_variable_replacements, dict_has_keys_with_types, chat_limiter, community_hash
 from rag.utils import num_tokens_from_string
 import trio
 
@@ -28,6 +28,8 @@ class CommunityReportsResult:
 
     output: list[str]
     structured_output: list[dict]
+    # weights of the communities whose stored report was kept, by community_hash
+    reused: dict[str, float]
 
 
 class CommunityReportsExtractor(Extractor):
@@ -52,12 +54,28 @@ class CommunityReportsExtractor(Extractor):
         self._extraction_prompt = COMMUNITY_REPORT_PROMPT
         self._max_report_length = max_report_length or 1500
 
-    async def __call__(self, graph: nx.Graph, callback: Callable | None = None):
+    async def __call__(self, graph: nx.Graph, callback: Callable | None = None, known_reports: dict[str, str] | None = None):
+        """
+        known_reports maps the community_hash of communities with a stored report to its title;
+        those communities keep their report instead of being summarized again.
+        """
         for node_degree in graph.degree:
             graph.nodes[str(node_degree[0])]["rank"] = int(node_degree[1])
 
         communities: dict[str, dict[str, list]] = leiden.run(graph, {})
+        known_reports = known_reports or {}
+        reused = {}
+        for _, comm in communities.items():
+            for cm_id, ents in list(comm.items()):
+                h = community_hash(ents["nodes"])
+                if h not in known_reports:
+                    continue
+                add_community_info2graph(graph, ents["nodes"], known_reports[h])
+                reused[h] = ents["weight"]
+                del comm[cm_id]
         total = sum([len(comm.items()) for _, comm in communities.items()])
+        if callback and reused:
+            callback(msg=f"Communities: {len(reused)} unchanged since the last run, {total} to summarize")
         res_str = []
         res_dict = []
         over, token_count = 0, 0
@@ -128,6 +146,7 @@ class CommunityReportsExtractor(Extractor):
         return CommunityReportsResult(
             structured_output=res_dict,
             output=res_str,
+            reused=reused,
         )
 
     def _get_text_output(self, parsed_output: dict) -> str:
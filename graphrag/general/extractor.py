@@ -44,6 +44,10 @@ class Extractor:
         set_entity: Callable | None = None,
         get_relation: Callable | None = None,
         set_relation: Callable | None = None,
+        get_entities: Callable | None = None,
+        set_entities: Callable | None = None,
+        get_relations: Callable | None = None,
+        set_relations: Callable | None = None,
     ):
         self._llm = llm_invoker
         self._language = language
@@ -52,6 +56,15 @@ class Extractor:
         self._set_entity_ = set_entity
         self._get_relation_ = get_relation
         self._set_relation_ = set_relation
+        self._get_entities_ = get_entities
+        self._set_entities_ = set_entities
+        self._get_relations_ = get_relations
+        self._set_relations_ = set_relations
+        # While merging with the bulk callables, entities and relations are looked up and written here.
+        self._known_entities = None
+        self._known_relations = None
+        self._pending_entities = None
+        self._pending_relations = None
 
     def _chat(self, system, history, gen_conf):
         hist = deepcopy(history)
@@ -118,6 +131,12 @@ class Extractor:
         if callback:
             callback(msg = f"Entities and relationships extraction done, {len(maybe_nodes)} nodes, {len(maybe_edges)} edges, {sum_token_count} tokens, {now-start_ts:.2f}s.")
         start_ts = now
+        batched = all([self._get_entities_, self._set_entities_, self._get_relations_, self._set_relations_])
+        if batched:
+            names = set(maybe_nodes.keys()) | set([n for edge in maybe_edges.keys() for n in edge])
+            self._known_entities = await trio.to_thread.run_sync(lambda: self._get_entities_(list(names)))
+            self._known_relations = await trio.to_thread.run_sync(lambda: self._get_relations_(list(maybe_edges.keys())))
+            self._pending_entities, self._pending_relations = {}, {}
         logging.info("Entities merging...")
         all_entities_data = []
         async with trio.open_nursery() as nursery:
@@ -137,6 +156,16 @@ class Extractor:
         if callback:
             callback(msg = f"Relationships merging done, {now-start_ts:.2f}s.")
 
+        if batched:
+            start_ts = now
+            entities, relations = self._pending_entities, self._pending_relations
+            self._known_entities = self._known_relations = self._pending_entities = self._pending_relations = None
+            await trio.to_thread.run_sync(lambda: self._set_entities_(entities))
+            await trio.to_thread.run_sync(lambda: self._set_relations_(relations))
+            now = trio.current_time()
+            if callback:
+                callback(msg = f"Stored {len(entities)} entities and {len(relations)} relationships, {now-start_ts:.2f}s.")
+
         if not len(all_entities_data) and not len(all_relationships_data):
             logging.warning(
                 "Didn't extract any entities and relationships, maybe your LLM is not working"
@@ -149,6 +178,28 @@ class Extractor:
 
         return all_entities_data, all_relationships_data
 
+    def _lookup_entity(self, entity_name: str):
+        if self._pending_entities is None:
+            return self._get_entity_(entity_name)
+        return self._pending_entities.get(entity_name) or self._known_entities.get(entity_name)
+
+    def _store_entity(self, entity_name: str, meta: dict):
+        if self._pending_entities is None:
+            self._set_entity_(entity_name, meta)
+            return
+        self._pending_entities[entity_name] = meta
+
+    def _lookup_relation(self, src_id: str, tgt_id: str):
+        if self._pending_relations is None:
+            return self._get_relation_(src_id, tgt_id)
+        return self._pending_relations.get((src_id, tgt_id)) or self._known_relations.get((src_id, tgt_id))
+
+    def _store_relation(self, src_id: str, tgt_id: str, meta: dict):
+        if self._pending_relations is None:
+            self._set_relation_(src_id, tgt_id, meta)
+            return
+        self._pending_relations[(src_id, tgt_id)] = meta
+
     async def _merge_nodes(self, entity_name: str, entities: list[dict], all_relationships_data):
         if not entities:
             return
@@ -156,7 +207,7 @@ class Extractor:
         already_source_ids = []
         already_description = []
 
-        already_node = self._get_entity_(entity_name)
+        already_node = self._lookup_entity(entity_name)
         if already_node:
             already_entity_types.append(already_node["entity_type"])
             already_source_ids.extend(already_node["source_id"])
@@ -180,7 +231,7 @@ class Extractor:
             source_id=already_source_ids,
         )
         node_data["entity_name"] = entity_name
-        self._set_entity_(entity_name, node_data)
+        self._store_entity(entity_name, node_data)
         all_relationships_data.append(node_data)
 
     async def _merge_edges(
@@ -197,7 +248,7 @@ class Extractor:
         already_description = []
         already_keywords = []
 
-        relation = self._get_relation_(src_id, tgt_id)
+        relation = self._lookup_relation(src_id, tgt_id)
         if relation:
             already_weights = [relation["weight"]]
             already_source_ids = relation["source_id"]
@@ -212,9 +263,9 @@ class Extractor:
         source_id = flat_uniq_list(edges_data, "source_id") + already_source_ids
 
         for need_insert_id in [src_id, tgt_id]:
-            if self._get_entity_(need_insert_id):
+            if self._lookup_entity(need_insert_id):
                 continue
-            self._set_entity_(need_insert_id, {
+            self._store_entity(need_insert_id, {
                         "source_id": source_id,
                         "description": description,
                         "entity_type": 'UNKNOWN'
@@ -230,7 +281,7 @@ class Extractor:
             weight=weight,
             source_id=source_id
         )
-        self._set_relation_(src_id, tgt_id, edge_data)
+        self._store_relation(src_id, tgt_id, edge_data)
         if all_relationships_data is not None:
             all_relationships_data.append(edge_data)
 
@@ -57,6 +57,10 @@ class GraphExtractor(Extractor):
         set_entity: Callable | None = None,
         get_relation: Callable | None = None,
         set_relation: Callable | None = None,
+        get_entities: Callable | None = None,
+        set_entities: Callable | None = None,
+        get_relations: Callable | None = None,
+        set_relations: Callable | None = None,
         tuple_delimiter_key: str | None = None,
         record_delimiter_key: str | None = None,
         input_text_key: str | None = None,
@@ -66,7 +70,8 @@ class GraphExtractor(Extractor):
         max_gleanings: int | None = None,
         on_error: ErrorHandlerFn | None = None,
     ):
-        super().__init__(llm_invoker, language, entity_types, get_entity, set_entity, get_relation, set_relation)
+        super().__init__(llm_invoker, language, entity_types, get_entity, set_entity, get_relation, set_relation,
+                         get_entities, set_entities, get_relations, set_relations)
         """Init method definition."""
         # TODO: streamline construction
         self._llm = llm_invoker
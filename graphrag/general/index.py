@@ -14,7 +14,6 @@
 #  limitations under the License.
 #
 import json
-import logging
 from functools import partial
 import networkx as nx
 import trio
@@ -26,17 +25,25 @@ from graphrag.general.community_reports_extractor import CommunityReportsExtract
 from graphrag.entity_resolution import EntityResolution
 from graphrag.general.extractor import Extractor
 from graphrag.utils import (
-    graph_merge,
+    GRAPH_CHUNKS_LIMIT,
+    GRAPH_COMPACT_DELTAS,
+    add_graph_delta,
+    merge_graph_delta,
     set_entity,
     get_relation,
     set_relation,
     get_entity,
+    get_entities,
+    set_entities,
+    get_relations,
+    set_relations,
+    community_hash,
+    search_graph_chunks,
     get_graph,
     set_graph,
     chunk_id,
     update_nodes_pagerank_nhop_neighbour,
     does_graph_contains,
-    get_graph_doc_ids,
 )
 from rag.nlp import rag_tokenizer, search
 from rag.utils.redis_conn import REDIS_CONN
@@ -142,6 +149,10 @@ async def update_graph(
         set_entity=partial(set_entity, tenant_id, kb_id, embed_bdl),
         get_relation=partial(get_relation, tenant_id, kb_id),
         set_relation=partial(set_relation, tenant_id, kb_id, embed_bdl),
+        get_entities=partial(get_entities, tenant_id, kb_id),
+        set_entities=partial(set_entities, tenant_id, kb_id, embed_bdl),
+        get_relations=partial(get_relations, tenant_id, kb_id),
+        set_relations=partial(set_relations, tenant_id, kb_id, embed_bdl),
     )
     ents, rels = await ext(doc_id, chunks, callback)
     subgraph = nx.Graph()
@@ -155,48 +166,21 @@ async def update_graph(
             weight=rel["weight"],
             # description=rel["description"]
         )
-    # TODO: infinity doesn't support array search
-    chunk = {
-        "content_with_weight": json.dumps(
-            nx.node_link_data(subgraph, edges="edges"), ensure_ascii=False, indent=2
-        ),
-        "knowledge_graph_kwd": "subgraph",
-        "kb_id": kb_id,
-        "source_id": [doc_id],
-        "available_int": 0,
-        "removed_kwd": "N",
-    }
-    cid = chunk_id(chunk)
-    await trio.to_thread.run_sync(
-        lambda: settings.docStoreConn.insert(
-            [{"id": cid, **chunk}], search.index_name(tenant_id), kb_id
-        )
-    )
+    await add_graph_delta(tenant_id, kb_id, doc_id, subgraph)
     now = trio.current_time()
     callback(msg=f"generated subgraph for doc {doc_id} in {now - start:.2f} seconds.")
     start = now
 
-    while True:
-        new_graph = subgraph
-        now_docids = set([doc_id])
-        old_graph, old_doc_ids = await get_graph(tenant_id, kb_id)
-        if old_graph is not None:
-            logging.info("Merge with an exiting graph...................")
-            new_graph = graph_merge(old_graph, subgraph)
-        await update_nodes_pagerank_nhop_neighbour(tenant_id, kb_id, new_graph, 2)
-        if old_doc_ids:
-            for old_doc_id in old_doc_ids:
-                now_docids.add(old_doc_id)
-        old_doc_ids2 = await get_graph_doc_ids(tenant_id, kb_id)
-        delta_doc_ids = set(old_doc_ids2) - set(old_doc_ids)
-        if delta_doc_ids:
-            callback(
-                msg="The global graph has changed during merging, try again"
-            )
-            await trio.sleep(1)
-            continue
-        break
-    await set_graph(tenant_id, kb_id, new_graph, list(now_docids))
+    new_graph, now_docids, pending = await get_graph(tenant_id, kb_id)
+    if new_graph is None:
+        new_graph, now_docids, pending = subgraph, [doc_id], GRAPH_COMPACT_DELTAS
+    elif doc_id not in now_docids:
+        # the doc store may not have refreshed since the subgraph was stored
+        merge_graph_delta(new_graph, subgraph)
+    now_docids = set(now_docids) | {doc_id}
+    await update_nodes_pagerank_nhop_neighbour(tenant_id, kb_id, new_graph, 2)
+    if pending >= GRAPH_COMPACT_DELTAS:
+        await set_graph(tenant_id, kb_id, new_graph, list(now_docids))
     now = trio.current_time()
     callback(
         msg=f"merging subgraph for doc {doc_id} into the global graph done in {now - start:.2f} seconds."
@@ -303,7 +287,17 @@ async def extract_community(
         get_relation=partial(get_relation, tenant_id, kb_id),
         set_relation=partial(set_relation, tenant_id, kb_id, embed_bdl),
     )
-    cr = await ext(graph, callback=callback)
+    stored = await trio.to_thread.run_sync(
+        lambda: search_graph_chunks(
+            tenant_id,
+            kb_id,
+            {"knowledge_graph_kwd": ["community_report"]},
+            ["entities_kwd", "docnm_kwd"],
+        )
+    )
+    stored_hashes = {id: community_hash(d.get("entities_kwd") or []) for id, d in stored.items()}
+    known_reports = {stored_hashes[id]: d.get("docnm_kwd", "") for id, d in stored.items()}
+    cr = await ext(graph, callback=callback, known_reports=known_reports)
     community_structure = cr.structured_output
     community_reports = cr.output
     working_doc_id = graphrag_task_get(tenant_id, kb_id)
@@ -319,25 +313,37 @@ async def extract_community(
         msg=f"Graph extracted {len(cr.structured_output)} communities in {now - start:.2f}s."
     )
     start = now
-    await trio.to_thread.run_sync(
-        lambda: settings.docStoreConn.delete(
-            {"knowledge_graph_kwd": "community_report", "kb_id": kb_id},
-            search.index_name(tenant_id),
-            kb_id,
+    kept = {
+        id: {"source_id": doc_ids, "weight_flt": cr.reused[h]}
+        for id, h in stored_hashes.items()
+        if h in cr.reused
+    }
+    # The listing stops at the search window, so delete every other report by query rather than
+    # the listed stale ids, which would leave the unlisted ones behind.
+    if len(kept) < len(stored) or len(stored) >= GRAPH_CHUNKS_LIMIT:
+        await trio.to_thread.run_sync(
+            lambda: settings.docStoreConn.delete(
+                {"knowledge_graph_kwd": ["community_report"], "kb_id": kb_id, "must_not": {"id": list(kept.keys())}},
+                search.index_name(tenant_id),
+                kb_id,
+            )
         )
-    )
+    if kept:
+        await trio.to_thread.run_sync(
+            lambda: settings.docStoreConn.bulkUpdate(
+                kept, search.index_name(tenant_id), kb_id
+            )
+        )
+    chunks = []
     for stru, rep in zip(community_structure, community_reports):
         obj = {
             "report": rep,
             "evidences": "\n".join([f["explanation"] for f in stru["findings"]]),
         }
-        chunk = {
+        chunks.append({
             "docnm_kwd": stru["title"],
-            "title_tks": rag_tokenizer.tokenize(stru["title"]),
             "content_with_weight": json.dumps(obj, ensure_ascii=False),
-            "content_ltks": rag_tokenizer.tokenize(
-                obj["report"] + " " + obj["evidences"]
-            ),
+            "content_ltks": obj["report"] + " " + obj["evidences"],
             "knowledge_graph_kwd": "community_report",
             "weight_flt": stru["weight"],
             "entities_kwd": stru["entities"],
@@ -345,18 +351,20 @@ async def extract_community(
             "kb_id": kb_id,
             "source_id": doc_ids,
             "available_int": 0,
-        }
-        chunk["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(
-            chunk["content_ltks"]
-        )
-        # try:
-        #    ebd, _ = embed_bdl.encode([", ".join(community["entities"])])
-        #    chunk["q_%d_vec" % len(ebd[0])] = ebd[0]
-        # except Exception as e:
-        #    logging.exception(f"Fail to embed entity relation: {e}")
+        })
+    titles_tks = rag_tokenizer.tokenize_batch([c["docnm_kwd"] for c in chunks])
+    content_ltks = rag_tokenizer.tokenize_batch([c["content_ltks"] for c in chunks])
+    content_sm_ltks = rag_tokenizer.fine_grained_tokenize_batch(content_ltks)
+    for chunk, title_tks, ltks, sm_ltks in zip(chunks, titles_tks, content_ltks, content_sm_ltks):
+        chunk["title_tks"] = title_tks
+        chunk["content_ltks"] = ltks
+        chunk["content_sm_ltks"] = sm_ltks
+    if chunks:
         await trio.to_thread.run_sync(
             lambda: settings.docStoreConn.insert(
-                [{"id": chunk_id(chunk), **chunk}], search.index_name(tenant_id)
+                [{"id": chunk_id(chunk), **chunk} for chunk in chunks],
+                search.index_name(tenant_id),
+                kb_id,
             )
         )
 
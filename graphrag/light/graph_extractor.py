@@ -37,10 +37,15 @@ class GraphExtractor(Extractor):
         set_entity: Callable | None = None,
         get_relation: Callable | None = None,
         set_relation: Callable | None = None,
+        get_entities: Callable | None = None,
+        set_entities: Callable | None = None,
+        get_relations: Callable | None = None,
+        set_relations: Callable | None = None,
         example_number: int = 2,
         max_gleanings: int | None = None,
     ):
-        super().__init__(llm_invoker, language, entity_types, get_entity, set_entity, get_relation, set_relation)
+        super().__init__(llm_invoker, language, entity_types, get_entity, set_entity, get_relation, set_relation,
+                         get_entities, set_entities, get_relations, set_relations)
         """Init method definition."""
         self._max_gleanings = (
             max_gleanings
@@ -6,11 +6,14 @@ Reference:
  - [LightRag](https://github.com/HKUDS/LightRAG)
 """
 
+import base64
 import html
 import json
 import logging
 import re
+import threading
 import time
+import zlib
 from collections import defaultdict
 from copy import deepcopy
 from hashlib import md5
@@ -19,19 +22,33 @@ import os
 import trio
 
 import networkx as nx
-import numpy as np
 import xxhash
+from cachetools import LRUCache
 from networkx.readwrite import json_graph
 
 from api import settings
 from rag.nlp import search, rag_tokenizer
 from rag.utils.doc_store_conn import OrderByExpr
+from rag.utils.embedding_cache import EMBEDDING_CACHE
 from rag.utils.redis_conn import REDIS_CONN
 
 ErrorHandlerFn = Callable[[BaseException | None, str | None, dict | None], None]
 
 chat_limiter = trio.CapacityLimiter(int(os.environ.get('MAX_CONCURRENT_CHATS', 10)))
 
+# Document subgraphs are folded into a new graph snapshot once this many are pending.
+GRAPH_COMPACT_DELTAS = int(os.environ.get("GRAPH_COMPACT_DELTAS", "16"))
+GRAPH_CACHE_SIZE = int(os.environ.get("GRAPH_CACHE_SIZE", "2"))
+GRAPH_VERSION_TTL = 30 * 24 * 3600
+# the doc store does not page past its result window (index.max_result_window of ES)
+GRAPH_DELTA_SCAN_LIMIT = 10000
+GRAPH_CHUNKS_LIMIT = 10000
+GRAPH_SNAPSHOT_PREFIX = "zlib:"
+GRAPH_CACHE = LRUCache(maxsize=max(GRAPH_CACHE_SIZE, 1))
+GRAPH_CACHE_LOCK = threading.Lock()
+# Entity ranks that moved less than this fraction since the last run are not written again.
+PAGERANK_WRITE_TOLERANCE = float(os.environ.get("PAGERANK_WRITE_TOLERANCE", "0.01"))
+
 def perform_variable_replacements(
     input: str, history: list[dict] | None = None, variables: dict | None = None
 ) -> str:
@@ -107,25 +124,11 @@ def set_llm_cache(llmnm, txt, v, history, genconf):
 
 
 def get_embed_cache(llmnm, txt):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
-
-    k = hasher.hexdigest()
-    bin = REDIS_CONN.get(k)
-    if not bin:
-        return
-    return np.array(json.loads(bin))
+    return EMBEDDING_CACHE.get_many(llmnm, [txt])[0]
 
 
 def set_embed_cache(llmnm, txt, arr):
-    hasher = xxhash.xxh64()
-    hasher.update(str(llmnm).encode("utf-8"))
-    hasher.update(str(txt).encode("utf-8"))
-
-    k = hasher.hexdigest()
-    arr = json.dumps(arr.tolist() if isinstance(arr, np.ndarray) else arr)
-    REDIS_CONN.set(k, arr.encode("utf-8"), 24*3600)
+    EMBEDDING_CACHE.set_many(llmnm, [txt], [arr])
 
 
 def get_tags_from_cache(kb_ids):
@@ -165,6 +168,11 @@ def graph_merge(g1, g2):
     return g
 
 
+def community_hash(entities: list[str]) -> str:
+    """Identify a community by its members, whatever order they come in."""
+    return xxhash.xxh64("\n".join(sorted(set(entities))).encode("utf-8")).hexdigest()
+
+
 def compute_args_hash(*args):
     return md5(str(args).encode()).hexdigest()
 
@@ -237,27 +245,23 @@ def is_float_regex(value):
 def chunk_id(chunk):
     return xxhash.xxh64((chunk["content_with_weight"] + chunk["kb_id"]).encode("utf-8")).hexdigest()
 
-def get_entity_cache(tenant_id, kb_id, ent_name) -> str | list[str]:
+def entity_cache_key(tenant_id, kb_id, ent_name):
     hasher = xxhash.xxh64()
     hasher.update(str(tenant_id).encode("utf-8"))
     hasher.update(str(kb_id).encode("utf-8"))
     hasher.update(str(ent_name).encode("utf-8"))
+    return hasher.hexdigest()
 
-    k = hasher.hexdigest()
-    bin = REDIS_CONN.get(k)
+
+def get_entity_cache(tenant_id, kb_id, ent_name) -> str | list[str]:
+    bin = REDIS_CONN.get(entity_cache_key(tenant_id, kb_id, ent_name))
     if not bin:
         return
     return json.loads(bin)
 
 
 def set_entity_cache(tenant_id, kb_id, ent_name, content_with_weight):
-    hasher = xxhash.xxh64()
-    hasher.update(str(tenant_id).encode("utf-8"))
-    hasher.update(str(kb_id).encode("utf-8"))
-    hasher.update(str(ent_name).encode("utf-8"))
-
-    k = hasher.hexdigest()
-    REDIS_CONN.set(k, content_with_weight.encode("utf-8"), 3600)
+    REDIS_CONN.set(entity_cache_key(tenant_id, kb_id, ent_name), content_with_weight.encode("utf-8"), 3600)
 
 
 def get_entity(tenant_id, kb_id, ent_name):
@@ -284,32 +288,40 @@ def get_entity(tenant_id, kb_id, ent_name):
     return res
 
 
-def set_entity(tenant_id, kb_id, embd_mdl, ent_name, meta):
-    chunk = {
+def entity_chunk(kb_id, ent_name, meta, tks=None):
+    """tks are the (title_tks, content_ltks, content_sm_ltks) of the entity if already tokenized."""
+    if tks is None:
+        content_ltks = rag_tokenizer.tokenize(meta["description"])
+        tks = (rag_tokenizer.tokenize(ent_name), content_ltks, rag_tokenizer.fine_grained_tokenize(content_ltks))
+    return {
         "important_kwd": [ent_name],
-        "title_tks": rag_tokenizer.tokenize(ent_name),
+        "title_tks": tks[0],
         "entity_kwd": ent_name,
         "knowledge_graph_kwd": "entity",
         "entity_type_kwd": meta["entity_type"],
         "content_with_weight": json.dumps(meta, ensure_ascii=False),
-        "content_ltks": rag_tokenizer.tokenize(meta["description"]),
+        "content_ltks": tks[1],
+        "content_sm_ltks": tks[2],
         "source_id": list(set(meta["source_id"])),
         "kb_id": kb_id,
         "available_int": 0
     }
-    chunk["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(chunk["content_ltks"])
+
+
+def set_entity(tenant_id, kb_id, embd_mdl, ent_name, meta):
+    chunk = entity_chunk(kb_id, ent_name, meta)
     set_entity_cache(tenant_id, kb_id, ent_name, chunk["content_with_weight"])
     res = settings.retrievaler.search({"entity_kwd": ent_name, "size": 1, "fields": []},
                                       search.index_name(tenant_id), [kb_id])
     if res.ids:
         settings.docStoreConn.update({"entity_kwd": ent_name}, chunk, search.index_name(tenant_id), kb_id)
     else:
-        ebd = get_embed_cache(embd_mdl.llm_name, ent_name)
+        ebd = get_embed_cache(embd_mdl.model_key, ent_name)
         if ebd is None:
             try:
                 ebd, _ = embd_mdl.encode([ent_name])
                 ebd = ebd[0]
-                set_embed_cache(embd_mdl.llm_name, ent_name, ebd)
+                set_embed_cache(embd_mdl.model_key, ent_name, ebd)
             except Exception as e:
                 logging.exception(f"Fail to embed entity: {e}")
         if ebd is not None:
@@ -344,20 +356,28 @@ def get_relation(tenant_id, kb_id, from_ent_name, to_ent_name, size=1):
     return res
 
 
-def set_relation(tenant_id, kb_id, embd_mdl, from_ent_name, to_ent_name, meta):
-    chunk = {
+def relation_chunk(kb_id, from_ent_name, to_ent_name, meta, tks=None):
+    """tks are the (content_ltks, content_sm_ltks) of the relation if already tokenized."""
+    if tks is None:
+        content_ltks = rag_tokenizer.tokenize(meta["description"])
+        tks = (content_ltks, rag_tokenizer.fine_grained_tokenize(content_ltks))
+    return {
         "from_entity_kwd": from_ent_name,
         "to_entity_kwd": to_ent_name,
         "knowledge_graph_kwd": "relation",
         "content_with_weight": json.dumps(meta, ensure_ascii=False),
-        "content_ltks": rag_tokenizer.tokenize(meta["description"]),
+        "content_ltks": tks[0],
+        "content_sm_ltks": tks[1],
         "important_kwd": meta["keywords"],
         "source_id": list(set(meta["source_id"])),
         "weight_int": int(meta["weight"]),
         "kb_id": kb_id,
         "available_int": 0
     }
-    chunk["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(chunk["content_ltks"])
+
+
+def set_relation(tenant_id, kb_id, embd_mdl, from_ent_name, to_ent_name, meta):
+    chunk = relation_chunk(kb_id, from_ent_name, to_ent_name, meta)
     res = settings.retrievaler.search({"from_entity_kwd": to_ent_name, "to_entity_kwd": to_ent_name, "size": 1, "fields": []},
                                       search.index_name(tenant_id), [kb_id])
 
@@ -367,84 +387,390 @@ def set_relation(tenant_id, kb_id, embd_mdl, from_ent_name, to_ent_name, meta):
                                  search.index_name(tenant_id), kb_id)
     else:
         txt = f"{from_ent_name}->{to_ent_name}"
-        ebd = get_embed_cache(embd_mdl.llm_name, txt)
+        ebd = get_embed_cache(embd_mdl.model_key, txt)
         if ebd is None:
             try:
                 ebd, _ = embd_mdl.encode([txt+f": {meta['description']}"])
                 ebd = ebd[0]
-                set_embed_cache(embd_mdl.llm_name, txt, ebd)
+                set_embed_cache(embd_mdl.model_key, txt, ebd)
             except Exception as e:
                 logging.exception(f"Fail to embed entity relation: {e}")
         if ebd is not None:
             chunk["q_%d_vec" % len(ebd)] = ebd
         settings.docStoreConn.insert([{"id": chunk_id(chunk), **chunk}], search.index_name(tenant_id), kb_id)
 
+
+def search_graph_chunks(tenant_id, kb_id, condition: dict, fields: list[str]) -> dict[str, dict]:
+    res = settings.docStoreConn.search(fields, [], {"kb_id": kb_id, **condition}, [], OrderByExpr(), 0, GRAPH_CHUNKS_LIMIT,
+                                       search.index_name(tenant_id), [kb_id])
+    res = settings.docStoreConn.getFields(res, fields)
+    for d in res.values():
+        for k in ["entity_kwd", "from_entity_kwd", "to_entity_kwd"]:
+            if isinstance(d.get(k), list):
+                d[k] = d[k][0] if d[k] else ""
+    return res
+
+
+def get_entities(tenant_id, kb_id, ent_names: list[str]) -> dict[str, dict]:
+    """The stored entities among `ent_names` by name, cached ones first and the others in batched searches."""
+    names = list(set(ent_names))
+    res = {}
+    for n, bin in zip(names, REDIS_CONN.mget([entity_cache_key(tenant_id, kb_id, n) for n in names])):
+        if bin:
+            res[n] = json.loads(bin)
+    missing = [n for n in names if n not in res]
+    cache = {}
+    bs = 1024
+    for i in range(0, len(missing), bs):
+        found = search_graph_chunks(tenant_id, kb_id, {"knowledge_graph_kwd": ["entity"], "entity_kwd": missing[i:i + bs]},
+                                    ["entity_kwd", "content_with_weight"])
+        for d in found.values():
+            try:
+                res[d["entity_kwd"]] = json.loads(d["content_with_weight"])
+            except Exception:
+                continue
+            cache[entity_cache_key(tenant_id, kb_id, d["entity_kwd"])] = d["content_with_weight"]
+    REDIS_CONN.set_many(cache, 3600)
+    return res
+
+
+def set_entities(tenant_id, kb_id, embd_mdl, metas: dict[str, dict]):
+    """Upsert entities by name: existing ones are updated by id in bulk, new ones embedded in one batch and inserted in bulk."""
+    if not metas:
+        return
+    names = list(metas.keys())
+    descs = [metas[n]["description"] for n in names]
+    content_ltks = rag_tokenizer.tokenize_batch(descs)
+    tks = zip(rag_tokenizer.tokenize_batch(names), content_ltks, rag_tokenizer.fine_grained_tokenize_batch(content_ltks))
+    chunks = {n: entity_chunk(kb_id, n, metas[n], t) for n, t in zip(names, tks)}
+    REDIS_CONN.set_many({entity_cache_key(tenant_id, kb_id, n): c["content_with_weight"] for n, c in chunks.items()}, 3600)
+
+    existing = {}
+    bs = 1024
+    for i in range(0, len(names), bs):
+        found = search_graph_chunks(tenant_id, kb_id, {"knowledge_graph_kwd": ["entity"], "entity_kwd": names[i:i + bs]}, ["entity_kwd"])
+        for id, d in found.items():
+            existing.setdefault(d["entity_kwd"], []).append(id)
+    updates = {id: chunks[n] for n, ids in existing.items() if n in chunks for id in ids}
+    if updates:
+        settings.docStoreConn.bulkUpdate(updates, search.index_name(tenant_id), kb_id)
+
+    new = [n for n in names if n not in existing]
+    if not new:
+        return
+    try:
+        ebds, _ = embd_mdl.encode(new)
+    except Exception as e:
+        logging.exception(f"Fail to embed entities: {e}")
+        ebds = [None] * len(new)
+    inserts = []
+    for n, ebd in zip(new, ebds):
+        chunk = chunks[n]
+        if ebd is not None:
+            chunk["q_%d_vec" % len(ebd)] = ebd
+        inserts.append({"id": chunk_id(chunk), **chunk})
+    settings.docStoreConn.insert(inserts, search.index_name(tenant_id), kb_id)
+
+
+def get_relations(tenant_id, kb_id, pairs: list[tuple]) -> dict[tuple, dict]:
+    """The stored relations between the (from, to) `pairs`, in either direction, keyed by the pair asked for."""
+    res = {}
+    pairs = list(set(pairs))
+    bs = 256
+    for i in range(0, len(pairs), bs):
+        batch = pairs[i:i + bs]
+        ents = list(set([e for p in batch for e in p]))
+        found = search_graph_chunks(tenant_id, kb_id, {"knowledge_graph_kwd": ["relation"], "from_entity_kwd": ents, "to_entity_kwd": ents},
+                                    ["from_entity_kwd", "to_entity_kwd", "content_with_weight"])
+        stored = {}
+        for d in found.values():
+            stored[(d["from_entity_kwd"], d["to_entity_kwd"])] = d["content_with_weight"]
+        for f, t in batch:
+            content = stored.get((f, t)) or stored.get((t, f))
+            if not content:
+                continue
+            try:
+                res[(f, t)] = json.loads(content)
+            except Exception:
+                continue
+    return res
+
+
+def set_relations(tenant_id, kb_id, embd_mdl, metas: dict[tuple, dict]):
+    """Upsert relations by (from, to) the same way set_entities upserts entities."""
+    if not metas:
+        return
+    pairs = list(metas.keys())
+    content_ltks = rag_tokenizer.tokenize_batch([metas[p]["description"] for p in pairs])
+    tks = zip(content_ltks, rag_tokenizer.fine_grained_tokenize_batch(content_ltks))
+    chunks = {p: relation_chunk(kb_id, p[0], p[1], metas[p], t) for p, t in zip(pairs, tks)}
+
+    existing = {}
+    bs = 256
+    for i in range(0, len(pairs), bs):
+        batch = pairs[i:i + bs]
+        found = search_graph_chunks(tenant_id, kb_id, {"knowledge_graph_kwd": ["relation"],
+                                                       "from_entity_kwd": list(set([p[0] for p in batch])),
+                                                       "to_entity_kwd": list(set([p[1] for p in batch]))},
+                                    ["from_entity_kwd", "to_entity_kwd"])
+        for id, d in found.items():
+            existing.setdefault((d["from_entity_kwd"], d["to_entity_kwd"]), []).append(id)
+    updates = {id: chunks[p] for p, ids in existing.items() if p in chunks for id in ids}
+    if updates:
+        settings.docStoreConn.bulkUpdate(updates, search.index_name(tenant_id), kb_id)
+
+    new = [p for p in pairs if p not in existing]
+    if not new:
+        return
+    try:
+        ebds, _ = embd_mdl.encode([f"{f}->{t}: {metas[(f, t)]['description']}" for f, t in new])
+    except Exception as e:
+        logging.exception(f"Fail to embed entity relations: {e}")
+        ebds = [None] * len(new)
+    inserts = []
+    for p, ebd in zip(new, ebds):
+        chunk = chunks[p]
+        if ebd is not None:
+            chunk["q_%d_vec" % len(ebd)] = ebd
+        inserts.append({"id": chunk_id(chunk), **chunk})
+    settings.docStoreConn.insert(inserts, search.index_name(tenant_id), kb_id)
+
+
+def graph_version_key(kb_id):
+    return f"graphrag:version:{kb_id}"
+
+
+def graph_snapshot_key(kb_id):
+    return f"graphrag:snapshot:{kb_id}"
+
+
+def graph_pending_key(kb_id):
+    # documents whose subgraph is stored but not folded into the snapshot yet,
+    # trusted only while the version key of the graph exists
+    return f"graphrag:pending:{kb_id}"
+
+
+def graph_pagerank_key(kb_id):
+    # entity name -> pagerank last written to its chunk
+    return f"graphrag:pagerank:{kb_id}"
+
+
+def invalidate_graph(kb_id, doc_ids=None):
+    """Make every process reload the graph of `kb_id` after its chunks were changed elsewhere."""
+    REDIS_CONN.srem_many(graph_pending_key(kb_id), doc_ids or [])
+    REDIS_CONN.delete(graph_snapshot_key(kb_id))
+    # entities may have been deleted and come back without a rank
+    REDIS_CONN.delete(graph_pagerank_key(kb_id))
+    if REDIS_CONN.exist(graph_version_key(kb_id)):
+        REDIS_CONN.incr(graph_version_key(kb_id), GRAPH_VERSION_TTL)
+
+
+def graph_delta_id(kb_id, doc_id):
+    # one delta per document, re-extracting a document overwrites it
+    return xxhash.xxh64(f"{kb_id}:subgraph:{doc_id}".encode("utf-8")).hexdigest()
+
+
+def dump_graph_snapshot(graph) -> str:
+    data = json.dumps(nx.node_link_data(graph, edges="edges"), ensure_ascii=False, separators=(",", ":"))
+    return GRAPH_SNAPSHOT_PREFIX + base64.b64encode(zlib.compress(data.encode("utf-8"))).decode("ascii")
+
+
+def load_graph_snapshot(content: str) -> dict:
+    """Node-link data of a stored graph, either a compressed snapshot or plain JSON."""
+    if content.startswith(GRAPH_SNAPSHOT_PREFIX):
+        content = zlib.decompress(base64.b64decode(content[len(GRAPH_SNAPSHOT_PREFIX):])).decode("utf-8")
+    return json.loads(content)
+
+
+def merge_graph_delta(graph, delta):
+    """Merge the subgraph of one document into `graph` in place, as graph_merge does, touching only its nodes."""
+    for n, attr in delta.nodes(data=True):
+        if graph.has_node(n):
+            graph.nodes[n].update(attr)
+        else:
+            graph.add_node(n, **attr)
+    for source, target, attr in delta.edges(data=True):
+        if graph.has_edge(source, target):
+            graph[source][target]["weight"] = graph[source][target].get("weight", 0) + 1
+            continue
+        graph.add_edge(source, target, **attr)
+    touched = set(delta.nodes())
+    for source, target in delta.edges():
+        touched.update([source, target])
+    for n in touched:
+        graph.nodes[n]["rank"] = int(graph.degree(n))
+    return graph
+
+
+def list_graph_deltas(tenant_id, kb_id) -> dict[str, list[str]]:
+    """
+    Ids of the stored per-document subgraphs of `kb_id`, with the documents they come from.
+
+    Only used when the pending documents tracked in Redis are lost, the doc store does not
+    page past its result window so at most that many subgraphs are listed.
+    """
+    flds = ["source_id"]
+    deltas = {}
+    bs = 1000
+    for i in range(0, GRAPH_DELTA_SCAN_LIMIT, bs):
+        res = settings.docStoreConn.search(flds, [], {"kb_id": kb_id, "knowledge_graph_kwd": ["subgraph"]}, [],
+                                           OrderByExpr(), i, min(bs, GRAPH_DELTA_SCAN_LIMIT - i),
+                                           search.index_name(tenant_id), [kb_id])
+        res = settings.docStoreConn.getFields(res, flds)
+        for id, d in res.items():
+            deltas[id] = d.get("source_id") or []
+        if len(res) < bs:
+            return deltas
+    logging.warning(f"More than {GRAPH_DELTA_SCAN_LIMIT} subgraphs in {kb_id}, the rest are not listed.")
+    return deltas
+
+
+def get_graph_snapshot(tenant_id, kb_id, fields):
+    """Fields of the snapshot chunk of `kb_id`, None if there is none."""
+    res = settings.retrievaler.search({"fields": fields + ["removed_kwd"], "size": 1, "knowledge_graph_kwd": ["graph"]},
+                                      search.index_name(tenant_id), [kb_id])
+    for id in res.ids:
+        return res.field[id]
+    return None
+
+
+def pending_graph_deltas(tenant_id, kb_id, snapshot_doc_ids, version) -> dict[str, list[str]]:
+    """Ids of the subgraphs of `kb_id` not folded into its snapshot, with the documents they come from."""
+    if version:
+        return {graph_delta_id(kb_id, doc_id): [doc_id] for doc_id in REDIS_CONN.smembers(graph_pending_key(kb_id)) or []
+                if doc_id not in snapshot_doc_ids}
+    return {id: docs for id, docs in list_graph_deltas(tenant_id, kb_id).items() if not set(docs) <= snapshot_doc_ids}
+
+
+def load_graph(tenant_id, kb_id):
+    """
+    Return (graph, doc_ids, pending) of `kb_id`, where pending is the number of document subgraphs
+    not folded into the stored snapshot yet, or None if the graph must be rebuilt.
+
+    The global graph is the latest snapshot plus the subgraphs of the documents it does not hold.
+    A process keeps the graphs it loaded, so while the snapshot is unchanged only the subgraphs
+    added since are fetched, and nothing at all while the version of the graph is unchanged.
+    """
+    version, snapshot_version = REDIS_CONN.mget([graph_version_key(kb_id), graph_snapshot_key(kb_id)])
+    with GRAPH_CACHE_LOCK:
+        cached = GRAPH_CACHE.get((tenant_id, kb_id))
+    if cached and version and cached["version"] == version:
+        return cached["graph"].copy(), list(cached["doc_ids"]), cached["pending"]
+
+    if cached and snapshot_version and cached["snapshot"] == snapshot_version:
+        graph, doc_ids, folded = cached["graph"].copy(), set(cached["doc_ids"]), set(cached["folded"])
+        snapshot_doc_ids = set(cached["snapshot_doc_ids"])
+    else:
+        graph, doc_ids, folded = None, set(), set()
+        snapshot = get_graph_snapshot(tenant_id, kb_id, ["content_with_weight", "source_id"])
+        if snapshot and snapshot.get("removed_kwd") == "Y":
+            # a document of the snapshot was removed, only its entities and relations tell what is left
+            return None
+        if snapshot:
+            graph = json_graph.node_link_graph(load_graph_snapshot(snapshot["content_with_weight"]), edges="edges")
+            doc_ids = set(snapshot["source_id"])
+        snapshot_doc_ids = set(doc_ids)
+
+    deltas = pending_graph_deltas(tenant_id, kb_id, snapshot_doc_ids, version)
+    pending = [id for id in deltas if id not in folded]
+    bs = 256
+    for i in range(0, len(pending), bs):
+        res = settings.docStoreConn.search(["content_with_weight", "source_id"], [], {"id": pending[i:i + bs]}, [],
+                                           OrderByExpr(), 0, bs, search.index_name(tenant_id), [kb_id])
+        for id, d in settings.docStoreConn.getFields(res, ["content_with_weight", "source_id"]).items():
+            try:
+                delta = json_graph.node_link_graph(json.loads(d["content_with_weight"]), edges="edges")
+            except Exception as e:
+                logging.warning(f"Fail to load the subgraph {id} of {kb_id}: {e}")
+                continue
+            graph = merge_graph_delta(graph, delta) if graph is not None else delta
+            doc_ids.update(d.get("source_id") or [])
+            folded.add(id)
+    if graph is None:
+        return None, [], 0
+
+    # without the pending documents in Redis, have the caller fold everything into a new snapshot
+    pending = len(deltas) if version else max(len(deltas), GRAPH_COMPACT_DELTAS)
+    with GRAPH_CACHE_LOCK:
+        GRAPH_CACHE[(tenant_id, kb_id)] = {"version": version, "snapshot": snapshot_version, "graph": graph,
+                                           "doc_ids": doc_ids, "snapshot_doc_ids": snapshot_doc_ids,
+                                           "folded": folded, "pending": pending}
+    return graph.copy(), list(doc_ids), pending
+
+
 async def does_graph_contains(tenant_id, kb_id, doc_id):
-    # Get doc_ids of graph
-    fields = ["source_id"]
-    condition = {
-        "knowledge_graph_kwd": ["graph"],
-        "removed_kwd": "N",
-    }
-    res = await trio.to_thread.run_sync(lambda: settings.docStoreConn.search(fields, [], condition, [], OrderByExpr(), 0, 1, search.index_name(tenant_id), [kb_id]))
-    fields2 = settings.docStoreConn.getFields(res, fields)
-    graph_doc_ids = set()
-    for chunk_id in fields2.keys():
-        graph_doc_ids = set(fields2[chunk_id]["source_id"])
-    return doc_id in graph_doc_ids
+    return doc_id in await get_graph_doc_ids(tenant_id, kb_id)
+
 
 async def get_graph_doc_ids(tenant_id, kb_id) -> list[str]:
-    conds = {
-        "fields": ["source_id"],
-        "removed_kwd": "N",
-        "size": 1,
-        "knowledge_graph_kwd": ["graph"]
-    }
-    res = await trio.to_thread.run_sync(lambda: settings.retrievaler.search(conds, search.index_name(tenant_id), [kb_id]))
-    doc_ids = []
-    if res.total == 0:
-        return doc_ids
-    for id in res.ids:
-        doc_ids = res.field[id]["source_id"]
-    return doc_ids
+    def doc_ids():
+        version = REDIS_CONN.get(graph_version_key(kb_id))
+        snapshot = get_graph_snapshot(tenant_id, kb_id, ["source_id"])
+        ids = set(snapshot["source_id"]) if snapshot and snapshot.get("removed_kwd") != "Y" else set()
+        for docs in pending_graph_deltas(tenant_id, kb_id, ids, version).values():
+            ids.update(docs)
+        return list(ids)
+
+    return await trio.to_thread.run_sync(doc_ids)
 
 
 async def get_graph(tenant_id, kb_id):
-    conds = {
-        "fields": ["content_with_weight", "source_id"],
-        "removed_kwd": "N",
-        "size": 1,
-        "knowledge_graph_kwd": ["graph"]
+    try:
+        res = await trio.to_thread.run_sync(lambda: load_graph(tenant_id, kb_id))
+        if res is not None:
+            return res
+    except Exception:
+        logging.exception(f"Fail to load the graph of {kb_id}, rebuild it from entities and relations.")
+    graph, doc_ids = await rebuild_graph(tenant_id, kb_id)
+    # a rebuilt graph is stored as a new snapshot right away
+    return graph, doc_ids or [], GRAPH_COMPACT_DELTAS
+
+
+async def add_graph_delta(tenant_id, kb_id, doc_id, subgraph):
+    """Store the subgraph extracted from `doc_id`; it is part of the global graph once stored."""
+    chunk = {
+        "content_with_weight": json.dumps(nx.node_link_data(subgraph, edges="edges"), ensure_ascii=False,
+                                          separators=(",", ":")),
+        "knowledge_graph_kwd": "subgraph",
+        "kb_id": kb_id,
+        "source_id": [doc_id],
+        "available_int": 0,
+        "removed_kwd": "N"
     }
-    res = await trio.to_thread.run_sync(lambda: settings.retrievaler.search(conds, search.index_name(tenant_id), [kb_id]))
-    if res.total == 0:
-        return None, []
-    for id in res.ids:
-        try:
-            return json_graph.node_link_graph(json.loads(res.field[id]["content_with_weight"]), edges="edges"), \
-                   res.field[id]["source_id"]
-        except Exception:
-            continue
-    result = await rebuild_graph(tenant_id, kb_id)
-    return result
+    await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert([{"id": graph_delta_id(kb_id, doc_id), **chunk}],
+                                                                      search.index_name(tenant_id), kb_id))
+    REDIS_CONN.sadd(graph_pending_key(kb_id), doc_id)
+    # a missing version means the pending documents are unknown, only a new snapshot sets it again
+    if REDIS_CONN.exist(graph_version_key(kb_id)):
+        REDIS_CONN.incr(graph_version_key(kb_id), GRAPH_VERSION_TTL)
 
 
 async def set_graph(tenant_id, kb_id, graph, docids):
+    """Store `graph` as the snapshot of `kb_id`, folding in the subgraphs of `docids`."""
     chunk = {
-        "content_with_weight": json.dumps(nx.node_link_data(graph, edges="edges"), ensure_ascii=False,
-                                          indent=2),
+        "content_with_weight": dump_graph_snapshot(graph),
         "knowledge_graph_kwd": "graph",
         "kb_id": kb_id,
         "source_id": list(docids),
         "available_int": 0,
         "removed_kwd": "N"
-    }     
+    }
     res = await trio.to_thread.run_sync(lambda: settings.retrievaler.search({"knowledge_graph_kwd": "graph", "size": 1, "fields": []}, search.index_name(tenant_id), [kb_id]))
     if res.ids:
         await trio.to_thread.run_sync(lambda: settings.docStoreConn.update({"knowledge_graph_kwd": "graph"}, chunk,
                                      search.index_name(tenant_id), kb_id))
     else:
         await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert([{"id": chunk_id(chunk), **chunk}], search.index_name(tenant_id), kb_id))
+    REDIS_CONN.srem_many(graph_pending_key(kb_id), list(docids))
+    version = REDIS_CONN.incr(graph_version_key(kb_id), GRAPH_VERSION_TTL)
+    if version is None:
+        return
+    version = str(version)
+    REDIS_CONN.set(graph_snapshot_key(kb_id), version, GRAPH_VERSION_TTL)
+    with GRAPH_CACHE_LOCK:
+        GRAPH_CACHE[(tenant_id, kb_id)] = {"version": version, "snapshot": version, "graph": graph.copy(),
+                                           "doc_ids": set(docids), "snapshot_doc_ids": set(docids),
+                                           "folded": set(), "pending": 0}
 
 
 def is_continuous_subsequence(subseq, seq):
@@ -515,15 +841,29 @@ async def update_nodes_pagerank_nhop_neighbour(tenant_id, kb_id, graph, n_hop):
             nbrs.append(n)
         return nbrs
 
-    pr = nx.pagerank(graph)
+    # Ranks are compared with the ones last written to the entities, kept in Redis: the graph only
+    # carries the ranks of its last snapshot. Without them every rank is written again.
+    written = await trio.to_thread.run_sync(lambda: REDIS_CONN.hgetall(graph_pagerank_key(kb_id))) or {}
+    written = {n: float(p) for n, p in written.items()}
+    # warm start from the ranks of the last run, only new nodes start from the uniform rank
+    prev = {n: attr["pagerank"] for n, attr in graph.nodes(data=True) if "pagerank" in attr}
+    prev.update((n, p) for n, p in written.items() if graph.has_node(n))
+    nstart = {n: prev.get(n, 1. / max(graph.number_of_nodes(), 1)) for n in graph.nodes()} if prev else None
+    pr = nx.pagerank(graph, nstart=nstart)
+    changed = {}
+    for n, p in pr.items():
+        graph.nodes[n]["pagerank"] = p
+        if n in written and abs(p - written[n]) <= PAGERANK_WRITE_TOLERANCE * written[n]:
+            continue
+        changed[n] = p
+
+    def write_pageranks():
+        done = set_entities_pagerank(tenant_id, kb_id, changed)
+        REDIS_CONN.hset_many(graph_pagerank_key(kb_id), done, GRAPH_VERSION_TTL)
+        REDIS_CONN.hdel_many(graph_pagerank_key(kb_id), [n for n in written if n not in pr])
+
     try:
-        async with trio.open_nursery() as nursery:
-            for n, p in pr.items():
-                graph.nodes[n]["pagerank"] = p
-                nursery.start_soon(lambda: trio.to_thread.run_sync(lambda: settings.docStoreConn.update({"entity_kwd": n, "kb_id": kb_id},
-                                                {"rank_flt": p,
-                                                "n_hop_with_weight": json.dumps((n), ensure_ascii=False)},
-                                                search.index_name(tenant_id), kb_id)))
+        await trio.to_thread.run_sync(write_pageranks)
     except Exception as e:
         logging.exception(e)
 
@@ -540,9 +880,11 @@ async def update_nodes_pagerank_nhop_neighbour(tenant_id, kb_id, graph, n_hop):
         "knowledge_graph_kwd": "ty2ents",
         "available_int": 0
     }
-    res = await trio.to_thread.run_sync(lambda: settings.retrievaler.search({"knowledge_graph_kwd": "ty2ents", "size": 1, "fields": []},
+    res = await trio.to_thread.run_sync(lambda: settings.retrievaler.search({"knowledge_graph_kwd": "ty2ents", "size": 1, "fields": ["content_with_weight"]},
                                       search.index_name(tenant_id), [kb_id]))
     if res.ids:
+        if res.field[res.ids[0]].get("content_with_weight") == chunk["content_with_weight"]:
+            return
         await trio.to_thread.run_sync(lambda: settings.docStoreConn.update({"knowledge_graph_kwd": "ty2ents"},
                                      chunk,
                                      search.index_name(tenant_id), kb_id))
@@ -550,6 +892,32 @@ async def update_nodes_pagerank_nhop_neighbour(tenant_id, kb_id, graph, n_hop):
         await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert([{"id": chunk_id(chunk), **chunk}], search.index_name(tenant_id), kb_id))
 
 
+def set_entities_pagerank(tenant_id, kb_id, pageranks: dict) -> dict:
+    """
+    Write the pagerank of entities, looking up their chunk ids and updating them by id in bulk.
+    Returns the ranks of the entities actually written.
+    """
+    names = list(pageranks.keys())
+    done = {}
+    bs = 512
+    for i in range(0, len(names), bs):
+        flds = ["entity_kwd"]
+        res = settings.docStoreConn.search(flds, [], {"kb_id": kb_id, "knowledge_graph_kwd": ["entity"], "entity_kwd": names[i:i + bs]},
+                                           [], OrderByExpr(), 0, 4 * bs, search.index_name(tenant_id), [kb_id])
+        updates, found = {}, {}
+        for id, d in settings.docStoreConn.getFields(res, flds).items():
+            n = d.get("entity_kwd")
+            if isinstance(n, list):
+                n = n[0] if n else None
+            if n not in pageranks:
+                continue
+            updates[id] = {"rank_flt": pageranks[n], "n_hop_with_weight": json.dumps(n, ensure_ascii=False)}
+            found[n] = pageranks[n]
+        if updates and settings.docStoreConn.bulkUpdate(updates, search.index_name(tenant_id), kb_id):
+            done.update(found)
+    return done
+
+
 async def get_entity_type2sampels(idxnms, kb_ids: list):
     es_res = await trio.to_thread.run_sync(lambda: settings.retrievaler.search({"knowledge_graph_kwd": "ty2ents", "kb_id": kb_ids,
                                        "size": 10000,
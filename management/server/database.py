@@ -79,6 +79,9 @@ REDIS_CONFIG = {
     "decode_responses": False,
 }
 
+# RAGFlow 服务使用的 Redis 库（service_conf.yaml 中的 redis.db），用于通知其缓存失效
+RAGFLOW_REDIS_DB = int(os.getenv("RAGFLOW_REDIS_DB", "1"))
+
 
 def get_db_connection():
     """创建MySQL数据库连接"""
@@ -135,6 +138,17 @@ def get_redis_connection():
         raise e
 
 
+def get_ragflow_redis_connection():
+    """创建到 RAGFlow 所用 Redis 库的连接"""
+    try:
+        r = redis.Redis(**dict(REDIS_CONFIG, db=RAGFLOW_REDIS_DB))
+        r.ping()
+        return r
+    except Exception as e:
+        print(f"Redis连接失败: {str(e)}")
+        raise e
+
+
 def test_connections():
     """测试数据库和MinIO连接"""
     try:
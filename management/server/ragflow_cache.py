@@ -0,0 +1,42 @@
+"""
+通知 RAGFlow 服务其缓存失效。
+
+管理端直接读写 MySQL 与 Elasticsearch，不经过 RAGFlow 的 docStoreConn 与服务层，
+因此写入后需要像 RAGFlow 一样更新 Redis 中的版本号，各 RAGFlow 进程据此丢弃缓存。
+键名与 rag/utils/retrieval_cache.py、api/db/services/llm_service.py 保持一致。
+"""
+
+import logging
+import os
+import time
+
+from database import get_ragflow_redis_connection
+
+KB_VERSION_PREFIX = "rag_flow_kb_chunks_version"
+KB_VERSION_TTL = 30 * 24 * 3600
+TENANT_LLM_VERSION = "rag_flow_tenant_llm_version"
+# 与 RAGFlow 的 MODEL_CACHE_TTL 一致，版本号只需比缓存的模型活得久
+MODEL_CACHE_TTL = int(os.environ.get("MODEL_CACHE_TTL", "300"))
+
+
+def bump_kb_version(index_name, kb_id=None):
+    """标记索引（以及知识库 kb_id）中的文本块已变更，使 RAGFlow 的检索缓存失效"""
+    version = str(int(time.time() * 1e6))
+    keys = [f"{KB_VERSION_PREFIX}:{index_name}"] + ([f"{KB_VERSION_PREFIX}:{kb_id}"] if kb_id else [])
+    try:
+        pipe = get_ragflow_redis_connection().pipeline(transaction=False)
+        for key in keys:
+            pipe.set(key, version, ex=KB_VERSION_TTL)
+        pipe.execute()
+    except Exception:
+        # 失败时 RAGFlow 最多在 RETRIEVAL_CACHE_TTL 内返回旧的检索结果
+        logging.exception(f"更新知识库 {kb_id} 的缓存版本失败")
+
+
+def bump_tenant_llm_version(tenant_id):
+    """标记租户的模型配置已变更，使 RAGFlow 进程缓存的模型实例失效"""
+    try:
+        get_ragflow_redis_connection().set(f"{TENANT_LLM_VERSION}:{tenant_id}", str(time.time_ns()), ex=MODEL_CACHE_TTL * 2)
+    except Exception:
+        # 失败时 RAGFlow 最多在 MODEL_CACHE_TTL 内继续使用旧模型
+        logging.exception(f"更新租户 {tenant_id} 的模型缓存版本失败")
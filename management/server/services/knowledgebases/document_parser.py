@@ -17,18 +17,48 @@ from magic_pdf.data.data_reader_writer import FileBasedDataReader, FileBasedData
 from magic_pdf.data.dataset import PymuDocDataset
 from magic_pdf.data.read_api import read_local_images, read_local_office
 from magic_pdf.model.doc_analyze_by_custom_model import doc_analyze
+from ragflow_cache import bump_kb_version
 
 from . import logger
 from .excel_parser import parse_excel_file
-from .rag_tokenizer import RagTokenizer
+from .rag_tokenizer import tokenize, tokenize_batch
 from .utils import _create_task_record, _update_document_progress, _update_kb_chunk_count, generate_uuid, get_bbox_from_block
 
-tknzr = RagTokenizer()
 
-
-def tokenize_text(text):
-    """使用分词器对文本进行分词"""
-    return tknzr.tokenize(text)
+def _chunk_text(chunk_data):
+    """提取文本/表格/公式块的内容，无有效内容时返回 None"""
+    if chunk_data["type"] == "text":
+        content = chunk_data["text"]
+        if not content or not content.strip():
+            return None
+        # 过滤 markdown 特殊符号
+        return re.sub(r"[!#\\$/]", "", content)
+    elif chunk_data["type"] == "equation":
+        content = chunk_data["text"]
+        if not content or not content.strip():
+            return None
+        return content
+    elif chunk_data["type"] == "table":
+        caption_list = chunk_data.get("table_caption", [])  # 获取列表，默认为空列表
+        table_body = chunk_data.get("table_body", "")  # 获取表格主体，默认为空字符串
+
+        # 如果表格主体为空，说明无实际内容，跳过该表格块
+        if not table_body.strip():
+            return None
+
+        # 检查 caption_list 是否为列表，并且包含字符串元素
+        if isinstance(caption_list, list) and all(isinstance(item, str) for item in caption_list):
+            # 使用空格将列表中的所有字符串拼接起来
+            caption_str = " ".join(caption_list)
+        elif isinstance(caption_list, str):
+            # 如果 caption 本身就是字符串，直接使用
+            caption_str = caption_list
+        else:
+            # 其他情况（如空列表、None 或非字符串列表），使用空字符串
+            caption_str = ""
+        # 将处理后的标题字符串和表格主体拼接
+        return caption_str + table_body
+    return None
 
 
 def perform_parse(doc_id, doc_info, file_info, embedding_config, kb_info):
@@ -49,6 +79,7 @@ def perform_parse(doc_id, doc_info, file_info, embedding_config, kb_info):
     start_time = time.time()
     middle_json_content = None  # 初始化 middle_json_content
     image_info_list = []  # 图片信息列表
+    es_index_written = None  # 已写入文本块的 ES 索引，解析失败时同样需要使检索缓存失效
 
     # 默认值处理
     embedding_model_name = embedding_config.get("llm_name") if embedding_config and embedding_config.get("llm_name") else "bge-m3"  # 默认模型
@@ -289,6 +320,12 @@ def perform_parse(doc_id, doc_info, file_info, embedding_config, kb_info):
         chunk_count = 0
         chunk_ids_list = []
 
+        # 先批量分词（多进程并行），循环中直接取结果
+        chunk_texts = [_chunk_text(chunk_data) for chunk_data in content_list]
+        contents = [t for t in chunk_texts if t is not None]
+        content_tks = dict(zip(contents, tokenize_batch(contents)))
+        title_tks = tokenize(doc_info["name"])
+
         for chunk_idx, chunk_data in enumerate(content_list):
             page_idx = 0  # 默认页面索引
             bbox = [0, 0, 0, 0]  # 默认 bbox
@@ -309,36 +346,9 @@ def perform_parse(doc_id, doc_info, file_info, embedding_config, kb_info):
                     logger.warning(f"[Parser-WARNING] block_info_list 的长度 ({len(block_info_list)}) 小于 content_list 的长度 ({len(content_list)})。后续块将使用默认 page_idx 和 bbox。")
 
             if chunk_data["type"] == "text" or chunk_data["type"] == "table" or chunk_data["type"] == "equation":
-                if chunk_data["type"] == "text":
-                    content = chunk_data["text"]
-                    if not content or not content.strip():
-                        continue
-                    # 过滤 markdown 特殊符号
-                    content = re.sub(r"[!#\\$/]", "", content)
-                elif chunk_data["type"] == "equation":
-                    content = chunk_data["text"]
-                    if not content or not content.strip():
-                        continue
-                elif chunk_data["type"] == "table":
-                    caption_list = chunk_data.get("table_caption", [])  # 获取列表，默认为空列表
-                    table_body = chunk_data.get("table_body", "")  # 获取表格主体，默认为空字符串
-
-                    # 如果表格主体为空，说明无实际内容，跳过该表格块
-                    if not table_body.strip():
-                        continue
-
-                    # 检查 caption_list 是否为列表，并且包含字符串元素
-                    if isinstance(caption_list, list) and all(isinstance(item, str) for item in caption_list):
-                        # 使用空格将列表中的所有字符串拼接起来
-                        caption_str = " ".join(caption_list)
-                    elif isinstance(caption_list, str):
-                        # 如果 caption 本身就是字符串，直接使用
-                        caption_str = caption_list
-                    else:
-                        # 其他情况（如空列表、None 或非字符串列表），使用空字符串
-                        caption_str = ""
-                    # 将处理后的标题字符串和表格主体拼接
-                    content = caption_str + table_body
+                content = chunk_texts[chunk_idx]
+                if content is None:
+                    continue
 
                 q_1024_vec = []  # 初始化为空列表
                 # 获取embedding向量
@@ -411,11 +421,11 @@ def perform_parse(doc_id, doc_info, file_info, embedding_config, kb_info):
                         "doc_id": doc_id,
                         "kb_id": kb_id,
                         "docnm_kwd": doc_info["name"],
-                        "title_tks": tokenize_text(doc_info["name"]),
-                        "title_sm_tks": tokenize_text(doc_info["name"]),
+                        "title_tks": title_tks,
+                        "title_sm_tks": title_tks,
                         "content_with_weight": content,
-                        "content_ltks": tokenize_text(content),
-                        "content_sm_ltks": tokenize_text(content),
+                        "content_ltks": content_tks[content],
+                        "content_sm_ltks": content_tks[content],
                         "page_num_int": [page_idx + 1],
                         "position_int": [[page_idx + 1] + bbox_reordered],  # 格式: [[page, x1, x2, y1, y2]]
                         "top_int": [1],
@@ -427,6 +437,7 @@ def perform_parse(doc_id, doc_info, file_info, embedding_config, kb_info):
 
                     # 存储到Elasticsearch
                     es_client.index(index=index_name, id=chunk_id, document=es_doc)  # 使用 document 参数
+                    es_index_written = index_name
 
                     chunk_count += 1
                     chunk_ids_list.append(chunk_id)
@@ -515,6 +526,10 @@ def perform_parse(doc_id, doc_info, file_info, embedding_config, kb_info):
                 raise Exception(f"[Parser-ERROR] 更新文本块图片关联失败: {e}")
 
 
+        # 管理端直接写入 ES，通知 RAGFlow 丢弃该知识库的检索缓存
+        if es_index_written:
+            bump_kb_version(es_index_written, kb_id)
+
         # 5. 更新最终状态
         process_duration = time.time() - start_time
         _update_document_progress(doc_id, progress=1.0, message="解析完成", status="1", run="3", chunk_count=chunk_count, process_duration=process_duration)
@@ -531,6 +546,8 @@ def perform_parse(doc_id, doc_info, file_info, embedding_config, kb_info):
         # error_message = f"解析失败: {str(e)}"
         logger.error(f"[Parser-ERROR] 文档 {doc_id} 解析失败: {e}")
         error_message = f"解析失败: {e}"
+        if es_index_written:
+            bump_kb_version(es_index_written, doc_info["kb_id"])
         # 更新文档状态为失败
         _update_document_progress(doc_id, status="1", run="0", message=error_message, process_duration=process_duration)  # status=1表示完成，run=0表示失败
         return {"success": False, "error": error_message}
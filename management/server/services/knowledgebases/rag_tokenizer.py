@@ -2,14 +2,26 @@ import copy
 import logging
 import math
 import os
+import pickle
 import re
 import string
+import subprocess
+import sys
+import threading
 
 import datrie
 from hanziconv import HanziConv
 from nltk import word_tokenize
 from nltk.stem import PorterStemmer, WordNetLemmatizer
 
+# 批量分词时，不少于 TOKENIZER_BATCH_MIN 条文本才会分发到 TOKENIZER_WORKERS 个进程
+TOKENIZER_WORKERS = int(os.environ.get("TOKENIZER_WORKERS", str(min(4, os.cpu_count() or 1))))
+TOKENIZER_BATCH_MIN = int(os.environ.get("TOKENIZER_BATCH_MIN", "32"))
+_pool = None
+_pool_lock = threading.Lock()
+# 服务根目录（management/server），工作进程从这里导入 services.knowledgebases.tokenizer_worker
+_SERVER_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 
 class RagTokenizer:
     def key_(self, line):
@@ -388,6 +400,78 @@ class RagTokenizer:
         return self.merge_(res_str)  # 返回经过合并处理的最终分词结果
 
 
+    def tokenize_batch(self, texts):
+        """
+        批量分词，文本较多时分发到常驻进程池并行处理。
+        进程池不可用或正被其他批次占用时，在当前进程逐条分词。
+        """
+        texts = list(texts)
+        if TOKENIZER_WORKERS <= 1 or len(texts) < TOKENIZER_BATCH_MIN:
+            return [self.tokenize(t) for t in texts]
+        try:
+            res = _get_pool().map(texts)
+            if res is not None:
+                return res
+        except Exception:
+            logging.exception("[HUQIE]:分词进程池异常，改为在当前进程分词")
+            _shutdown_pool()
+        return [self.tokenize(t) for t in texts]
+
+
+class _TokenizerPool:
+    """
+    以 python -m services.knowledgebases.tokenizer_worker 启动的分词进程。
+    不经过 multiprocessing，工作进程不会重新导入主程序（app.py），只加载分词器；
+    请求与结果通过工作进程的 stdin/stdout 以 pickle 传递。
+    """
+
+    def __init__(self, workers):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in (_SERVER_DIR, os.environ.get("PYTHONPATH")) if p))
+        self.procs = [
+            subprocess.Popen([sys.executable, "-m", "services.knowledgebases.tokenizer_worker"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+            for _ in range(workers)
+        ]
+        self.lock = threading.Lock()
+
+    def map(self, texts):
+        """进程池正被其他线程使用时返回 None"""
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            size = math.ceil(len(texts) / len(self.procs))
+            parts = [texts[i : i + size] for i in range(0, len(texts), size)]
+            for proc, part in zip(self.procs, parts):
+                pickle.dump(part, proc.stdin, pickle.HIGHEST_PROTOCOL)
+                proc.stdin.flush()
+            res = []
+            for proc, _ in zip(self.procs, parts):
+                res.extend(pickle.load(proc.stdout))
+            return res
+        finally:
+            self.lock.release()
+
+    def close(self):
+        for proc in self.procs:
+            proc.kill()
+            proc.wait()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _TokenizerPool(TOKENIZER_WORKERS)
+        return _pool
+
+
+def _shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
 def is_chinese(s):
     if s >= "\u4e00" and s <= "\u9fa5":
         return True
@@ -395,6 +479,11 @@ def is_chinese(s):
         return False
 
 
+tokenizer = RagTokenizer()
+tokenize = tokenizer.tokenize
+tokenize_batch = tokenizer.tokenize_batch
+
+
 if __name__ == "__main__":
     tknzr = RagTokenizer()
     tks = tknzr.tokenize("基于动态视觉相机的光流估计研究_孙文义.pdf")
@@ -7,6 +7,7 @@ from datetime import datetime
 import mysql.connector
 import requests
 from database import DB_CONFIG, get_es_client
+from ragflow_cache import bump_kb_version
 from utils import generate_uuid
 
 # 解析相关模块
@@ -773,6 +774,7 @@ class KnowledgebaseService:
                             ignore_unavailable=True,  # 如果索引在此期间被删除
                         )
                         deleted_count = resp.get("deleted", 0)
+                        bump_kb_version(es_index_name, kb_id)
                         print(f"[ES-SUCCESS] 从索引 {es_index_name} 中删除 {deleted_count} 个与 doc_id {doc_id} 相关的块。")
                     else:
                         print(f"[ES-INFO] 索引 {es_index_name} 不存在，跳过 ES 清理 for doc_id {doc_id}。")
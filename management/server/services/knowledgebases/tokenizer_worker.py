@@ -0,0 +1,30 @@
+"""
+分词进程池（rag_tokenizer._TokenizerPool）的工作进程。
+
+从 stdin 读取 pickle 序列化的文本列表，分词后将结果写回 stdout，直到 stdin 关闭。
+
+    python -m services.knowledgebases.tokenizer_worker
+"""
+
+import os
+import pickle
+import sys
+
+
+def main():
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    # 分词器的打印输出改到 stderr，stdout 只传递结果
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    from services.knowledgebases.rag_tokenizer import tokenizer
+
+    while True:
+        try:
+            texts = pickle.load(sys.stdin.buffer)
+        except EOFError:
+            return
+        pickle.dump([tokenizer.tokenize(t) for t in texts], out, pickle.HIGHEST_PROTOCOL)
+        out.flush()
+
+
+if __name__ == "__main__":
+    main()
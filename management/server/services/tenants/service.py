@@ -1,6 +1,7 @@
 import mysql.connector
 from datetime import datetime
 from database import DB_CONFIG
+from ragflow_cache import bump_tenant_llm_version
 
 def get_tenants_with_pagination(current_page, page_size, username=''):
     """查询租户信息，支持分页和条件筛选"""
@@ -114,6 +115,9 @@ def update_tenant(tenant_id, tenant_data):
         cursor.close()
         conn.close()
         
+        # llm_id/embd_id 已变更，通知 RAGFlow 丢弃该租户缓存的模型
+        bump_tenant_llm_version(tenant_id)
+        
         return affected_rows > 0
         
     except mysql.connector.Error as err:
@@ -255,8 +255,19 @@ def tokenize(d, t, eng):
     d["content_sm_ltks"] = rag_tokenizer.fine_grained_tokenize(d["content_ltks"])
 
 
+def tokenize_batch(docs, texts, eng):
+    """Same as calling tokenize(d, t, eng) for each pair, but tokenizes the texts as one batch."""
+    ltks = rag_tokenizer.tokenize_batch([re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", t) for t in texts])
+    sm_ltks = rag_tokenizer.fine_grained_tokenize_batch(ltks)
+    for d, t, lt, smt in zip(docs, texts, ltks, sm_ltks):
+        d["content_with_weight"] = t
+        d["content_ltks"] = lt
+        d["content_sm_ltks"] = smt
+
+
 def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
     res = []
+    texts = []
     # wrap up as es documents
     for ck in chunks:
         if len(ck.strip()) == 0:
@@ -270,13 +281,15 @@ def tokenize_chunks(chunks, doc, eng, pdf_parser=None):
                 ck = pdf_parser.remove_tag(ck)
             except NotImplementedError:
                 pass
-        tokenize(d, ck, eng)
         res.append(d)
+        texts.append(ck)
+    tokenize_batch(res, texts, eng)
     return res
 
 
 def tokenize_chunks_docx(chunks, doc, eng, images):
     res = []
+    texts = []
     # wrap up as es documents
     for ck, image in zip(chunks, images):
         if len(ck.strip()) == 0:
@@ -284,35 +297,37 @@ def tokenize_chunks_docx(chunks, doc, eng, images):
         logging.debug("-- {}".format(ck))
         d = copy.deepcopy(doc)
         d["image"] = image
-        tokenize(d, ck, eng)
         res.append(d)
+        texts.append(ck)
+    tokenize_batch(res, texts, eng)
     return res
 
 
 def tokenize_table(tbls, doc, eng, batch_size=10):
     res = []
+    texts = []
     # add tables
     for (img, rows), poss in tbls:
         if not rows:
             continue
         if isinstance(rows, str):
             d = copy.deepcopy(doc)
-            tokenize(d, rows, eng)
-            d["content_with_weight"] = rows
             if img:
                 d["image"] = img
             if poss:
                 add_positions(d, poss)
             res.append(d)
+            texts.append(rows)
             continue
         de = "; " if eng else "； "
         for i in range(0, len(rows), batch_size):
             d = copy.deepcopy(doc)
             r = de.join(rows[i:i + batch_size])
-            tokenize(d, r, eng)
             d["image"] = img
             add_positions(d, poss)
             res.append(d)
+            texts.append(r)
+    tokenize_batch(res, texts, eng)
     return res
 
 
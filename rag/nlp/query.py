@@ -16,16 +16,36 @@
 
 import logging
 import json
+import os
 import re
+import threading
+import numpy as np
+from cachetools import TTLCache
+from scipy.sparse import csr_matrix
 from rag.utils.doc_store_conn import MatchTextExpr
 
 from rag.nlp import rag_tokenizer, term_weight, synonym
+from rag.utils.redis_conn import REDIS_CONN
+
+# Parsed questions are shared by search, its min_match retry and reranking, and across requests.
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "4096"))
+QUERY_CACHE_TTL = int(os.environ.get("QUERY_CACHE_TTL", "600"))
+
+
+def cosine_similarity(avec, bvecs):
+    """Cosine similarity of `avec` to every row of `bvecs`, computed in float32; zero vectors score 0."""
+    a = np.asarray(avec, dtype=np.float32)
+    b = np.asarray(bvecs, dtype=np.float32).reshape(-1, a.shape[-1])
+    dots = b @ a
+    norms = np.linalg.norm(b, axis=1) * np.linalg.norm(a)
+    sims = np.divide(dots, norms, out=np.zeros_like(dots), where=norms > 0)
+    return sims.astype(np.float64)
 
 
 class FulltextQueryer:
     def __init__(self):
         self.tw = term_weight.Dealer()
-        self.syn = synonym.Dealer()
+        self.syn = synonym.Dealer(REDIS_CONN)
         self.query_fields = [
             "title_tks^10",
             "title_sm_tks^5",
@@ -35,6 +55,8 @@ class FulltextQueryer:
             "content_ltks^2",
             "content_sm_ltks",
         ]
+        self.analyzed = TTLCache(maxsize=max(QUERY_CACHE_SIZE, 1), ttl=QUERY_CACHE_TTL)
+        self.analyzed_lock = threading.Lock()
 
     @staticmethod
     def subSpecialChar(line):
@@ -124,6 +146,32 @@ class FulltextQueryer:
             " ",
             rag_tokenizer.tradi2simp(rag_tokenizer.strQ2B(txt.lower())),
         ).strip()
+
+        # 解析结果按规范化后的文本缓存，只有 minimum_should_match 随调用变化；同义词词典热更新后缓存随之失效
+        key = (self.syn.dictionary_hash, txt)
+        with self.analyzed_lock:
+            analyzed = self.analyzed.get(key)
+        if analyzed is None:
+            analyzed = self.analyze_(txt)
+            with self.analyzed_lock:
+                self.analyzed[key] = analyzed
+        query, keywords, with_min_match = analyzed
+        keywords = list(keywords)
+        if query is None:
+            return None, keywords
+        if not with_min_match:
+            return MatchTextExpr(self.query_fields, query, 100), keywords
+        return MatchTextExpr(self.query_fields, query, 100, {"minimum_should_match": min_match}), keywords
+
+    def analyze_(self, txt):
+        """
+        分词、计算权重并查找同义词，把规范化后的问题解析为查询字符串。
+
+        返回:
+        - query (str | None): 查询字符串，无查询条件时为 None。
+        - keywords (tuple): 提取的关键词。
+        - with_min_match (bool): 查询是否使用 minimum_should_match。
+        """
         otxt = txt
         txt = FulltextQueryer.rmWWW(txt)
 
@@ -161,7 +209,7 @@ class FulltextQueryer:
             if not q:
                 q.append(txt)
             query = " ".join(q)
-            return MatchTextExpr(self.query_fields, query, 100), keywords
+            return query, tuple(keywords), False
 
         def need_fine_grained_tokenize(tk):
             """
@@ -274,35 +322,50 @@ class FulltextQueryer:
             # 如果查询条件为空，使用原始文本
             if not query:
                 query = otxt
-            # 返回匹配文本表达式和关键词
-            return MatchTextExpr(self.query_fields, query, 100, {"minimum_should_match": min_match}), keywords
+            # 返回查询字符串和关键词
+            return query, tuple(keywords), True
         # 如果没有生成查询条件，只返回关键词
-        return None, keywords
+        return None, tuple(keywords), True
 
     def hybrid_similarity(self, avec, bvecs, atks, btkss, tkweight=0.3, vtweight=0.7):
-        from sklearn.metrics.pairwise import cosine_similarity as CosineSimilarity
-        import numpy as np
-
-        sims = CosineSimilarity([avec], bvecs)
+        sims = cosine_similarity(avec, bvecs)
         tksim = self.token_similarity(atks, btkss)
-        if np.sum(sims[0]) == 0:
-            return np.array(tksim), tksim, sims[0]
-        return np.array(sims[0]) * vtweight + np.array(tksim) * tkweight, tksim, sims[0]
+        if np.sum(sims) == 0:
+            return np.array(tksim), tksim, sims
+        return sims * vtweight + np.array(tksim) * tkweight, tksim, sims
+
+    def term_weights(self, tks):
+        if isinstance(tks, str):
+            tks = tks.split()
+        d = {}
+        for t, c in self.tw.weights(tks, preprocess=False):
+            if t not in d:
+                d[t] = 0
+            d[t] += c
+        return d
 
     def token_similarity(self, atks, btkss):
-        def toDict(tks):
-            d = {}
+        """
+        Score every candidate token bag of `btkss` against the query tokens `atks` at once.
+
+        Like `similarity`, a candidate scores the share of query term weight it contains,
+        so only which query terms occur in a candidate matters, never the candidate's own
+        weights. The candidates become a sparse term-incidence matrix over the query terms
+        and are scored with a single product against the query weight vector.
+        """
+        qtwt = self.term_weights(atks)
+        if not qtwt:
+            return [1.0] * len(btkss)
+        col = {t: i for i, t in enumerate(qtwt.keys())}
+        qvec = np.array(list(qtwt.values()), dtype=np.float64)
+        indptr, indices = [0], []
+        for tks in btkss:
             if isinstance(tks, str):
                 tks = tks.split()
-            for t, c in self.tw.weights(tks, preprocess=False):
-                if t not in d:
-                    d[t] = 0
-                d[t] += c
-            return d
-
-        atks = toDict(atks)
-        btkss = [toDict(tks) for tks in btkss]
-        return [self.similarity(atks, btks) for btks in btkss]
+            indices.extend([col[t] for t in set(tks) if t in col])
+            indptr.append(len(indices))
+        incidence = csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(btkss), len(col)))
+        return ((incidence @ qvec + 1e-9) / (np.sum(qvec) + 1e-9)).tolist()
 
     def similarity(self, qtwt, dtwt):
         if isinstance(dtwt, type("")):
@@ -19,9 +19,12 @@ import copy
 import datrie
 import math
 import os
+import pickle
 import re
 import string
+import subprocess
 import sys
+import threading
 from pathlib import Path
 from hanziconv import HanziConv
 from nltk import word_tokenize
@@ -30,6 +33,12 @@ from nltk.stem import PorterStemmer, WordNetLemmatizer
 sys.path.append(str(Path(__file__).parent.parent.parent))
 from api.utils.file_utils import get_project_base_directory
 
+# Batches at least TOKENIZER_BATCH_MIN long are spread over a pool of TOKENIZER_WORKERS processes.
+TOKENIZER_WORKERS = int(os.environ.get("TOKENIZER_WORKERS", str(min(4, os.cpu_count() or 1))))
+TOKENIZER_BATCH_MIN = int(os.environ.get("TOKENIZER_BATCH_MIN", "32"))
+TOKENIZER_POOL = None
+TOKENIZER_POOL_LOCK = threading.Lock()
+
 
 class RagTokenizer:
     def key_(self, line):
@@ -40,6 +49,7 @@ class RagTokenizer:
 
     def loadDict_(self, fnm):
         logging.info(f"[HUQIE]:Build trie from {fnm}")
+        self.trie_file_ = None
         try:
             of = open(fnm, "r", encoding="utf-8")
             while True:
@@ -57,6 +67,7 @@ class RagTokenizer:
             dict_file_cache = fnm + ".trie"
             logging.info(f"[HUQIE]:Build trie cache to {dict_file_cache}")
             self.trie_.save(dict_file_cache)
+            self.trie_file_ = dict_file_cache
             of.close()
         except Exception:
             logging.exception(f"[HUQIE]:Build trie {fnm} failed")
@@ -69,6 +80,12 @@ class RagTokenizer:
         self.stemmer = PorterStemmer()
         self.lemmatizer = WordNetLemmatizer()
 
+        # "compat" reproduces the exhaustive dfs_ ranking exactly, "viterbi" is the faster approximation
+        self.SEGMENTER = os.environ.get("TOKENIZER_SEGMENTER", "compat")
+
+        # .trie file holding the current dictionary, which pool workers load instead of pickling the trie
+        self.trie_file_ = None
+
         self.SPLIT_CHAR = r"([ ,\.<>/?;:'\[\]\\`!@#$%^&*\(\)\{\}\|_+=《》，。？、；‘’：“”【】~！￥%……（）——-]+|[a-zA-Z0-9,\.-]+)"
 
         trie_file_name = self.DIR_ + ".txt.trie"
@@ -77,6 +94,7 @@ class RagTokenizer:
             try:
                 # load trie from file
                 self.trie_ = datrie.Trie.load(trie_file_name)
+                self.trie_file_ = trie_file_name
                 return
             except Exception:
                 # fail to load trie from file, build default trie
@@ -93,6 +111,7 @@ class RagTokenizer:
     def loadUserDict(self, fnm):
         try:
             self.trie_ = datrie.Trie.load(fnm + ".trie")
+            self.trie_file_ = fnm + ".trie"
             return
         except Exception:
             self.trie_ = datrie.Trie(string.printable)
@@ -165,6 +184,88 @@ class RagTokenizer:
 
         return self.dfs_(chars, s + 1, preTks, tkslist)
 
+    def lattice_edges_(self, chars, s, after_singles, cache):
+        """
+        Tokens dfs_ may take at position `s` as (end, log-frequency) pairs, in dfs_'s order.
+        `after_singles` tells whether the previous three tokens were single characters.
+        """
+        ck = (s, after_singles)
+        if ck in cache:
+            return cache[ck]
+        S = s + 1
+        if after_singles and self.trie_.has_keys_with_prefix(self.key_(chars[s - 1 : s + 1])):
+            S = s + 2
+        edges = []
+        for e in range(S, len(chars) + 1):
+            k = self.key_(chars[s:e])
+            if e > s + 1 and not self.trie_.has_keys_with_prefix(k):
+                break
+            if k in self.trie_:
+                edges.append((e, self.trie_[k][0]))
+        if not edges:
+            k = self.key_(chars[s : s + 1])
+            edges.append((s + 1, self.trie_[k][0] if k in self.trie_ else -12))
+        cache[ck] = edges
+        return edges
+
+    def segment_(self, chars, topn=1):
+        """
+        Rank the segmentations of `chars` by dynamic programming over the lattice of tokens
+        dfs_ would try, without enumerating or copying every path.
+
+        In "compat" mode (the default) the result is identical to sortTks_ over dfs_: the DP
+        state tracks token count and long-token count since score_ is not additive, and ties
+        are broken in dfs_'s enumeration order. That is O(n^2) states per position, so roughly
+        O(n^3*maxwordlen) overall: still polynomial where dfs_ is exponential, but slow on long
+        runs without punctuation. "viterbi" mode keeps one state per position and ranks by total
+        log-frequency, then fewer and longer tokens, in O(n*maxwordlen).
+
+        Returns at most `topn` (tokens, score) pairs, best first.
+        """
+        N = len(chars)
+        if N == 0:
+            return [([], 0)]
+        compat = self.SEGMENTER != "viterbi"
+        cache = {}
+        # states[s]: {(trailing single tokens, [token count, long token count]): [(F, ends), ...]}
+        states = [{} for _ in range(N + 1)]
+        states[0][(0, 0, 0)] = [(0, ())] if compat else [(0, (), 0)]
+        for s in range(N):
+            for (c, n, lg), cands in states[s].items():
+                if compat:
+                    cands = sorted(cands, key=lambda x: (-x[0], x[1]))[:topn]
+                else:
+                    cands = sorted(cands, key=lambda x: (-x[0], len(x[1]), -x[2], x[1]))[:topn]
+                for e, f in self.lattice_edges_(chars, s, c == 3, cache):
+                    single = e == s + 1
+                    if compat:
+                        key = (min(c + 1, 3) if single else 0, n + 1, lg + (0 if single else 1))
+                        states[e].setdefault(key, []).extend([(F + f, ends + (e,)) for F, ends in cands])
+                    else:
+                        key = (min(c + 1, 3) if single else 0, 0, 0)
+                        states[e].setdefault(key, []).extend([(F + f, ends + (e,), L + (0 if single else 1)) for F, ends, L in cands])
+            states[s] = None
+
+        res = []
+        for (_, n, lg), cands in states[N].items():
+            for cand in cands:
+                F, ends = cand[0], cand[1]
+                if not compat:
+                    n, lg = len(ends), cand[2]
+                # same arithmetic as score_
+                B = 30
+                score = B / n + lg / n + F
+                tks, p = [], 0
+                for e in ends:
+                    tks.append(chars[p:e])
+                    p = e
+                if compat:
+                    res.append((-score, ends, tks, score))
+                else:
+                    res.append((-F, n, -lg, ends, tks, score))
+        res = sorted(res, key=lambda x: x[:-2])[:topn]
+        return [(r[-2], r[-1]) for r in res]
+
     def freq(self, tk):
         k = self.key_(tk)
         if k not in self.trie_:
@@ -333,9 +434,7 @@ class RagTokenizer:
                     j += 1
                     continue
                 # backward tokens from_i to i are different from forward tokens from _j to j.
-                tkslist = []
-                self.dfs_("".join(tks[_j:j]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
+                res.append(" ".join(self.segment_("".join(tks[_j:j]))[0][0]))
 
                 same = 1
                 while i + same < len(tks1) and j + same < len(tks) and tks1[i + same] == tks[j + same]:
@@ -349,9 +448,7 @@ class RagTokenizer:
             if _i < len(tks1):
                 assert _j < len(tks)
                 assert "".join(tks1[_i:]) == "".join(tks[_j:])
-                tkslist = []
-                self.dfs_("".join(tks[_j:]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
+                res.append(" ".join(self.segment_("".join(tks[_j:]))[0][0]))
 
         res = " ".join(res)
         logging.debug("[TKS] {}".format(self.merge_(res)))
@@ -393,23 +490,21 @@ class RagTokenizer:
                 res.append(tk)
                 continue
 
-            # 初始化候选分词列表
-            tkslist = []
-
             # 规则2：超长词（长度>10）直接保留不切分
             if len(tk) > 10:
-                tkslist.append(tk)
-            else:
-                # 使用DFS回溯算法寻找所有可能的分词组合
-                self.dfs_(tk, 0, [], tkslist)
+                res.append(tk)
+                continue
+
+            # 用动态规划求排名前两位的分词方案
+            tkslist = self.segment_(tk, topn=2)
 
             # 规则3：若无有效切分方案则保留原词
             if len(tkslist) < 2:
                 res.append(tk)
                 continue
 
-            # 从候选方案中选择最优切分（通过sortTks_排序）
-            stk = self.sortTks_(tkslist)[1][0]
+            # 取排名第二的切分方案（与原sortTks_排序一致）
+            stk = tkslist[1][0]
 
             # 规则4：若切分结果与原词长度相同则视为无效切分
             if len(stk) == len(tk):
@@ -431,6 +526,97 @@ class RagTokenizer:
         return " ".join(self.english_normalize_(res))
 
 
+    def tokenize_batch(self, texts):
+        return self.map_("tokenize", texts)
+
+    def fine_grained_tokenize_batch(self, tkss):
+        return self.map_("fine_grained_tokenize", tkss)
+
+    def map_(self, method, texts):
+        """
+        Apply `method` to every text, spreading large batches over the tokenizer process pool.
+        Falls back to tokenizing in this process if the pool is disabled, busy with another batch or breaks.
+        """
+        texts = list(texts)
+        if TOKENIZER_WORKERS <= 1 or len(texts) < TOKENIZER_BATCH_MIN or not self.trie_file_:
+            return [getattr(self, method)(t) for t in texts]
+        try:
+            res = tokenizer_pool().map(self.trie_file_, method, texts)
+            if res is not None:
+                return res
+        except Exception:
+            logging.exception("[HUQIE]:Tokenizer pool failed, tokenize in process")
+            shutdown_tokenizer_pool()
+        return [getattr(self, method)(t) for t in texts]
+
+
+class TokenizerPool:
+    """
+    Tokenizer processes started as `python -m rag.nlp.tokenizer_worker`.
+
+    Unlike multiprocessing workers, they do not re-import the caller's __main__ (the API server or the
+    task executor), only the tokenizer. Requests and results are pickled over the worker's stdin/stdout.
+    """
+
+    def __init__(self, workers):
+        base = get_project_base_directory()
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in (base, os.environ.get("PYTHONPATH")) if p))
+        self.procs = [
+            subprocess.Popen([sys.executable, "-m", "rag.nlp.tokenizer_worker"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+            for _ in range(workers)
+        ]
+        self.lock = threading.Lock()
+
+    def map(self, trie_file, method, texts):
+        """Returns None if another thread is using the pool."""
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            size = math.ceil(len(texts) / len(self.procs))
+            parts = [texts[i : i + size] for i in range(0, len(texts), size)]
+            for proc, part in zip(self.procs, parts):
+                pickle.dump((trie_file, method, part), proc.stdin, pickle.HIGHEST_PROTOCOL)
+                proc.stdin.flush()
+            res = []
+            for proc, _ in zip(self.procs, parts):
+                res.extend(pickle.load(proc.stdout))
+            return res
+        finally:
+            self.lock.release()
+
+    def close(self):
+        for proc in self.procs:
+            proc.kill()
+            proc.wait()
+
+
+def load_worker_trie(trie_file):
+    if trie_file and tokenizer.trie_file_ != trie_file:
+        tokenizer.trie_ = datrie.Trie.load(trie_file)
+        tokenizer.trie_file_ = trie_file
+
+
+def tokenize_part(trie_file, method, texts):
+    load_worker_trie(trie_file)
+    return [getattr(tokenizer, method)(t) for t in texts]
+
+
+def tokenizer_pool():
+    global TOKENIZER_POOL
+    with TOKENIZER_POOL_LOCK:
+        if TOKENIZER_POOL is None:
+            TOKENIZER_POOL = TokenizerPool(TOKENIZER_WORKERS)
+        return TOKENIZER_POOL
+
+
+def shutdown_tokenizer_pool():
+    global TOKENIZER_POOL
+    with TOKENIZER_POOL_LOCK:
+        if TOKENIZER_POOL is not None:
+            TOKENIZER_POOL.close()
+            TOKENIZER_POOL = None
+
+
 def is_chinese(s):
     if s >= "\u4e00" and s <= "\u9fa5":
         return True
@@ -464,6 +650,8 @@ def naiveQie(txt):
 tokenizer = RagTokenizer()
 tokenize = tokenizer.tokenize
 fine_grained_tokenize = tokenizer.fine_grained_tokenize
+tokenize_batch = tokenizer.tokenize_batch
+fine_grained_tokenize_batch = tokenizer.fine_grained_tokenize_batch
 tag = tokenizer.tag
 freq = tokenizer.freq
 loadUserDict = tokenizer.loadUserDict
@@ -23,6 +23,7 @@ from rag.utils import rmSpace
 from rag.nlp import rag_tokenizer, query
 import numpy as np
 from rag.utils.doc_store_conn import DocStoreConnection, MatchDenseExpr, FusionExpr, OrderByExpr
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE, RETRIEVAL_CACHE_ENABLED
 
 
 def index_name(uid):
@@ -262,12 +263,15 @@ class Dealer:
 
         assert len(ans_v[0]) == len(chunk_v[0]), "The dimension of query and chunk do not match: {} vs. {}".format(len(ans_v[0]), len(chunk_v[0]))
 
+        # 对话路径只有几十条短文本，在当前进程分词，不启动分词进程池
         chunks_tks = [rag_tokenizer.tokenize(self.qryr.rmWWW(ck)).split() for ck in chunks]
+        pieces_tks = [rag_tokenizer.tokenize(self.qryr.rmWWW(a)).split() for a in pieces_]
+        # 相似度与阈值无关，每个句子只计算一次，降低阈值重试时直接复用
+        sims = [self.qryr.hybrid_similarity(ans_v[i], chunk_v, pieces_tks[i], chunks_tks, tkweight, vtweight)[0] for i in range(len(pieces_))] if chunks_tks else []
         cites = {}
         thr = 0.63
         while thr > 0.3 and len(cites.keys()) == 0 and pieces_ and chunks_tks:
-            for i, a in enumerate(pieces_):
-                sim, tksim, vtsim = self.qryr.hybrid_similarity(ans_v[i], chunk_v, rag_tokenizer.tokenize(self.qryr.rmWWW(pieces_[i])).split(), chunks_tks, tkweight, vtweight)
+            for i, sim in enumerate(sims):
                 mx = np.max(sim) * 0.99
                 logging.debug("{} SIM: {}".format(pieces_[i], mx))
                 if mx < thr:
@@ -465,9 +469,38 @@ class Dealer:
         # 处理租户ID格式
         if isinstance(tenant_ids, str):
             tenant_ids = tenant_ids.split(",")
+        idx_names = [index_name(tid) for tid in tenant_ids]
+
+        # 查询检索结果缓存：命中时只按块ID取回内容，跳过向量化、混合检索和重排序；高亮结果不缓存
+        cache_key = None
+        if RETRIEVAL_CACHE_ENABLED and not highlight:
+            cache_key = RETRIEVAL_CACHE.key(
+                question,
+                {
+                    "kb_ids": sorted(kb_ids or []),
+                    "doc_ids": sorted(doc_ids or []),
+                    "idx_names": sorted(idx_names),
+                    "page": page,
+                    "page_size": page_size,
+                    "similarity_threshold": similarity_threshold,
+                    "vector_similarity_weight": vector_similarity_weight,
+                    "top": top,
+                    "aggs": aggs,
+                    "embd_mdl": getattr(embd_mdl, "llm_name", None),
+                    "rerank_mdl": getattr(rerank_mdl, "llm_name", None) if rerank_mdl else None,
+                    "rank_feature": rank_feature,
+                },
+            )
+            versions = RETRIEVAL_CACHE.versions(idx_names, kb_ids)
+            cached = RETRIEVAL_CACHE.get(cache_key, versions)
+            if cached is not None:
+                cached_ranks = self.load_cached_ranks_(cached, idx_names, kb_ids)
+                if cached_ranks is not None:
+                    return cached_ranks
+                RETRIEVAL_CACHE.invalidate(cache_key)
 
         # 执行搜索操作
-        sres = self.search(req, [index_name(tid) for tid in tenant_ids], kb_ids, embd_mdl, highlight, rank_feature=rank_feature)
+        sres = self.search(req, idx_names, kb_ids, embd_mdl, highlight, rank_feature=rank_feature)
 
         # 执行重排序操作
         if rerank_mdl and sres.total > 0:
@@ -497,23 +530,7 @@ class Dealer:
             chunk = sres.field[id]
             dnm = chunk.get("docnm_kwd", "")
             did = chunk.get("doc_id", "")
-            position_int = chunk.get("position_int", [])
-            d = {
-                "chunk_id": id,
-                "content_ltks": chunk["content_ltks"],
-                "content_with_weight": chunk["content_with_weight"],
-                "doc_id": did,
-                "docnm_kwd": dnm,
-                "kb_id": chunk["kb_id"],
-                "important_kwd": chunk.get("important_kwd", []),
-                "image_id": chunk.get("img_id", ""),
-                "similarity": sim[i],
-                "vector_similarity": vsim[i],
-                "term_similarity": tsim[i],
-                "vector": chunk.get(vector_column, zero_vector),
-                "positions": position_int,
-                "doc_type_kwd": chunk.get("doc_type_kwd", ""),
-            }
+            d = self.ranked_chunk_(id, chunk, sim[i], vsim[i], tsim[i], chunk.get(vector_column, zero_vector))
             if highlight and sres.highlight:
                 if id in sres.highlight:
                     d["highlight"] = rmSpace(sres.highlight[id])
@@ -526,6 +543,58 @@ class Dealer:
         ranks["doc_aggs"] = [{"doc_name": k, "doc_id": v["doc_id"], "count": v["count"]} for k, v in sorted(ranks["doc_aggs"].items(), key=lambda x: x[1]["count"] * -1)]
         ranks["chunks"] = ranks["chunks"][:page_size]
 
+        if cache_key:
+            RETRIEVAL_CACHE.put(
+                cache_key,
+                versions,
+                {
+                    "total": ranks["total"],
+                    "dim": dim,
+                    "chunks": [(c["chunk_id"], float(c["similarity"]), float(c["vector_similarity"]), float(c["term_similarity"])) for c in ranks["chunks"]],
+                    "doc_aggs": ranks["doc_aggs"],
+                },
+            )
+        return ranks
+
+    @staticmethod
+    def ranked_chunk_(id, chunk, similarity, vector_similarity, term_similarity, vector):
+        return {
+            "chunk_id": id,
+            "content_ltks": chunk["content_ltks"],
+            "content_with_weight": chunk["content_with_weight"],
+            "doc_id": chunk.get("doc_id", ""),
+            "docnm_kwd": chunk.get("docnm_kwd", ""),
+            "kb_id": chunk["kb_id"],
+            "important_kwd": chunk.get("important_kwd", []),
+            "image_id": chunk.get("img_id", ""),
+            "similarity": similarity,
+            "vector_similarity": vector_similarity,
+            "term_similarity": term_similarity,
+            "vector": vector,
+            "positions": chunk.get("position_int", []),
+            "doc_type_kwd": chunk.get("doc_type_kwd", ""),
+        }
+
+    def load_cached_ranks_(self, cached, idx_names, kb_ids):
+        """
+        根据缓存的块ID和分数重建检索结果，块内容按ID一次取回。
+
+        任一块已不存在时返回None，由调用方重新检索。
+        """
+        ranks = {"total": cached["total"], "chunks": [], "doc_aggs": [dict(a) for a in cached["doc_aggs"]]}
+        if not cached["chunks"]:
+            return ranks
+        vector_column = f"q_{cached['dim']}_vec"
+        fields = ["content_ltks", "content_with_weight", "doc_id", "docnm_kwd", "kb_id", "important_kwd", "img_id", "position_int", "doc_type_kwd", vector_column]
+        ids = [c[0] for c in cached["chunks"]]
+        res = self.dataStore.search(fields, [], {"id": ids}, [], OrderByExpr(), 0, len(ids), idx_names, kb_ids)
+        chunks = self.dataStore.getFields(res, fields)
+        zero_vector = [0.0] * cached["dim"]
+        for id, sim, vsim, tsim in cached["chunks"]:
+            chunk = chunks.get(id)
+            if not chunk or "content_with_weight" not in chunk:
+                return None
+            ranks["chunks"].append(self.ranked_chunk_(id, chunk, sim, vsim, tsim, chunk.get(vector_column, zero_vector)))
         return ranks
 
     def sql_retrieval(self, sql, fetch_size=128, format="json"):
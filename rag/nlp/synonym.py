@@ -17,52 +17,118 @@
 import logging
 import json
 import os
+import sys
+import threading
 import time
 import re
+import xxhash
+from cachetools import LRUCache
 from nltk.corpus import wordnet
 from api.utils.file_utils import get_project_base_directory
 
+SYNONYM_RELOAD_INTERVAL = int(os.environ.get("SYNONYM_RELOAD_INTERVAL", "3600"))
+# Words missing from the precomputed WordNet index are looked up live once and kept here.
+WORDNET_MISS_CACHE_SIZE = int(os.environ.get("WORDNET_MISS_CACHE_SIZE", "10000"))
+WORDNET_INDEX_FILE = os.path.join(get_project_base_directory(), "rag/res", "wordnet_synonyms.json")
+
+
+def wordnet_synonyms(tk):
+    res = set([re.sub("_", " ", syn.name().split(".")[0]) for syn in wordnet.synsets(tk)]) - set([tk])
+    return tuple(sorted([t for t in res if t]))
+
+
+def freeze(dictionary):
+    """Normalize a synonym dictionary to {term: tuple of synonyms} so lookups never convert values."""
+    res = {}
+    for k, v in dictionary.items():
+        if isinstance(v, str):
+            v = [v]
+        res[k] = tuple(v)
+    return res
+
+
+def build_wordnet_index(fnm=WORDNET_INDEX_FILE):
+    """
+    Precompute WordNet synonyms for every single-word WordNet lemma and every English word in the
+    tokenizer dictionary, and save them to `fnm` for Dealer to load at startup. Words without
+    synonyms are saved too, so looking them up never falls back to WordNet.
+    """
+    from rag.nlp import rag_tokenizer
+
+    vocab = set([w for w in wordnet.all_lemma_names() if re.match(r"[a-z]+$", w)])
+    vocab |= set([k for k in rag_tokenizer.tokenizer.trie_.keys() if re.match(r"[a-z]+$", k)])
+    index = {w: wordnet_synonyms(w) for w in sorted(vocab)}
+    with open(fnm, "w") as f:
+        json.dump(index, f, ensure_ascii=False, separators=(",", ":"))
+    logging.info(f"Saved WordNet synonyms of {len(index)} words, {len([1 for v in index.values() if v])} of them have some, to {fnm}")
+
 
 class Dealer:
     def __init__(self, redis=None):
-        self.lookup_num = 100000000
-        self.load_tm = time.time() - 1000000
-        self.dictionary = None
+        self.dictionary = {}
+        self.dictionary_hash = None
         path = os.path.join(get_project_base_directory(), "rag/res", "synonym.json")
         try:
-            self.dictionary = json.load(open(path, "r"))
+            self.dictionary = freeze(json.load(open(path, "r")))
         except Exception:
             logging.warning("Missing synonym.json")
-            self.dictionary = {}
 
         if not redis:
             logging.warning("Realtime synonym is disabled, since no redis connection.")
         if not len(self.dictionary.keys()):
             logging.warning("Fail to load synonym")
 
+        self.wordnet = {}
+        try:
+            self.wordnet = freeze(json.load(open(WORDNET_INDEX_FILE, "r")))
+        except Exception:
+            logging.warning(f"Missing {WORDNET_INDEX_FILE}, English synonyms are looked up in WordNet on demand")
+        self.wordnet_misses = LRUCache(maxsize=max(WORDNET_MISS_CACHE_SIZE, 1))
+        self.wordnet_lock = threading.Lock()
+
         self.redis = redis
-        self.load()
+        if self.redis:
+            self.load()
+            threading.Thread(target=self.reload_loop_, daemon=True).start()
 
     def load(self):
+        """Swap in the Redis copy of the dictionary if it changed since the last load."""
         if not self.redis:
             return
-
-        if self.lookup_num < 100:
-            return
-        tm = time.time()
-        if tm - self.load_tm < 3600:
-            return
-
-        self.load_tm = time.time()
-        self.lookup_num = 0
         d = self.redis.get("kevin_synonyms")
         if not d:
             return
+        h = xxhash.xxh64(d).hexdigest()
+        if h == self.dictionary_hash:
+            return
         try:
-            d = json.loads(d)
-            self.dictionary = d
+            dictionary = freeze(json.loads(d))
         except Exception as e:
             logging.error("Fail to load synonym!" + str(e))
+            return
+        # a single reference assignment, so concurrent lookups see either the old or the new dictionary
+        self.dictionary = dictionary
+        self.dictionary_hash = h
+
+    def reload_loop_(self):
+        while True:
+            time.sleep(SYNONYM_RELOAD_INTERVAL)
+            try:
+                self.load()
+            except Exception:
+                logging.exception("Fail to reload synonym")
+
+    def english_synonyms(self, tk):
+        res = self.wordnet.get(tk)
+        if res is not None:
+            return res
+        with self.wordnet_lock:
+            res = self.wordnet_misses.get(tk)
+        if res is None:
+            res = wordnet_synonyms(tk)
+            with self.wordnet_lock:
+                self.wordnet_misses[tk] = res
+        return res
 
     def lookup(self, tk, topn=8):
         """
@@ -76,25 +142,29 @@ class Dealer:
             list: 同义词列表，可能为空（无同义词时）
 
         处理逻辑:
-            1. 英文单词：使用WordNet语义网络查询
+            1. 英文单词：查询预计算的WordNet同义词索引
             2. 中文/其他：从预加载的自定义词典查询
         """
         # 英文单词处理分支
         if re.match(r"[a-z]+$", tk):
-            res = list(set([re.sub("_", " ", syn.name().split(".")[0]) for syn in wordnet.synsets(tk)]) - set([tk]))
-            return [t for t in res if t]
+            return list(self.english_synonyms(tk))
 
-        # 中文/其他词条处理
-        self.lookup_num += 1
-        self.load()  # 自定义词典
         # 从字典获取同义词，默认返回空列表
-        res = self.dictionary.get(re.sub(r"[ \t]+", " ", tk.lower()), [])
-        # 兼容处理：如果字典值是字符串，转为单元素列表
-        if isinstance(res, str):
-            res = [res]
-        return res[:topn]
+        return list(self.dictionary.get(re.sub(r"[ \t]+", " ", tk.lower()), ())[:topn])
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        logging.basicConfig(level=logging.INFO)
+        build_wordnet_index()
+        sys.exit(0)
+
+    import timeit
+
     dl = Dealer()
-    print(dl.dictionary)
+    words = ["happy", "computer", "run", "苹果", "数据库", "unknownword"]
+    for w in words:
+        dl.lookup(w)
+    n = 100000
+    sec = timeit.timeit(lambda: [dl.lookup(w) for w in words], number=n // len(words))
+    print(f"{len(dl.dictionary)} terms, {len(dl.wordnet)} English words, {sec / n * 1e6:.2f}us per lookup")
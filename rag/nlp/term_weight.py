@@ -14,15 +14,21 @@
 #  limitations under the License.
 #
 
+import ast
 import logging
 import math
 import json
 import re
 import os
+from functools import lru_cache
 import numpy as np
 from rag.nlp import rag_tokenizer
 from api.utils.file_utils import get_project_base_directory
 
+TERM_WEIGHT_CACHE_SIZE = int(os.environ.get("TERM_WEIGHT_CACHE_SIZE", 100000))
+IDF_VOCAB_FILE = "term_weight.vocab"
+IDF_TABLE_FILE = "term_weight.idf.npy"
+
 
 class Dealer:
     def __init__(self):
@@ -92,6 +98,16 @@ class Dealer:
             self.df = load_dict(os.path.join(fnm, "term.freq"))
         except Exception:
             logging.warning("Load term.freq FAIL!")
+        self.idf_vocab, self.idf_table = {}, None
+        try:
+            self.load_idf_table(fnm)
+        except Exception:
+            logging.warning("Load IDF table FAIL!")
+        # per-token weights only depend on the static dictionaries, so they are memoized;
+        # freq and df_ too, as they recurse into the fine-grained tokens of unknown long tokens
+        self.token_weight = lru_cache(maxsize=TERM_WEIGHT_CACHE_SIZE)(self.token_weight_)
+        self.freq = lru_cache(maxsize=TERM_WEIGHT_CACHE_SIZE)(self.freq)
+        self.df_ = lru_cache(maxsize=TERM_WEIGHT_CACHE_SIZE)(self.df_)
 
     def pretoken(self, txt, num=False, stpwd=True):
         patt = [r"[~—\t @#%!<>,\.\?\":;'\{\}\[\]_=\(\)\|，。？》•●○↓《；‘’：“”【¥ 】…￥！、·（）×`&\\/「」\\]"]
@@ -164,84 +180,128 @@ class Dealer:
                 tks.append(t)
         return tks
 
-    def weights(self, tks, preprocess=True):
-        def skill(t):
-            if t not in self.sk:
-                return 1
-            return 6
-
-        def ner(t):
-            if re.match(r"[0-9,.]{2,}$", t):
-                return 2
-            if re.match(r"[a-z]{1,2}$", t):
-                return 0.01
-            if not self.ne or t not in self.ne:
-                return 1
-            m = {"toxic": 2, "func": 1, "corp": 3, "loca": 3, "sch": 3, "stock": 3, "firstnm": 1}
-            return m[self.ne[t]]
-
-        def postag(t):
-            t = rag_tokenizer.tag(t)
-            if t in set(["r", "c", "d"]):
-                return 0.3
-            if t in set(["ns", "nt"]):
-                return 3
-            if t in set(["n"]):
-                return 2
-            if re.match(r"[0-9-]+", t):
-                return 2
+    def ner_weight(self, t):
+        if re.match(r"[0-9,.]{2,}$", t):
+            return 2
+        if re.match(r"[a-z]{1,2}$", t):
+            return 0.01
+        if not self.ne or t not in self.ne:
             return 1
+        m = {"toxic": 2, "func": 1, "corp": 3, "loca": 3, "sch": 3, "stock": 3, "firstnm": 1}
+        return m[self.ne[t]]
+
+    def postag_weight(self, t):
+        t = rag_tokenizer.tag(t)
+        if t in set(["r", "c", "d"]):
+            return 0.3
+        if t in set(["ns", "nt"]):
+            return 3
+        if t in set(["n"]):
+            return 2
+        if re.match(r"[0-9-]+", t):
+            return 2
+        return 1
 
-        def freq(t):
-            if re.match(r"[0-9. -]{2,}$", t):
-                return 3
-            s = rag_tokenizer.freq(t)
-            if not s and re.match(r"[a-z. -]+$", t):
-                return 300
-            if not s:
+    def freq(self, t):
+        if re.match(r"[0-9. -]{2,}$", t):
+            return 3
+        s = rag_tokenizer.freq(t)
+        if not s and re.match(r"[a-z. -]+$", t):
+            return 300
+        if not s:
+            s = 0
+
+        if not s and len(t) >= 4:
+            s = [tt for tt in rag_tokenizer.fine_grained_tokenize(t).split() if len(tt) > 1]
+            if len(s) > 1:
+                s = np.min([self.freq(tt) for tt in s]) / 6.0
+            else:
                 s = 0
 
-            if not s and len(t) >= 4:
-                s = [tt for tt in rag_tokenizer.fine_grained_tokenize(t).split() if len(tt) > 1]
-                if len(s) > 1:
-                    s = np.min([freq(tt) for tt in s]) / 6.0
-                else:
-                    s = 0
-
-            return max(s, 10)
-
-        def df(t):
-            if re.match(r"[0-9. -]{2,}$", t):
-                return 5
-            if t in self.df:
-                return self.df[t] + 3
-            elif re.match(r"[a-z. -]+$", t):
-                return 300
-            elif len(t) >= 4:
-                s = [tt for tt in rag_tokenizer.fine_grained_tokenize(t).split() if len(tt) > 1]
-                if len(s) > 1:
-                    return max(3, np.min([df(tt) for tt in s]) / 6.0)
+        return max(s, 10)
 
-            return 3
+    def df_(self, t):
+        if re.match(r"[0-9. -]{2,}$", t):
+            return 5
+        if t in self.df:
+            return self.df[t] + 3
+        elif re.match(r"[a-z. -]+$", t):
+            return 300
+        elif len(t) >= 4:
+            s = [tt for tt in rag_tokenizer.fine_grained_tokenize(t).split() if len(tt) > 1]
+            if len(s) > 1:
+                return max(3, np.min([self.df_(tt) for tt in s]) / 6.0)
 
-        def idf(s, N):
-            return math.log10(10 + ((N - s + 0.5) / (s + 0.5)))
+        return 3
 
+    @staticmethod
+    def idf(s, N):
+        return math.log10(10 + ((N - s + 0.5) / (s + 0.5)))
+
+    def idfs(self, t):
+        i = self.idf_vocab.get(t)
+        if i is not None:
+            idf1, idf2 = self.idf_table[i]
+            return float(idf1), float(idf2)
+        return self.idf(self.freq(t), 10000000), self.idf(self.df_(t), 1000000000)
+
+    def token_weight_(self, t):
+        idf1, idf2 = self.idfs(t)
+        return (0.3 * idf1 + 0.7 * idf2) * self.ner_weight(t) * self.postag_weight(t)
+
+    def load_idf_table(self, fnm):
+        vocab_fnm, table_fnm = os.path.join(fnm, IDF_VOCAB_FILE), os.path.join(fnm, IDF_TABLE_FILE)
+        if not os.path.exists(vocab_fnm) or not os.path.exists(table_fnm):
+            return
+        with open(vocab_fnm, "r", encoding="utf-8") as f:
+            vocab = f.read().split("\n")
+        table = np.load(table_fnm, mmap_mode="r")
+        if len(vocab) != table.shape[0]:
+            logging.warning(f"IDF table {table_fnm} doesn't match {vocab_fnm}, ignored.")
+            return
+        self.idf_vocab = {t: i for i, t in enumerate(vocab)}
+        self.idf_table = table
+
+    def weights(self, tks, preprocess=True):
         tw = []
         if not preprocess:
-            idf1 = np.array([idf(freq(t), 10000000) for t in tks])
-            idf2 = np.array([idf(df(t), 1000000000) for t in tks])
-            wts = (0.3 * idf1 + 0.7 * idf2) * np.array([ner(t) * postag(t) for t in tks])
-            wts = [s for s in wts]
-            tw = list(zip(tks, wts))
+            tw = [(t, self.token_weight(t)) for t in tks]
         else:
             for tk in tks:
                 tt = self.tokenMerge(self.pretoken(tk, True))
-                idf1 = np.array([idf(freq(t), 10000000) for t in tt])
-                idf2 = np.array([idf(df(t), 1000000000) for t in tt])
-                wts = (0.3 * idf1 + 0.7 * idf2) * np.array([ner(t) * postag(t) for t in tt])
-                wts = [s for s in wts]
-                tw.extend(zip(tt, wts))
+                tw.extend([(t, self.token_weight(t)) for t in tt])
 
         S = np.sum([s for _, s in tw])
         return [(t, s / S) for t, s in tw]
+
+
+def build_idf_table(fnm=None):
+    """
+    Precompute idf1/idf2 of every token of the huqie dictionary and term.freq into
+    rag/res/term_weight.vocab (one token per line) and rag/res/term_weight.idf.npy
+    (float64 array of shape [len(vocab), 2], row i for line i), which Dealer memory-maps.
+    float64 keeps the weights identical to computing them on the fly. Re-run it whenever the
+    dictionaries change.
+    """
+    fnm = fnm or os.path.join(get_project_base_directory(), "rag/res")
+    dealer = Dealer()
+    dealer.idf_vocab, dealer.idf_table = {}, None
+    vocab = set(dealer.df)
+    for k in rag_tokenizer.tokenizer.trie_.keys():
+        if k.startswith("DD"):
+            continue
+        try:
+            vocab.add(ast.literal_eval("b'" + k + "'").decode("utf-8"))
+        except Exception:
+            continue
+    vocab = sorted([t for t in vocab if t and t.find("\n") < 0])
+    table = np.array([dealer.idfs(t) for t in vocab], dtype=np.float64).reshape(-1, 2)
+    with open(os.path.join(fnm, IDF_VOCAB_FILE), "w", encoding="utf-8") as f:
+        f.write("\n".join(vocab))
+    np.save(os.path.join(fnm, IDF_TABLE_FILE), table)
+    logging.info(f"Built IDF table of {len(vocab)} tokens in {fnm}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    build_idf_table()
@@ -0,0 +1,46 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Worker of rag_tokenizer.TokenizerPool.
+
+Reads pickled (trie_file, method, texts) requests from stdin and writes the pickled
+tokenized texts to stdout, until stdin is closed.
+
+    python -m rag.nlp.tokenizer_worker
+"""
+
+import os
+import pickle
+import sys
+
+
+def main():
+    out = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    # anything the tokenizer prints goes to stderr, stdout carries the results only
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    from rag.nlp.rag_tokenizer import tokenize_part
+
+    while True:
+        try:
+            trie_file, method, texts = pickle.load(sys.stdin.buffer)
+        except EOFError:
+            return
+        pickle.dump(tokenize_part(trie_file, method, texts), out, pickle.HIGHEST_PROTOCOL)
+        out.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -55,14 +55,14 @@ class RecursiveAbstractiveProcessing4TreeOrganizedRetrieval:
         return response
 
     async def _embedding_encode(self, txt):
-        response = get_embed_cache(self._embd_model.llm_name, txt)
+        response = get_embed_cache(self._embd_model.model_key, txt)
         if response is not None:
             return response
         embds, _ = await trio.to_thread.run_sync(lambda: self._embd_model.encode([txt]))
         if len(embds) < 1 or len(embds[0]) < 1:
             raise Exception("Embedding error: ")
         embds = embds[0]
-        set_embed_cache(self._embd_model.llm_name, txt, embds)
+        set_embed_cache(self._embd_model.model_key, txt, embds)
         return embds
 
     def _get_optimal_clusters(self, embeddings: np.ndarray, random_state: int):
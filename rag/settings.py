@@ -37,6 +37,15 @@ DOC_MAXIMUM_SIZE = int(os.environ.get("MAX_CONTENT_LENGTH", 128 * 1024 * 1024))
 SVR_QUEUE_NAME = "rag_flow_svr_queue"
 SVR_QUEUE_RETENTION = 60*60
 SVR_QUEUE_MAX_LEN = 1024
+# Redis set of ids of tasks whose progress changed, folded into their documents by ragflow_server
+DOC_PROGRESS_EVENTS = "rag_flow_doc_progress_events"
+# Re-parse a document incrementally: chunks whose content did not change keep their vectors and keywords
+INCREMENTAL_REPARSE = int(os.environ.get("INCREMENTAL_REPARSE", "1"))
+# Per document, the chunks stored before an incremental re-parse, deleted at its end unless rebuilt
+REPARSE_CHUNKS = "rag_flow_reparse_chunks"
+REPARSE_CHUNKS_TTL = 7 * 24 * 3600
+# Per document, digest of the settings its stored chunks were embedded and enriched with
+CHUNK_ENRICH_DIGEST = "rag_flow_chunk_enrich_digest"
 SVR_CONSUMER_NAME = "rag_flow_svr_consumer"
 SVR_CONSUMER_GROUP_NAME = "rag_flow_svr_consumer_group"
 PAGERANK_FLD = "pagerank_fea"
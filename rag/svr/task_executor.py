@@ -11,6 +11,7 @@ import json
 import xxhash
 import copy
 import re
+import threading
 from functools import partial
 from io import BytesIO
 from multiprocessing.context import TimeoutError
@@ -21,11 +22,12 @@ import trio
 import exceptiongroup
 import faulthandler
 import numpy as np
+from cachetools import TTLCache
 from peewee import DoesNotExist
 from api.db import LLMType, ParserType, TaskStatus
 from api.db.services.document_service import DocumentService
 from api.db.services.llm_service import LLMBundle
-from api.db.services.task_service import TaskService
+from api.db.services.task_service import TaskService, trim_header_by_lines
 from api.db.services.file2document_service import File2DocumentService
 from api import settings
 from api.versions import get_ragflow_version
@@ -34,9 +36,12 @@ from rag.app import laws, paper, presentation, manual, qa, table, book, resume,
     email, tag
 from rag.nlp import search, rag_tokenizer
 from rag.raptor import RecursiveAbstractiveProcessing4TreeOrganizedRetrieval as Raptor
-from rag.settings import DOC_MAXIMUM_SIZE, SVR_QUEUE_NAME, print_rag_settings, TAG_FLD, PAGERANK_FLD
+from rag.settings import DOC_MAXIMUM_SIZE, SVR_QUEUE_NAME, DOC_PROGRESS_EVENTS, INCREMENTAL_REPARSE, REPARSE_CHUNKS, print_rag_settings, TAG_FLD, PAGERANK_FLD
 from rag.utils import num_tokens_from_string
+from rag.utils.doc_store_conn import OrderByExpr
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.task_queue import SVR_CONSUMER_GROUP, TaskQueue
+from rag.utils.embedding_cache import EMBEDDING_CACHE
 from rag.utils.storage_factory import STORAGE_IMPL
 from graphrag.utils import chat_limiter
 
@@ -64,7 +69,6 @@ FACTORY = {
     ParserType.TAG.value: tag
 }
 
-UNACKED_ITERATOR = None
 CONSUMER_NAME = "task_consumer_" + CONSUMER_NO
 BOOT_AT = datetime.now().astimezone().isoformat(timespec="milliseconds")
 PENDING_TASKS = 0
@@ -73,11 +77,30 @@ DONE_TASKS = 0
 FAILED_TASKS = 0
 
 CURRENT_TASKS = {}
+CURRENT_MSG_IDS = {}
+TASK_QUEUE = TaskQueue(CONSUMER_NAME)
 
 MAX_CONCURRENT_TASKS = int(os.environ.get('MAX_CONCURRENT_TASKS', "5"))
 MAX_CONCURRENT_CHUNK_BUILDERS = int(os.environ.get('MAX_CONCURRENT_CHUNK_BUILDERS', "1"))
 task_limiter = trio.CapacityLimiter(MAX_CONCURRENT_TASKS)
 chunk_limiter = trio.CapacityLimiter(MAX_CONCURRENT_CHUNK_BUILDERS)
+DOC_BULK_SIZE = int(os.environ.get('DOC_BULK_SIZE', "64"))
+DOC_BULK_BYTES = int(os.environ.get('DOC_BULK_BYTES', str(8 * 1024 * 1024)))
+MAX_CONCURRENT_BULKS = int(os.environ.get('MAX_CONCURRENT_BULKS', "4"))
+CHUNK_IDS_CHECKPOINT = int(os.environ.get('CHUNK_IDS_CHECKPOINT', "1024"))
+CHUNK_PIPELINE_DEPTH = int(os.environ.get('CHUNK_PIPELINE_DEPTH', "2"))
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', "16"))
+EMBEDDING_BATCH_WAIT = float(os.environ.get('EMBEDDING_BATCH_WAIT', "0.02"))
+EMBEDDING_BATCHER_IDLE = float(os.environ.get('EMBEDDING_BATCHER_IDLE', "60"))
+MAX_CONCURRENT_EMBEDDINGS = int(os.environ.get('MAX_CONCURRENT_EMBEDDINGS', "4"))
+# Queued messages read at once, and how long to wait before polling an empty queue again (ms).
+TASK_PREFETCH = int(os.environ.get('TASK_PREFETCH', str(MAX_CONCURRENT_TASKS)))
+TASK_POLL_BLOCK = int(os.environ.get('TASK_POLL_BLOCK', "1000"))
+# Messages pending this long (s) belong to a dead executor, as live ones touch theirs every heartbeat.
+TASK_RECLAIM_IDLE = int(os.environ.get('TASK_RECLAIM_IDLE', "600"))
+TASK_RECLAIM_INTERVAL = int(os.environ.get('TASK_RECLAIM_INTERVAL', "60"))
+PROGRESS_FLUSH_INTERVAL = float(os.environ.get('PROGRESS_FLUSH_INTERVAL', "2"))
+CANCEL_CHECK_INTERVAL = float(os.environ.get('CANCEL_CHECK_INTERVAL', "3"))
 
 # SIGUSR1 handler: start tracemalloc and take snapshot
 def start_tracemalloc_and_snapshot(signum, frame):
@@ -116,11 +139,89 @@ class TaskCanceledException(Exception):
         self.msg = msg
 
 
+class ProgressReporter:
+    """
+    Buffers the progress of the tasks running in this executor and writes it in batches.
+
+    Progress used to be written per call under a cluster-wide DB lock. Here each task's messages
+    are appended in memory and flushed at most every PROGRESS_FLUSH_INTERVAL seconds, or at once
+    for final states. A task runs in one executor only, so that executor keeps the task's
+    progress_msg and rewrites it without re-reading. Cancel state is cached for
+    CANCEL_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = {}
+        self.messages = {}
+        self.canceled = TTLCache(maxsize=1024, ttl=CANCEL_CHECK_INTERVAL)
+
+    def is_canceled(self, task_id):
+        with self.lock:
+            canceled = self.canceled.get(task_id)
+        if canceled is None:
+            canceled = TaskService.do_cancel(task_id)
+            with self.lock:
+                self.canceled[task_id] = canceled
+        return canceled
+
+    def report(self, task_id, prog=None, msg="", flush=False):
+        with self.lock:
+            p = self.pending.setdefault(task_id, {"msgs": [], "since": timer()})
+            if msg:
+                p["msgs"].append(msg)
+            if prog is not None:
+                p["progress"] = prog
+            flush = flush or timer() - p["since"] >= PROGRESS_FLUSH_INTERVAL
+        if flush:
+            self.flush([task_id])
+
+    def flush(self, task_ids=None):
+        # flushes are serialized so that a task's messages are written in order
+        with self.flush_lock:
+            with self.lock:
+                task_ids = list(self.pending.keys()) if task_ids is None else [i for i in task_ids if i in self.pending]
+                batch = {i: self.pending.pop(i) for i in task_ids}
+            if not batch:
+                return
+            unknown = [i for i, p in batch.items() if p["msgs"] and i not in self.messages]
+            if unknown:
+                self.messages.update(TaskService.get_progress_msgs(unknown))
+            updates = {}
+            for task_id, p in batch.items():
+                info = {}
+                if p["msgs"]:
+                    text = self.messages.get(task_id, "") + "\n" + "\n".join(p["msgs"])
+                    self.messages[task_id] = info["progress_msg"] = trim_header_by_lines(text, 3000)
+                if "progress" in p:
+                    info["progress"] = p["progress"]
+                if info:
+                    updates[task_id] = info
+            try:
+                TaskService.update_progress_batch(updates)
+                # let ragflow_server re-aggregate the documents of these tasks
+                REDIS_CONN.sadd_many(DOC_PROGRESS_EVENTS, list(updates.keys()))
+            except Exception:
+                logging.exception(f"ProgressReporter.flush of {list(updates.keys())} got exception")
+            close_connection()
+
+    def forget(self, task_id):
+        self.flush([task_id])
+        with self.flush_lock:
+            self.messages.pop(task_id, None)
+        with self.lock:
+            self.canceled.pop(task_id, None)
+
+
+PROGRESS = ProgressReporter()
+
+
 def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing..."):
     try:
         if prog is not None and prog < 0:
             msg = "[ERROR]" + msg
-        cancel = TaskService.do_cancel(task_id)
+        cancel = PROGRESS.is_canceled(task_id)
 
         if cancel:
             msg += " [Canceled]"
@@ -132,13 +233,9 @@ def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing...
                     msg = f"Page({from_page + 1}~{to_page + 1}): " + msg
         if msg:
             msg = datetime.now().strftime("%H:%M:%S") + " " + msg
-        d = {"progress_msg": msg}
-        if prog is not None:
-            d["progress"] = prog
-
-        TaskService.update_progress(task_id, d)
+        # final states are written through so the document aggregation sees them right away
+        PROGRESS.report(task_id, prog, msg, flush=prog is not None and (prog < 0 or prog >= 1))
 
-        close_connection()
         if cancel:
             raise TaskCanceledException(msg)
         logging.info(f"set_progress({task_id}), progress: {prog}, progress_msg: {msg}")
@@ -147,130 +244,164 @@ def set_progress(task_id, from_page=0, to_page=-1, prog=None, msg="Processing...
     except Exception:
         logging.exception(f"set_progress({task_id}), progress: {prog}, progress_msg: {msg}, got exception")
 
-async def collect():
-    global CONSUMER_NAME, DONE_TASKS, FAILED_TASKS
-    global UNACKED_ITERATOR
-    try:
-        if not UNACKED_ITERATOR:
-            UNACKED_ITERATOR = REDIS_CONN.get_unacked_iterator(SVR_QUEUE_NAME, "rag_flow_svr_task_broker", CONSUMER_NAME)
+async def collect(nursery):
+    """
+    Read tasks from the queue lanes in batches and start them in `nursery`, at most
+    MAX_CONCURRENT_TASKS at a time. The task rows of a batch are fetched with one query. This
+    consumer's own pending messages are re-read first, e.g. after a restart, and messages left
+    pending on dead consumers are reclaimed every TASK_RECLAIM_INTERVAL seconds.
+    """
+    global FAILED_TASKS
+    recovering = True
+    last_reclaim = timer()
+    while True:
+        # a slot of task_limiter per message to read, so prefetching never outruns the capacity
+        slots = [object()]
+        await task_limiter.acquire_on_behalf_of(slots[0])
+        while len(slots) < TASK_PREFETCH:
+            slot = object()
+            try:
+                task_limiter.acquire_on_behalf_of_nowait(slot)
+            except trio.WouldBlock:
+                break
+            slots.append(slot)
+
+        redis_msgs = []
         try:
-            redis_msg = next(UNACKED_ITERATOR)
-        except StopIteration:
-            redis_msg = REDIS_CONN.queue_consumer(SVR_QUEUE_NAME, "rag_flow_svr_task_broker", CONSUMER_NAME)
-        if not redis_msg:
+            if recovering:
+                redis_msgs = await trio.to_thread.run_sync(TASK_QUEUE.read_pending, len(slots))
+                recovering = len(redis_msgs) > 0
+            elif timer() - last_reclaim >= TASK_RECLAIM_INTERVAL:
+                last_reclaim = timer()
+                redis_msgs = await trio.to_thread.run_sync(TASK_QUEUE.reclaim, len(slots), TASK_RECLAIM_IDLE * 1000)
+            if not redis_msgs and not recovering:
+                redis_msgs = await trio.to_thread.run_sync(TASK_QUEUE.read, len(slots))
+
+            tasks = {}
+            msgs = [m.get_message() for m in redis_msgs]
+            task_ids = [m["id"] for m in msgs if m]
+            if task_ids:
+                tasks = await trio.to_thread.run_sync(TaskService.get_task_batch, task_ids)
+        except Exception:
+            logging.exception("collect got exception")
+            for slot in slots:
+                task_limiter.release_on_behalf_of(slot)
             await trio.sleep(1)
-            return None, None
-    except Exception:
-        logging.exception("collect got exception")
-        return None, None
-
-    msg = redis_msg.get_message()
-    if not msg:
-        logging.error(f"collect got empty message of {redis_msg.get_msg_id()}")
-        redis_msg.ack()
-        return None, None
-
-    canceled = False
-    task = TaskService.get_task(msg["id"])
-    if task:
-        _, doc = DocumentService.get_by_id(task["doc_id"])
-        canceled = doc.run == TaskStatus.CANCEL.value or doc.progress < 0
-    if not task or canceled:
-        state = "is unknown" if not task else "has been cancelled"
-        FAILED_TASKS += 1
-        logging.warning(f"collect task {msg['id']} {state}")
-        redis_msg.ack()
-        return None, None
-    task["task_type"] = msg.get("task_type", "")
-    return redis_msg, task
+            continue
+
+        for redis_msg, msg in zip(redis_msgs, msgs):
+            if not msg:
+                logging.error(f"collect got empty message of {redis_msg.get_msg_id()}")
+                redis_msg.ack()
+                continue
+            task = tasks.get(msg["id"])
+            canceled = False
+            if task:
+                task = copy.deepcopy(task)
+                canceled = task.pop("doc_run") == TaskStatus.CANCEL.value
+                canceled = task.pop("doc_progress") < 0 or canceled
+            if not task or canceled:
+                state = "is unknown" if not task else "has been cancelled"
+                FAILED_TASKS += 1
+                logging.warning(f"collect task {msg['id']} {state}")
+                redis_msg.ack()
+                continue
+            task["task_type"] = msg.get("task_type", "")
+            nursery.start_soon(handle_task, redis_msg, task, slots.pop())
+        for slot in slots:
+            task_limiter.release_on_behalf_of(slot)
+        if not redis_msgs:
+            await trio.sleep(TASK_POLL_BLOCK / 1000)
 
 
 async def get_storage_binary(bucket, name):
     return await trio.to_thread.run_sync(lambda: STORAGE_IMPL.get(bucket, name))
 
 
-async def build_chunks(task, progress_callback):
-    if task["size"] > DOC_MAXIMUM_SIZE:
-        set_progress(task["id"], prog=-1, msg="File size exceeds( <= %dMb )" %
-                                              (int(DOC_MAXIMUM_SIZE / 1024 / 1024)))
-        return []
+def load_stored_chunks(task, chunk_ids, vector_size):
+    """Vectors, keywords and questions of the chunks of `task`'s document stored under `chunk_ids`."""
+    fields = ["q_%d_vec" % vector_size, "important_kwd", "important_tks", "question_kwd", "question_tks"]
+    res = settings.docStoreConn.search(fields, [], {"id": chunk_ids, "doc_id": task["doc_id"]}, [], OrderByExpr(), 0, len(chunk_ids),
+                                       search.index_name(task["tenant_id"]), [task["kb_id"]])
+    return settings.docStoreConn.getFields(res, fields)
 
-    chunker = FACTORY[task["parser_id"].lower()]
-    try:
-        st = timer()
-        bucket, name = File2DocumentService.get_storage_address(doc_id=task["doc_id"])
-        binary = await get_storage_binary(bucket, name)
-        logging.info("From minio({}) {}/{}".format(timer() - st, task["location"], task["name"]))
-    except TimeoutError:
-        progress_callback(-1, "Internal server error: Fetch file from minio timeout. Could you try it again.")
-        logging.exception(
-            "Minio {}/{} got timeout: Fetch file from minio timeout.".format(task["location"], task["name"]))
-        raise
-    except Exception as e:
-        if re.search("(No such file|not found)", str(e)):
-            progress_callback(-1, "Can not find file <%s> from minio. Could you try it again?" % task["name"])
-        else:
-            progress_callback(-1, "Get file from minio: %s" % str(e).replace("'", ""))
-        logging.exception("Chunking {}/{} got exception".format(task["location"], task["name"]))
-        raise
 
-    try:
-        async with chunk_limiter:
-            cks = await trio.to_thread.run_sync(lambda: chunker.chunk(task["name"], binary=binary, from_page=task["from_page"],
-                                to_page=task["to_page"], lang=task["language"], callback=progress_callback,
-                                kb_id=task["kb_id"], parser_config=task["parser_config"], tenant_id=task["tenant_id"]))
-        logging.info("Chunking({}) {}/{} done".format(timer() - st, task["location"], task["name"]))
-    except TaskCanceledException:
-        raise
-    except Exception as e:
-        progress_callback(-1, "Internal server error while chunking: %s" % str(e).replace("'", ""))
-        logging.exception("Chunking {}/{} got exception".format(task["location"], task["name"]))
-        raise
+def has_vector(chunk: dict) -> bool:
+    return any([re.match(r"q_[0-9]+_vec$", k) for k in chunk])
 
-    docs = []
-    doc = {
-        "doc_id": task["doc_id"],
-        "kb_id": str(task["kb_id"])
-    }
-    if task["pagerank"]:
-        doc[PAGERANK_FLD] = int(task["pagerank"])
-    el = 0
-    for ck in cks:
-        d = copy.deepcopy(doc)
-        d.update(ck)
-        d["id"] = xxhash.xxh64((ck["content_with_weight"] + str(d["doc_id"])).encode("utf-8")).hexdigest()
-        d["create_time"] = str(datetime.now()).replace("T", " ")[:19]
-        d["create_timestamp_flt"] = datetime.now().timestamp()
-        if not d.get("image"):
-            _ = d.pop("image", None)
-            d["img_id"] = ""
-            docs.append(d)
-            continue
 
-        try:
-            output_buffer = BytesIO()
-            if isinstance(d["image"], bytes):
-                output_buffer = BytesIO(d["image"])
-            else:
-                d["image"].save(output_buffer, format='JPEG')
+async def build_chunks(task, progress_callback, send_channel, vector_size=0, task_status=trio.TASK_STATUS_IGNORED):
+    """
+    Chunk the document of `task` and stream the chunks to `send_channel` in batches of
+    at most BATCH_SIZE. Images are uploaded and keywords, questions and tags are generated
+    batch by batch, so only one batch of enriched chunks is alive at a time.
 
+    During an incremental re-parse, chunks whose id (a hash of their content) is already
+    stored take over the stored vector, keywords and questions instead of generating them.
+
+    The total number of chunks is reported through `task_status` once chunking is done.
+    """
+    async with send_channel:
+        if task["size"] > DOC_MAXIMUM_SIZE:
+            set_progress(task["id"], prog=-1, msg="File size exceeds( <= %dMb )" %
+                                                  (int(DOC_MAXIMUM_SIZE / 1024 / 1024)))
+            task_status.started(0)
+            return
+
+        chunker = FACTORY[task["parser_id"].lower()]
+        try:
             st = timer()
-            await trio.to_thread.run_sync(lambda: STORAGE_IMPL.put(task["kb_id"], d["id"], output_buffer.getvalue()))
-            el += timer() - st
-        except Exception:
+            bucket, name = File2DocumentService.get_storage_address(doc_id=task["doc_id"])
+            binary = await get_storage_binary(bucket, name)
+            logging.info("From minio({}) {}/{}".format(timer() - st, task["location"], task["name"]))
+        except TimeoutError:
+            progress_callback(-1, "Internal server error: Fetch file from minio timeout. Could you try it again.")
             logging.exception(
-                "Saving image of chunk {}/{}/{} got exception".format(task["location"], task["name"], d["id"]))
+                "Minio {}/{} got timeout: Fetch file from minio timeout.".format(task["location"], task["name"]))
+            raise
+        except Exception as e:
+            if re.search("(No such file|not found)", str(e)):
+                progress_callback(-1, "Can not find file <%s> from minio. Could you try it again?" % task["name"])
+            else:
+                progress_callback(-1, "Get file from minio: %s" % str(e).replace("'", ""))
+            logging.exception("Chunking {}/{} got exception".format(task["location"], task["name"]))
             raise
 
-        d["img_id"] = "{}-{}".format(task["kb_id"], d["id"])
-        del d["image"]
-        docs.append(d)
-    logging.info("MINIO PUT({}):{}".format(task["name"], el))
+        try:
+            async with chunk_limiter:
+                cks = await trio.to_thread.run_sync(lambda: chunker.chunk(task["name"], binary=binary, from_page=task["from_page"],
+                                    to_page=task["to_page"], lang=task["language"], callback=progress_callback,
+                                    kb_id=task["kb_id"], parser_config=task["parser_config"], tenant_id=task["tenant_id"]))
+            logging.info("Chunking({}) {}/{} done".format(timer() - st, task["location"], task["name"]))
+        except TaskCanceledException:
+            raise
+        except Exception as e:
+            progress_callback(-1, "Internal server error while chunking: %s" % str(e).replace("'", ""))
+            logging.exception("Chunking {}/{} got exception".format(task["location"], task["name"]))
+            raise
+        task_status.started(len(cks))
+        if not cks:
+            return
 
-    if task["parser_config"].get("auto_keywords", 0):
-        st = timer()
-        progress_callback(msg="Start to generate keywords for every chunk ...")
-        chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
+        doc = {
+            "doc_id": task["doc_id"],
+            "kb_id": str(task["kb_id"])
+        }
+        if task["pagerank"]:
+            doc[PAGERANK_FLD] = int(task["pagerank"])
+
+        auto_keywords = task["parser_config"].get("auto_keywords", 0)
+        auto_questions = task["parser_config"].get("auto_questions", 0)
+        tag_kb_ids = task["kb_parser_config"].get("tag_kb_ids", [])
+        chat_mdl = None
+        if auto_keywords or auto_questions or tag_kb_ids:
+            chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
+        reparse = INCREMENTAL_REPARSE and vector_size and REDIS_CONN.exist(f"{REPARSE_CHUNKS}:{task['doc_id']}")
+        reused_count = 0
+        if auto_keywords:
+            progress_callback(msg="Start to generate keywords for every chunk ...")
+        if auto_questions:
+            progress_callback(msg="Start to generate questions for every chunk ...")
 
         async def doc_keyword_extraction(chat_mdl, d, topn):
             cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], "keywords", {"topn": topn})
@@ -282,15 +413,6 @@ async def build_chunks(task, progress_callback):
                 d["important_kwd"] = cached.split(",")
                 d["important_tks"] = rag_tokenizer.tokenize(" ".join(d["important_kwd"]))
             return
-        async with trio.open_nursery() as nursery:
-            for d in docs:
-                nursery.start_soon(lambda: doc_keyword_extraction(chat_mdl, d, task["parser_config"]["auto_keywords"]))
-        progress_callback(msg="Keywords generation {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
-
-    if task["parser_config"].get("auto_questions", 0):
-        st = timer()
-        progress_callback(msg="Start to generate questions for every chunk ...")
-        chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
 
         async def doc_question_proposal(chat_mdl, d, topn):
             cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], "question", {"topn": topn})
@@ -301,34 +423,19 @@ async def build_chunks(task, progress_callback):
             if cached:
                 d["question_kwd"] = cached.split("\n")
                 d["question_tks"] = rag_tokenizer.tokenize("\n".join(d["question_kwd"]))
-        async with trio.open_nursery() as nursery:
-            for d in docs:
-                nursery.start_soon(lambda: doc_question_proposal(chat_mdl, d, task["parser_config"]["auto_questions"]))
-        progress_callback(msg="Question generation {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
-
-    if task["kb_parser_config"].get("tag_kb_ids", []):
-        progress_callback(msg="Start to tag for every chunk ...")
-        kb_ids = task["kb_parser_config"]["tag_kb_ids"]
-        tenant_id = task["tenant_id"]
-        topn_tags = task["kb_parser_config"].get("topn_tags", 3)
-        S = 1000
-        st = timer()
-        examples = []
-        all_tags = get_tags_from_cache(kb_ids)
-        if not all_tags:
-            all_tags = settings.retrievaler.all_tags_in_portion(tenant_id, kb_ids, S)
-            set_tags_to_cache(kb_ids, all_tags)
-        else:
-            all_tags = json.loads(all_tags)
-
-        chat_mdl = LLMBundle(task["tenant_id"], LLMType.CHAT, llm_name=task["llm_id"], lang=task["language"])
-
-        docs_to_tag = []
-        for d in docs:
-            if settings.retrievaler.tag_content(tenant_id, kb_ids, d, all_tags, topn_tags=topn_tags, S=S):
-                examples.append({"content": d["content_with_weight"], TAG_FLD: d[TAG_FLD]})
+
+        if tag_kb_ids:
+            progress_callback(msg="Start to tag for every chunk ...")
+            tenant_id = task["tenant_id"]
+            topn_tags = task["kb_parser_config"].get("topn_tags", 3)
+            S = 1000
+            examples = []
+            all_tags = get_tags_from_cache(tag_kb_ids)
+            if not all_tags:
+                all_tags = settings.retrievaler.all_tags_in_portion(tenant_id, tag_kb_ids, S)
+                set_tags_to_cache(tag_kb_ids, all_tags)
             else:
-                docs_to_tag.append(d)
+                all_tags = json.loads(all_tags)
 
         async def doc_content_tagging(chat_mdl, d, topn_tags):
             cached = get_llm_cache(chat_mdl.llm_name, d["content_with_weight"], all_tags, {"topn": topn_tags})
@@ -341,12 +448,96 @@ async def build_chunks(task, progress_callback):
             if cached:
                 set_llm_cache(chat_mdl.llm_name, d["content_with_weight"], cached, all_tags, {"topn": topn_tags})
                 d[TAG_FLD] = json.loads(cached)
-        async with trio.open_nursery() as nursery:
-            for d in docs_to_tag:
-                nursery.start_soon(lambda: doc_content_tagging(chat_mdl, d, topn_tags))
-        progress_callback(msg="Tagging {} chunks completed in {:.2f}s".format(len(docs), timer() - st))
 
-    return docs
+        el = 0
+        elapsed = {"keywords": 0, "questions": 0, "tags": 0}
+        for b in range(0, len(cks), BATCH_SIZE):
+            docs = []
+            for i in range(b, min(b + BATCH_SIZE, len(cks))):
+                ck = cks[i]
+                # drop the parser's reference so page images are released once uploaded
+                cks[i] = None
+                d = copy.deepcopy(doc)
+                d.update(ck)
+                d["id"] = xxhash.xxh64((ck["content_with_weight"] + str(d["doc_id"])).encode("utf-8")).hexdigest()
+                d["create_time"] = str(datetime.now()).replace("T", " ")[:19]
+                d["create_timestamp_flt"] = datetime.now().timestamp()
+                if not d.get("image"):
+                    _ = d.pop("image", None)
+                    d["img_id"] = ""
+                    docs.append(d)
+                    continue
+
+                try:
+                    output_buffer = BytesIO()
+                    if isinstance(d["image"], bytes):
+                        output_buffer = BytesIO(d["image"])
+                    else:
+                        d["image"].save(output_buffer, format='JPEG')
+
+                    st = timer()
+                    await trio.to_thread.run_sync(lambda: STORAGE_IMPL.put(task["kb_id"], d["id"], output_buffer.getvalue()))
+                    el += timer() - st
+                except Exception:
+                    logging.exception(
+                        "Saving image of chunk {}/{}/{} got exception".format(task["location"], task["name"], d["id"]))
+                    raise
+
+                d["img_id"] = "{}-{}".format(task["kb_id"], d["id"])
+                del d["image"]
+                docs.append(d)
+
+            fresh = docs
+            if reparse:
+                stored = await trio.to_thread.run_sync(lambda: load_stored_chunks(task, [d["id"] for d in docs], vector_size))
+                fresh = []
+                for d in docs:
+                    ck = stored.get(d["id"])
+                    if not ck or not ck.get("q_%d_vec" % vector_size):
+                        fresh.append(d)
+                        continue
+                    for fld, v in ck.items():
+                        d.setdefault(fld, v)
+                reused_count += len(docs) - len(fresh)
+
+            if auto_keywords:
+                st = timer()
+                async with trio.open_nursery() as nursery:
+                    for d in fresh:
+                        nursery.start_soon(lambda: doc_keyword_extraction(chat_mdl, d, auto_keywords))
+                elapsed["keywords"] += timer() - st
+
+            if auto_questions:
+                st = timer()
+                async with trio.open_nursery() as nursery:
+                    for d in fresh:
+                        nursery.start_soon(lambda: doc_question_proposal(chat_mdl, d, auto_questions))
+                elapsed["questions"] += timer() - st
+
+            if tag_kb_ids:
+                st = timer()
+                docs_to_tag = []
+                for d in docs:
+                    if settings.retrievaler.tag_content(tenant_id, tag_kb_ids, d, all_tags, topn_tags=topn_tags, S=S):
+                        examples.append({"content": d["content_with_weight"], TAG_FLD: d[TAG_FLD]})
+                    else:
+                        docs_to_tag.append(d)
+                async with trio.open_nursery() as nursery:
+                    for d in docs_to_tag:
+                        nursery.start_soon(lambda: doc_content_tagging(chat_mdl, d, topn_tags))
+                elapsed["tags"] += timer() - st
+
+            await send_channel.send(docs)
+        logging.info("MINIO PUT({}):{}".format(task["name"], el))
+        if reparse:
+            progress_callback(msg="Reused {} unchanged chunks of the previous parse".format(reused_count))
+
+        if auto_keywords:
+            progress_callback(msg="Keywords generation {} chunks completed in {:.2f}s".format(len(cks), elapsed["keywords"]))
+        if auto_questions:
+            progress_callback(msg="Question generation {} chunks completed in {:.2f}s".format(len(cks), elapsed["questions"]))
+        if tag_kb_ids:
+            progress_callback(msg="Tagging {} chunks completed in {:.2f}s".format(len(cks), elapsed["tags"]))
 
 
 def init_kb(row, vector_size: int):
@@ -354,49 +545,229 @@ def init_kb(row, vector_size: int):
     return settings.docStoreConn.createIdx(idxnm, row.get("kb_id", ""), vector_size)
 
 
-async def embedding(docs, mdl, parser_config=None, callback=None):
+class EmbeddingBatcher:
+    """
+    Coalesces the encode calls of all concurrent tasks on one embedding model into batches of
+    EMBEDDING_BATCH_SIZE texts, waiting at most EMBEDDING_BATCH_WAIT seconds to fill a batch,
+    and keeps up to MAX_CONCURRENT_EMBEDDINGS batches in flight against the model.
+    """
+
+    class Request:
+        def __init__(self, texts):
+            self.vectors = [None] * len(texts)
+            self.remaining = len(texts)
+            self.token_count = 0
+            self.error = None
+            self.done = trio.Event()
+
+    def __init__(self, key, mdl):
+        self.key = key
+        self.mdl = mdl
+        self.send_channel, self.receive_channel = trio.open_memory_channel(float("inf"))
+        self.in_flight = trio.Semaphore(MAX_CONCURRENT_EMBEDDINGS)
+
+    def submit(self, texts):
+        req = EmbeddingBatcher.Request(texts)
+        for i, txt in enumerate(texts):
+            self.send_channel.send_nowait((req, i, txt))
+        if not texts:
+            req.done.set()
+        return req
+
+    def idle(self):
+        return self.receive_channel.statistics().current_buffer_used == 0
+
+    async def run(self):
+        async with trio.open_nursery() as nursery:
+            while True:
+                with trio.move_on_after(EMBEDDING_BATCHER_IDLE) as idle_scope:
+                    batch = [await self.receive_channel.receive()]
+                if idle_scope.cancelled_caught:
+                    if self.idle():
+                        EMBEDDING_BATCHERS.pop(self.key, None)
+                        return
+                    continue
+                with trio.move_on_after(EMBEDDING_BATCH_WAIT):
+                    while len(batch) < EMBEDDING_BATCH_SIZE:
+                        batch.append(await self.receive_channel.receive())
+                await self.in_flight.acquire()
+                nursery.start_soon(self.dispatch, batch)
+
+    async def dispatch(self, batch):
+        """Encode one batch; any failure is handed to every request of the batch instead of the batcher."""
+        texts = [txt for _, _, txt in batch]
+        try:
+            vts, c = await trio.to_thread.run_sync(lambda: self.mdl.encode(texts))
+            if len(vts) != len(texts):
+                raise ValueError(f"Embedding model {self.mdl.llm_name} returned {len(vts)} vectors for {len(texts)} texts")
+            # share the tokens of the batch among its requests by text length
+            total_len = max(sum([len(txt) for txt in texts]), 1)
+            for (req, i, txt), vec in zip(batch, vts):
+                req.vectors[i] = vec
+                req.token_count += c * len(txt) / total_len
+                req.remaining -= 1
+                if req.remaining == 0:
+                    req.done.set()
+        except Exception as e:
+            for req, _, _ in batch:
+                req.error = e
+                req.done.set()
+        finally:
+            self.in_flight.release()
+
+
+EMBEDDING_BATCHERS = {}
+EMBEDDING_NURSERY = None
+
+
+async def batch_encode(mdl, texts):
+    """Encode `texts` with `mdl` through the batcher shared by every task of this executor."""
+    if EMBEDDING_NURSERY is None:
+        return await trio.to_thread.run_sync(lambda: mdl.encode(texts))
+    key = (mdl.tenant_id, mdl.llm_name)
+    batcher = EMBEDDING_BATCHERS.get(key)
+    if batcher is None:
+        batcher = EmbeddingBatcher(key, mdl)
+        EMBEDDING_BATCHERS[key] = batcher
+        EMBEDDING_NURSERY.start_soon(batcher.run)
+    req = batcher.submit(texts)
+    await req.done.wait()
+    if req.error:
+        raise req.error
+    return np.array(req.vectors), int(round(req.token_count))
+
+
+async def embedding(chunk_batches, mdl, send_channel, parser_config=None):
+    """
+    Embed the chunk batches received from `chunk_batches`, writing the vector of every
+    chunk in place and passing each embedded batch on to `send_channel`. Chunks that
+    already carry a vector, reused from the previous parse, are passed on as they are.
+    """
     if parser_config is None:
         parser_config = {}
-    batch_size = 16
-    tts, cnts = [], []
-    for d in docs:
-        tts.append(d.get("docnm_kwd", "Title"))
-        c = "\n".join(d.get("question_kwd", []))
-        if not c:
-            c = d["content_with_weight"]
-        c = re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", c)
-        if not c:
-            c = "None"
-        cnts.append(c)
-
+    title_w = float(parser_config.get("filename_embd_weight", 0.1))
+    title_vec = None
     tk_count = 0
-    if len(tts) == len(cnts):
-        vts, c = await trio.to_thread.run_sync(lambda: mdl.encode(tts[0: 1]))
-        tts = np.concatenate([vts for _ in range(len(tts))], axis=0)
+    vector_size = 0
+    async for docs in chunk_batches:
+        todo = [d for d in docs if not has_vector(d)]
+        if not todo:
+            await send_channel.send(docs)
+            continue
+        if title_vec is None:
+            vts, c = await batch_encode(mdl, [todo[0].get("docnm_kwd", "Title")])
+            title_vec = vts[0]
+            tk_count += c
+
+        cnts = []
+        for d in todo:
+            c = "\n".join(d.get("question_kwd", []))
+            if not c:
+                c = d["content_with_weight"]
+            c = re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", c)
+            if not c:
+                c = "None"
+            cnts.append(c)
+
+        vts, c = await batch_encode(mdl, cnts)
         tk_count += c
+        vects = title_w * title_vec + (1 - title_w) * vts
+        assert len(vects) == len(todo)
+        for d, vec in zip(todo, vects):
+            v = vec.tolist()
+            vector_size = len(v)
+            d["q_%d_vec" % len(v)] = v
+        await send_channel.send(docs)
+    return tk_count, vector_size
 
-    cnts_ = np.array([])
-    for i in range(0, len(cnts), batch_size):
-        vts, c = await trio.to_thread.run_sync(lambda: mdl.encode(cnts[i: i + batch_size]))
-        if len(cnts_) == 0:
-            cnts_ = vts
-        else:
-            cnts_ = np.concatenate((cnts_, vts), axis=0)
-        tk_count += c
-        callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
-    cnts = cnts_
 
-    title_w = float(parser_config.get("filename_embd_weight", 0.1))
-    vects = (title_w * tts + (1 - title_w) *
-             cnts) if len(tts) == len(cnts) else cnts
+def bulk_size_of(chunk: dict) -> int:
+    return len(json.dumps(chunk, ensure_ascii=False).encode("utf-8"))
 
-    assert len(vects) == len(docs)
-    vector_size = 0
-    for i, d in enumerate(docs):
-        v = vects[i].tolist()
-        vector_size = len(v)
-        d["q_%d_vec" % len(v)] = v
-    return tk_count, vector_size
+
+async def insert_chunks(task, chunk_batches, progress_callback, total):
+    """
+    Bulk-index chunks received from `chunk_batches` (an async iterable of chunk lists).
+
+    Chunks are regrouped into bulk requests bounded by DOC_BULK_SIZE documents and
+    DOC_BULK_BYTES bytes, and up to MAX_CONCURRENT_BULKS of them are kept in flight.
+    Inserted chunk ids are checkpointed to the task every CHUNK_IDS_CHECKPOINT chunks
+    and committed once at the end. If indexing fails, the chunks sent since the last
+    checkpoint are deleted again, so the store holds no chunk the task does not list.
+
+    Returns the ids of inserted chunks, or None if the task disappeared meanwhile,
+    in which case the inserted chunks are removed again.
+    """
+    index_name = search.index_name(task["tenant_id"])
+    sent_ids = []
+    inserted_ids = []
+    checkpointed = 0
+    task_gone = False
+    in_flight = trio.Semaphore(MAX_CONCURRENT_BULKS)
+
+    def commit_chunk_ids():
+        nonlocal checkpointed, task_gone
+        try:
+            TaskService.update_chunk_ids(task["id"], " ".join(inserted_ids))
+            checkpointed = len(inserted_ids)
+        except DoesNotExist:
+            logging.warning(f"insert_chunks update_chunk_ids failed since task {task['id']} is unknown.")
+            task_gone = True
+
+    async def do_insert(bulk):
+        try:
+            doc_store_result = await trio.to_thread.run_sync(
+                lambda: settings.docStoreConn.insert(bulk, index_name, task["kb_id"]))
+        finally:
+            in_flight.release()
+        if doc_store_result:
+            error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
+            progress_callback(-1, msg=error_message)
+            raise Exception(error_message)
+        inserted_ids.extend([chunk["id"] for chunk in bulk])
+        progress_callback(prog=0.7 + 0.2 * len(inserted_ids) / max(total, 1), msg="")
+        if not task_gone and len(inserted_ids) - checkpointed >= CHUNK_IDS_CHECKPOINT:
+            commit_chunk_ids()
+
+    try:
+        async with trio.open_nursery() as nursery:
+            bulk, bulk_bytes = [], 0
+
+            async def flush():
+                nonlocal bulk, bulk_bytes
+                await in_flight.acquire()
+                # a failed bulk may still have written part of its chunks
+                sent_ids.extend([chunk["id"] for chunk in bulk])
+                nursery.start_soon(do_insert, bulk)
+                bulk, bulk_bytes = [], 0
+
+            async for chunks in chunk_batches:
+                for chunk in chunks:
+                    if task_gone:
+                        break
+                    size = bulk_size_of(chunk)
+                    if bulk and (len(bulk) >= DOC_BULK_SIZE or bulk_bytes + size > DOC_BULK_BYTES):
+                        await flush()
+                    bulk.append(chunk)
+                    bulk_bytes += size
+            if bulk and not task_gone:
+                await flush()
+    except BaseException:
+        stale_ids = list(set(sent_ids) - set(inserted_ids[:checkpointed]))
+        if stale_ids:
+            with trio.CancelScope(shield=True):
+                try:
+                    await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": stale_ids}, index_name, task["kb_id"]))
+                except Exception:
+                    logging.exception(f"insert_chunks failed to delete {len(stale_ids)} unrecorded chunks of task {task['id']}")
+        raise
+
+    if not task_gone:
+        commit_chunk_ids()
+    if task_gone:
+        await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": inserted_ids}, index_name, task["kb_id"]))
+        return None
+    return inserted_ids
 
 
 async def run_raptor(row, chat_mdl, embd_mdl, vector_size, callback=None):
@@ -488,6 +859,11 @@ async def do_handle_task(task):
         chat_model = LLMBundle(task_tenant_id, LLMType.CHAT, llm_name=task_llm_id, lang=task_language)
         # run RAPTOR
         chunks, token_count = await run_raptor(task, chat_model, embedding_model, vector_size, progress_callback)
+        start_ts = timer()
+
+        async def raptor_chunks():
+            yield chunks
+        chunk_ids = await insert_chunks(task, raptor_chunks(), progress_callback, len(chunks))
     # Either using graphrag or Standard chunking methods
     elif task.get("task_type", "") == "graphrag":
         graphrag_conf = task_parser_config.get("graphrag", {})
@@ -501,53 +877,47 @@ async def do_handle_task(task):
         progress_callback(prog=1.0, msg="Knowledge Graph done ({:.2f}s)".format(timer() - start_ts))
         return
     else:
-        # Standard chunking methods
+        # Standard chunking methods: chunks stream through building, embedding and indexing
+        # in bounded batches, so a task never holds all its chunks and vectors at once.
         start_ts = timer()
-        chunks = await build_chunks(task, progress_callback)
-        logging.info("Build document {}: {:.2f}s".format(task_document_name, timer() - start_ts))
-        if chunks is None:
-            return
-        if not chunks:
+        chunk_send, chunk_receive = trio.open_memory_channel(CHUNK_PIPELINE_DEPTH)
+        embedded_send, embedded_receive = trio.open_memory_channel(CHUNK_PIPELINE_DEPTH)
+        result = {}
+
+        async def embed_stage():
+            async with chunk_receive, embedded_send:
+                try:
+                    result["token_count"], _ = await embedding(chunk_receive, embedding_model, embedded_send, task_parser_config)
+                except Exception as e:
+                    error_message = "Generate embedding error:{}".format(str(e))
+                    progress_callback(-1, error_message)
+                    logging.exception(error_message)
+                    raise
+
+        async def index_stage(total):
+            async with embedded_receive:
+                result["chunk_ids"] = await insert_chunks(task, embedded_receive, progress_callback, total)
+
+        async with trio.open_nursery() as nursery:
+            chunk_total = await nursery.start(build_chunks, task, progress_callback, chunk_send, vector_size)
+            if chunk_total:
+                progress_callback(msg="Generate {} chunks".format(chunk_total))
+                nursery.start_soon(embed_stage)
+                nursery.start_soon(index_stage, chunk_total)
+        if not chunk_total:
             progress_callback(1., msg=f"No chunk built from {task_document_name}")
             return
-        # TODO: exception handler
-        ## set_progress(task["did"], -1, "ERROR: ")
-        progress_callback(msg="Generate {} chunks".format(len(chunks)))
-        start_ts = timer()
-        try:
-            token_count, vector_size = await embedding(chunks, embedding_model, task_parser_config, progress_callback)
-        except Exception as e:
-            error_message = "Generate embedding error:{}".format(str(e))
-            progress_callback(-1, error_message)
-            logging.exception(error_message)
-            token_count = 0
-            raise
-        progress_message = "Embedding chunks ({:.2f}s)".format(timer() - start_ts)
+        token_count = result["token_count"]
+        chunk_ids = result["chunk_ids"]
+        progress_message = "Build, embed and index {} chunks ({:.2f}s)".format(chunk_total, timer() - start_ts)
         logging.info(progress_message)
         progress_callback(msg=progress_message)
 
-    chunk_count = len(set([chunk["id"] for chunk in chunks]))
-    start_ts = timer()
-    doc_store_result = ""
-    es_bulk_size = 4
-    for b in range(0, len(chunks), es_bulk_size):
-        doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.insert(chunks[b:b + es_bulk_size], search.index_name(task_tenant_id), task_dataset_id))
-        if b % 128 == 0:
-            progress_callback(prog=0.8 + 0.1 * (b + 1) / len(chunks), msg="")
-        if doc_store_result:
-            error_message = f"Insert chunk error: {doc_store_result}, please check log file and Elasticsearch/Infinity status!"
-            progress_callback(-1, msg=error_message)
-            raise Exception(error_message)
-        chunk_ids = [chunk["id"] for chunk in chunks[:b + es_bulk_size]]
-        chunk_ids_str = " ".join(chunk_ids)
-        try:
-            TaskService.update_chunk_ids(task["id"], chunk_ids_str)
-        except DoesNotExist:
-            logging.warning(f"do_handle_task update_chunk_ids failed since task {task['id']} is unknown.")
-            doc_store_result = await trio.to_thread.run_sync(lambda: settings.docStoreConn.delete({"id": chunk_ids}, search.index_name(task_tenant_id), task_dataset_id))
-            return
+    if chunk_ids is None:
+        return
+    chunk_count = len(set(chunk_ids))
     logging.info("Indexing doc({}), page({}-{}), chunks({}), elapsed: {:.2f}".format(task_document_name, task_from_page,
-                                                                                     task_to_page, len(chunks),
+                                                                                     task_to_page, len(chunk_ids),
                                                                                      timer() - start_ts))
 
     DocumentService.increment_chunk_num(task_doc_id, task_dataset_id, token_count, chunk_count, 0)
@@ -557,15 +927,25 @@ async def do_handle_task(task):
     progress_callback(prog=1.0, msg="Indexing done ({:.2f}s). Task done ({:.2f}s)".format(time_cost, task_time_cost))
     logging.info(
         "Chunk doc({}), page({}-{}), chunks({}), token({}), elapsed:{:.2f}".format(task_document_name, task_from_page,
-                                                                                   task_to_page, len(chunks),
+                                                                                   task_to_page, len(chunk_ids),
                                                                                    token_count, task_time_cost))
 
 
-async def handle_task():
+async def handle_task(redis_msg, task, slot):
+    running = TASK_QUEUE.start(task["tenant_id"])
+    try:
+        await trio.to_thread.run_sync(TASK_QUEUE.publish_running, running)
+        await run_task(redis_msg, task)
+    finally:
+        CURRENT_MSG_IDS.pop(task["id"], None)
+        running = TASK_QUEUE.finish(task["tenant_id"])
+        task_limiter.release_on_behalf_of(slot)
+        await trio.to_thread.run_sync(TASK_QUEUE.publish_running, running)
+
+
+async def run_task(redis_msg, task):
     global DONE_TASKS, FAILED_TASKS
-    redis_msg, task = await collect()
-    if not task:
-        return
+    CURRENT_MSG_IDS[task["id"]] = (redis_msg.get_queue_name(), redis_msg.get_msg_id())
     try:
         logging.info(f"handle_task begin for task {json.dumps(task)}")
         CURRENT_TASKS[task["id"]] = copy.deepcopy(task)
@@ -585,19 +965,36 @@ async def handle_task():
         except Exception:
             pass
         logging.exception(f"handle_task got exception for task {json.dumps(task)}")
+    await trio.to_thread.run_sync(PROGRESS.forget, task["id"])
     redis_msg.ack()
 
 
+async def flush_progress():
+    while True:
+        await trio.sleep(PROGRESS_FLUSH_INTERVAL)
+        try:
+            await trio.to_thread.run_sync(PROGRESS.flush)
+        except Exception:
+            logging.exception("flush_progress got exception")
+
+
 async def report_status():
     global CONSUMER_NAME, BOOT_AT, PENDING_TASKS, LAG_TASKS, DONE_TASKS, FAILED_TASKS
     REDIS_CONN.sadd("TASKEXE", CONSUMER_NAME)
     while True:
         try:
             now = datetime.now()
-            group_info = REDIS_CONN.queue_info(SVR_QUEUE_NAME, "rag_flow_svr_task_broker")
+            # keep the messages being worked on from looking idle to reclaim, and the running counts alive
+            await trio.to_thread.run_sync(TASK_QUEUE.touch, list(CURRENT_MSG_IDS.values()))
+            await trio.to_thread.run_sync(TASK_QUEUE.publish_running, dict(TASK_QUEUE.running))
+            # most tasks sit in the lane streams, the plain SVR_QUEUE_NAME stream only holds older messages
+            lanes = await trio.to_thread.run_sync(TASK_QUEUE.depths)
+            PENDING_TASKS = sum(d["pending"] for d in lanes.values())
+            LAG_TASKS = sum(d["lag"] for d in lanes.values())
+            group_info = REDIS_CONN.queue_info(SVR_QUEUE_NAME, SVR_CONSUMER_GROUP)
             if group_info is not None:
-                PENDING_TASKS = int(group_info.get("pending", 0))
-                LAG_TASKS = int(group_info.get("lag", 0))
+                PENDING_TASKS += int(group_info.get("pending", 0))
+                LAG_TASKS += int(group_info.get("lag") or 0)
 
             current = copy.deepcopy(CURRENT_TASKS)
             heartbeat = json.dumps({
@@ -609,6 +1006,8 @@ async def report_status():
                 "done": DONE_TASKS,
                 "failed": FAILED_TASKS,
                 "current": current,
+                "embedding_cache": EMBEDDING_CACHE.stats(),
+                "lanes": lanes,
             })
             REDIS_CONN.zadd(CONSUMER_NAME, heartbeat, now.timestamp())
             logging.info(f"{CONSUMER_NAME} reported heartbeat: {heartbeat}")
@@ -639,11 +1038,12 @@ async def main():
     if TRACE_MALLOC_ENABLED:
         start_tracemalloc_and_snapshot(None, None)
 
+    global EMBEDDING_NURSERY
     async with trio.open_nursery() as nursery:
+        EMBEDDING_NURSERY = nursery
         nursery.start_soon(report_status)
-        while True:
-            async with task_limiter:
-                nursery.start_soon(handle_task)
+        nursery.start_soon(flush_progress)
+        nursery.start_soon(collect, nursery)
     logging.error("BUG!!! You should not reach here!!!")
 
 if __name__ == "__main__":
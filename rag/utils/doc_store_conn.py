@@ -229,6 +229,13 @@ class DocStoreConnection(ABC):
         """
         raise NotImplementedError("Not implemented")
 
+    @abstractmethod
+    def bulkUpdate(self, newValues: dict[str, dict], indexName: str, knowledgebaseId: str) -> bool:
+        """
+        Update rows by id, newValues maps each row id to its new field values
+        """
+        raise NotImplementedError("Not implemented")
+
     @abstractmethod
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         """
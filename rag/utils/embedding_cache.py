@@ -0,0 +1,164 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import base64
+import logging
+import os
+import re
+import threading
+
+import numpy as np
+import xxhash
+from cachetools import TTLCache
+
+from rag.utils import singleton
+from rag.utils.redis_conn import REDIS_CONN
+
+EMBEDDING_CACHE_ENABLED = int(os.environ.get("EMBEDDING_CACHE_ENABLED", "1"))
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "20000"))
+EMBEDDING_CACHE_TTL = int(os.environ.get("EMBEDDING_CACHE_TTL", str(24 * 3600)))
+# float16 halves the footprint again at the cost of ~3 significant digits per component.
+EMBEDDING_CACHE_DTYPE = os.environ.get("EMBEDDING_CACHE_DTYPE", "float32")
+
+DTYPE_TAGS = {"float32": "f4", "float16": "f2"}
+
+
+@singleton
+class EmbeddingCache:
+    """
+    Content-addressed cache of embedding vectors, keyed by (model, kind, normalized text).
+
+    Vectors live in an in-process LRU with TTL and in Redis as base64-encoded float32/float16
+    buffers, so every process of the deployment shares them. A cached vector whose dimension
+    differs from what the model returns now is treated as a miss.
+    """
+
+    def __init__(self):
+        self.dtype = EMBEDDING_CACHE_DTYPE if EMBEDDING_CACHE_DTYPE in DTYPE_TAGS else "float32"
+        self.local = TTLCache(maxsize=max(EMBEDDING_CACHE_SIZE, 1), ttl=EMBEDDING_CACHE_TTL)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        # vector dimension each model was last seen returning
+        self.dims = {}
+
+    @staticmethod
+    def key(model, text, kind="doc"):
+        hasher = xxhash.xxh128()
+        hasher.update(str(model).encode("utf-8"))
+        hasher.update(b"\0" + kind.encode("utf-8") + b"\0")
+        hasher.update(re.sub(r"\s+", " ", str(text)).strip().encode("utf-8"))
+        return "embd:" + hasher.hexdigest()
+
+    def serialize(self, vector) -> str:
+        buf = np.asarray(vector, dtype=self.dtype).tobytes()
+        return DTYPE_TAGS[self.dtype] + ":" + base64.b64encode(buf).decode("ascii")
+
+    @staticmethod
+    def deserialize(value: str):
+        tag, _, data = value.partition(":")
+        dtype = "float16" if tag == "f2" else "float32"
+        return np.frombuffer(base64.b64decode(data), dtype=dtype).astype(np.float32)
+
+    def get_many(self, model, texts: list, kind="doc") -> list:
+        if not EMBEDDING_CACHE_ENABLED or not texts:
+            return [None] * len(texts)
+        keys = [self.key(model, t, kind) for t in texts]
+        with self.lock:
+            vectors = [self.local.get(k) for k in keys]
+        remote = [i for i, v in enumerate(vectors) if v is None]
+        if remote:
+            values = REDIS_CONN.mget([keys[i] for i in remote])
+            with self.lock:
+                for i, value in zip(remote, values):
+                    if not value:
+                        continue
+                    try:
+                        vectors[i] = self.deserialize(value)
+                    except Exception:
+                        logging.warning(f"EmbeddingCache can't decode {keys[i]}")
+                        continue
+                    self.local[keys[i]] = vectors[i]
+                    self.redis_hits += 1
+        with self.lock:
+            dim = self.dims.get(model)
+            if dim:
+                vectors = [v if v is None or len(v) == dim else None for v in vectors]
+            self.misses += sum([1 for v in vectors if v is None])
+            self.hits += sum([1 for v in vectors if v is not None])
+        return vectors
+
+    def set_many(self, model, texts: list, vectors, kind="doc"):
+        if not EMBEDDING_CACHE_ENABLED or not texts:
+            return
+        mapping = {}
+        with self.lock:
+            if len(vectors):
+                self.dims[model] = len(vectors[0])
+            for t, v in zip(texts, vectors):
+                k = self.key(model, t, kind)
+                v = np.asarray(v, dtype=np.float32)
+                self.local[k] = v
+                mapping[k] = self.serialize(v)
+        REDIS_CONN.set_many(mapping, EMBEDDING_CACHE_TTL)
+
+    def encode(self, model, texts: list, encode_func, kind="doc"):
+        """
+        Return `encode_func(texts)` served from the cache where possible.
+
+        Only the missed texts are passed to `encode_func`, so the returned token count
+        covers the misses only.
+        """
+        vectors = self.get_many(model, texts, kind)
+        missed = [i for i, v in enumerate(vectors) if v is None]
+        used_tokens = 0
+        if missed:
+            vts, used_tokens = encode_func([texts[i] for i in missed])
+            for i, v in zip(missed, vts):
+                vectors[i] = v
+            self.set_many(model, [texts[i] for i in missed], vts, kind)
+            # hits cached before the model changed its dimension
+            stale = [i for i, v in enumerate(vectors) if len(vts) and len(v) != len(vts[0])]
+            if stale:
+                vts, tks = encode_func([texts[i] for i in stale])
+                used_tokens += tks
+                for i, v in zip(stale, vts):
+                    vectors[i] = v
+                self.set_many(model, [texts[i] for i in stale], vts, kind)
+        return np.array(vectors), used_tokens
+
+    def encode_query(self, model, text: str, encode_func):
+        vector = self.get_many(model, [text], "query")[0]
+        if vector is not None:
+            return vector, 0
+        vector, used_tokens = encode_func(text)
+        self.set_many(model, [text], [vector], "query")
+        return vector, used_tokens
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.local),
+                "hits": self.hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+EMBEDDING_CACHE = EmbeddingCache()
@@ -27,6 +27,7 @@ from elastic_transport import ConnectionTimeout
 from rag import settings
 from rag.settings import TAG_FLD, PAGERANK_FLD
 from rag.utils import singleton
+from rag.utils.retrieval_cache import bumps_kb_version
 from api.utils.file_utils import get_project_base_directory
 from rag.utils.doc_store_conn import DocStoreConnection, MatchExpr, OrderByExpr, MatchTextExpr, MatchDenseExpr, \
     FusionExpr
@@ -162,6 +163,9 @@ class ESConnection(DocStoreConnection):
                 continue
             if not v:
                 continue
+            if k == "id":
+                bqry.filter.append(Q("ids", values=v if isinstance(v, list) else [v]))
+                continue
             if isinstance(v, list):
                 bqry.filter.append(Q("terms", **{k: v}))
             elif isinstance(v, str) or isinstance(v, int):
@@ -277,6 +281,7 @@ class ESConnection(DocStoreConnection):
         logger.error("ESConnection.get timeout for 3 times!")
         raise Exception("ESConnection.get timeout.")
 
+    @bumps_kb_version
     def insert(self, documents: list[dict], indexName: str, knowledgebaseId: str = None) -> list[str]:
         # Refers to https://www.elastic.co/guide/en/elasticsearch/reference/current/docs-bulk.html
         operations = []
@@ -313,6 +318,7 @@ class ESConnection(DocStoreConnection):
                     continue
         return res
 
+    @bumps_kb_version
     def update(self, condition: dict, newValue: dict, indexName: str, knowledgebaseId: str) -> bool:
         doc = copy.deepcopy(newValue)
         doc.pop("id", None)
@@ -396,6 +402,39 @@ class ESConnection(DocStoreConnection):
                 break
         return False
 
+    @bumps_kb_version
+    def bulkUpdate(self, newValues: dict[str, dict], indexName: str, knowledgebaseId: str) -> bool:
+        ok = True
+        items = list(newValues.items())
+        bs = 1024
+        for i in range(0, len(items), bs):
+            operations = []
+            for chunkId, newValue in items[i:i + bs]:
+                doc = copy.deepcopy(newValue)
+                doc.pop("id", None)
+                operations.append({"update": {"_index": indexName, "_id": chunkId}})
+                operations.append({"doc": doc})
+            for _ in range(ATTEMPT_TIME):
+                try:
+                    r = self.es.bulk(index=indexName, operations=operations, refresh=False, timeout="60s")
+                    if r["errors"]:
+                        ok = False
+                        for item in r["items"]:
+                            if "error" in item["update"]:
+                                logger.warning(f"ESConnection.bulkUpdate {item['update']['_id']}: {item['update']['error']}")
+                    break
+                except Exception as e:
+                    logger.warning("ESConnection.bulkUpdate got exception: " + str(e))
+                    if re.search(r"(Timeout|time out|connection)", str(e), re.IGNORECASE):
+                        time.sleep(3)
+                        continue
+                    ok = False
+                    break
+            else:
+                ok = False
+        return ok
+
+    @bumps_kb_version
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         qry = None
         assert "_id" not in condition
@@ -415,6 +454,8 @@ class ESConnection(DocStoreConnection):
                         for kk, vv in v.items():
                             if kk == "exists":
                                 qry.must_not.append(Q("exists", field=vv))
+                            elif kk == "id" and vv:
+                                qry.must_not.append(Q("ids", values=vv if isinstance(vv, list) else [vv]))
 
                 elif isinstance(v, list):
                     qry.must.append(Q("terms", **{k: v}))
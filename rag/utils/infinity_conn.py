@@ -28,6 +28,7 @@ from infinity.errors import ErrorCode
 from rag import settings
 from rag.settings import PAGERANK_FLD
 from rag.utils import singleton
+from rag.utils.retrieval_cache import bumps_kb_version
 import pandas as pd
 from api.utils.file_utils import get_project_base_directory
 
@@ -43,6 +44,33 @@ from rag.utils.doc_store_conn import (
 logger = logging.getLogger('ragflow.infinity_conn')
 
 
+def equivalent_new_value(newValue: dict) -> dict:
+    """Convert the field values of an update to their column representation, in place."""
+    for k, v in list(newValue.items()):
+        if k in ["important_kwd", "question_kwd", "entities_kwd", "tag_kwd", "source_id"]:
+            assert isinstance(v, list)
+            newValue[k] = "###".join(v)
+        elif re.search(r"_feas$", k):
+            newValue[k] = json.dumps(v)
+        elif k.endswith("_kwd") and isinstance(v, list):
+            newValue[k] = " ".join(v)
+        elif k == 'kb_id':
+            if isinstance(newValue[k], list):
+                newValue[k] = newValue[k][0]  # since d[k] is a list, but we need a str
+        elif k == "position_int":
+            assert isinstance(v, list)
+            arr = [num for row in v for num in row]
+            newValue[k] = "_".join(f"{num:08x}" for num in arr)
+        elif k in ["page_num_int", "top_int"]:
+            assert isinstance(v, list)
+            newValue[k] = "_".join(f"{num:08x}" for num in v)
+        elif k == "remove":
+            del newValue[k]
+            if v in [PAGERANK_FLD]:
+                newValue[v] = 0
+    return newValue
+
+
 def equivalent_condition_to_str(condition: dict, table_instance=None) -> str | None:
     assert "_id" not in condition
     clmns = {}
@@ -80,6 +108,9 @@ def equivalent_condition_to_str(condition: dict, table_instance=None) -> str | N
                 for kk, vv in v.items():
                     if kk == "exists":
                         cond.append("NOT (%s)" % exists(vv))
+                    elif kk == "id" and vv:
+                        ids = ", ".join(f"'{id}'" for id in (vv if isinstance(vv, list) else [vv]))
+                        cond.append(f"id NOT IN ({ids})")
         elif isinstance(v, str):
             cond.append(f"{k}='{v}'")
         elif k == "exists":
@@ -442,6 +473,7 @@ class InfinityConnection(DocStoreConnection):
         res_fields = self.getFields(res, res.columns.tolist())
         return res_fields.get(chunkId, None)
 
+    @bumps_kb_version
     def insert(
             self, documents: list[dict], indexName: str, knowledgebaseId: str = None
     ) -> list[str]:
@@ -512,6 +544,7 @@ class InfinityConnection(DocStoreConnection):
         logger.debug(f"INFINITY inserted into {table_name} {str_ids}.")
         return []
 
+    @bumps_kb_version
     def update(
             self, condition: dict, newValue: dict, indexName: str, knowledgebaseId: str
     ) -> bool:
@@ -524,34 +557,27 @@ class InfinityConnection(DocStoreConnection):
         #if "exists" in condition:
         #    del condition["exists"]
         filter = equivalent_condition_to_str(condition, table_instance)
-        for k, v in list(newValue.items()):
-            if k in ["important_kwd", "question_kwd", "entities_kwd", "tag_kwd", "source_id"]:
-                assert isinstance(v, list)
-                newValue[k] = "###".join(v)
-            elif re.search(r"_feas$", k):
-                newValue[k] = json.dumps(v)
-            elif k.endswith("_kwd") and isinstance(v, list):
-                newValue[k] = " ".join(v)
-            elif k == 'kb_id':
-                if isinstance(newValue[k], list):
-                    newValue[k] = newValue[k][0]  # since d[k] is a list, but we need a str
-            elif k == "position_int":
-                assert isinstance(v, list)
-                arr = [num for row in v for num in row]
-                newValue[k] = "_".join(f"{num:08x}" for num in arr)
-            elif k in ["page_num_int", "top_int"]:
-                assert isinstance(v, list)
-                newValue[k] = "_".join(f"{num:08x}" for num in v)
-            elif k == "remove":
-                del newValue[k]
-                if v in [PAGERANK_FLD]:
-                    newValue[v] = 0
+        equivalent_new_value(newValue)
 
         logger.debug(f"INFINITY update table {table_name}, filter {filter}, newValue {newValue}.")
         table_instance.update(filter, newValue)
         self.connPool.release_conn(inf_conn)
         return True
 
+    @bumps_kb_version
+    def bulkUpdate(self, newValues: dict[str, dict], indexName: str, knowledgebaseId: str) -> bool:
+        inf_conn = self.connPool.get_conn()
+        db_instance = inf_conn.get_database(self.dbName)
+        table_name = f"{indexName}_{knowledgebaseId}"
+        table_instance = db_instance.get_table(table_name)
+        for chunkId, newValue in newValues.items():
+            newValue = equivalent_new_value({k: v for k, v in newValue.items() if k != "id"})
+            table_instance.update(f"id = '{chunkId}'", newValue)
+        self.connPool.release_conn(inf_conn)
+        logger.debug(f"INFINITY updated {len(newValues)} rows of table {table_name}.")
+        return True
+
+    @bumps_kb_version
     def delete(self, condition: dict, indexName: str, knowledgebaseId: str) -> int:
         inf_conn = self.connPool.get_conn()
         db_instance = inf_conn.get_database(self.dbName)
@@ -93,6 +93,18 @@ class RAGFlowMinio:
                 time.sleep(1)
         return
 
+    def get_size(self, bucket, filename):
+        return self.conn.stat_object(bucket, filename).size
+
+    def get_range(self, bucket, filename, offset, length):
+        """Read `length` bytes of the object from `offset`, without fetching the rest of it."""
+        r = self.conn.get_object(bucket, filename, offset=offset, length=length)
+        try:
+            return r.read()
+        finally:
+            r.close()
+            r.release_conn()
+
     def obj_exist(self, bucket, filename):
         try:
             if not self.conn.bucket_exists(bucket):
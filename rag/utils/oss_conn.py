@@ -143,6 +143,18 @@ class RAGFlowOSS:
                 time.sleep(1)
         return
 
+    @use_prefix_path
+    @use_default_bucket
+    def get_size(self, bucket, fnm):
+        return self.conn.head_object(Bucket=bucket, Key=fnm)['ContentLength']
+
+    @use_prefix_path
+    @use_default_bucket
+    def get_range(self, bucket, fnm, offset, length):
+        """Read `length` bytes of the object from `offset`, without fetching the rest of it."""
+        r = self.conn.get_object(Bucket=bucket, Key=fnm, Range=f"bytes={offset}-{offset + length - 1}")
+        return r['Body'].read()
+
     @use_prefix_path
     @use_default_bucket
     def obj_exist(self, bucket, fnm):
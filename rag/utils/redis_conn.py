@@ -24,16 +24,19 @@ from rag.utils import singleton
 from valkey.lock import Lock
 
 class RedisMsg:
-    def __init__(self, consumer, queue_name, group_name, msg_id, message):
+    def __init__(self, consumer, queue_name, group_name, msg_id, message, delete_on_ack=False):
         self.__consumer = consumer
         self.__queue_name = queue_name
         self.__group_name = group_name
         self.__msg_id = msg_id
         self.__message = json.loads(message["message"])
+        self.__delete_on_ack = delete_on_ack
 
     def ack(self):
         try:
             self.__consumer.xack(self.__queue_name, self.__group_name, self.__msg_id)
+            if self.__delete_on_ack:
+                self.__consumer.xdel(self.__queue_name, self.__msg_id)
             return True
         except Exception as e:
             logging.warning("[EXCEPTION]ack" + str(self.__queue_name) + "||" + str(e))
@@ -45,12 +48,16 @@ class RedisMsg:
     def get_msg_id(self):
         return self.__msg_id
 
+    def get_queue_name(self):
+        return self.__queue_name
+
 
 @singleton
 class RedisDB:
     def __init__(self):
         self.REDIS = None
         self.config = settings.REDIS
+        self.groups = set()
         self.__open__()
 
     def __open__(self):
@@ -113,6 +120,50 @@ class RedisDB:
             self.__open__()
         return False
 
+    def delete(self, k):
+        try:
+            self.REDIS.delete(k)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.delete " + str(k) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def incr(self, k, exp=3600):
+        try:
+            pipeline = self.REDIS.pipeline(transaction=True)
+            pipeline.incr(k)
+            pipeline.expire(k, exp)
+            return pipeline.execute()[0]
+        except Exception as e:
+            logging.warning("RedisDB.incr " + str(k) + " got exception: " + str(e))
+            self.__open__()
+        return None
+
+    def mget(self, keys: list[str]):
+        if not self.REDIS or not keys:
+            return [None] * len(keys)
+        try:
+            return self.REDIS.mget(keys)
+        except Exception as e:
+            logging.warning("RedisDB.mget got exception: " + str(e))
+            self.__open__()
+        return [None] * len(keys)
+
+    def set_many(self, mapping: dict, exp=3600):
+        if not mapping:
+            return True
+        try:
+            pipeline = self.REDIS.pipeline(transaction=False)
+            for k, v in mapping.items():
+                pipeline.set(k, v, exp)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.set_many got exception: " + str(e))
+            self.__open__()
+        return False
+
     def sadd(self, key: str, member: str):
         try:
             self.REDIS.sadd(key, member)
@@ -122,6 +173,25 @@ class RedisDB:
             self.__open__()
         return False
 
+    def sadd_many(self, key: str, members: list):
+        if not members:
+            return True
+        try:
+            self.REDIS.sadd(key, *members)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.sadd_many " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def spop(self, key: str, count: int):
+        try:
+            return self.REDIS.spop(key, count) or []
+        except Exception as e:
+            logging.warning("RedisDB.spop " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return []
+
     def srem(self, key: str, member: str):
         try:
             self.REDIS.srem(key, member)
@@ -131,6 +201,17 @@ class RedisDB:
             self.__open__()
         return False
 
+    def srem_many(self, key: str, members: list):
+        if not members:
+            return True
+        try:
+            self.REDIS.srem(key, *members)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.srem_many " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
     def smembers(self, key: str):
         try:
             res = self.REDIS.smembers(key)
@@ -142,6 +223,39 @@ class RedisDB:
             self.__open__()
         return None
 
+    def hgetall(self, key: str):
+        try:
+            return self.REDIS.hgetall(key)
+        except Exception as e:
+            logging.warning("RedisDB.hgetall " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return None
+
+    def hset_many(self, key: str, mapping: dict, exp=3600):
+        if not mapping:
+            return True
+        try:
+            pipeline = self.REDIS.pipeline(transaction=False)
+            pipeline.hset(key, mapping=mapping)
+            pipeline.expire(key, exp)
+            pipeline.execute()
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.hset_many " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
+    def hdel_many(self, key: str, fields: list):
+        if not fields:
+            return True
+        try:
+            self.REDIS.hdel(key, *fields)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.hdel_many " + str(key) + " got exception: " + str(e))
+            self.__open__()
+        return False
+
     def zadd(self, key: str, member: str, score: float):
         try:
             self.REDIS.zadd(key, {member: score})
@@ -208,39 +322,110 @@ class RedisDB:
                 )
         return False
 
+    def ensure_group(self, queue_name, group_name):
+        """Create the consumer group (and stream) once per process instead of checking it on every read."""
+        if (queue_name, group_name) in self.groups:
+            return
+        try:
+            self.REDIS.xgroup_create(queue_name, group_name, id="0", mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self.groups.add((queue_name, group_name))
+
+    def to_msgs(self, queue_name, group_name, element_list, delete_on_ack=False) -> list[RedisMsg]:
+        msgs = []
+        for msg_id, payload in element_list:
+            if not payload or "message" not in payload:
+                # the entry was trimmed from the stream while pending
+                self.REDIS.xack(queue_name, group_name, msg_id)
+                continue
+            msgs.append(RedisMsg(self.REDIS, queue_name, group_name, msg_id, payload, delete_on_ack))
+        return msgs
+
+    def queue_consumer_batch(self, queue_name, group_name, consumer_name, count=1, msg_id=">", block=5, delete_on_ack=False) -> list[RedisMsg]:
+        """
+        Read up to `count` messages in one XREADGROUP, blocking up to `block` ms for new ones (None: no wait).
+        `msg_id` other than ">" re-reads this consumer's own pending messages after that id.
+        With `delete_on_ack` acked messages are removed from the stream, so its length is its backlog.
+        https://redis.io/docs/latest/commands/xreadgroup/
+        """
+        try:
+            self.ensure_group(queue_name, group_name)
+            messages = self.REDIS.xreadgroup(group_name, consumer_name, {queue_name: msg_id}, count=count, block=block)
+            if not messages:
+                return []
+            _, element_list = messages[0]
+            return self.to_msgs(queue_name, group_name, element_list, delete_on_ack)
+        except Exception as e:
+            if "NOGROUP" in str(e):
+                self.groups.discard((queue_name, group_name))
+            elif "key" not in str(e):
+                logging.exception("RedisDB.queue_consumer_batch " + str(queue_name) + " got exception: " + str(e))
+                self.__open__()
+        return []
+
+    def queue_consumer_streams(self, queues: dict, group_name, consumer_name, count=1) -> list[RedisMsg]:
+        """
+        Read up to `count` new messages from each stream of `queues` in one XREADGROUP, without waiting.
+        `queues` maps each stream to whether its messages are deleted once acked.
+        """
+        if not queues:
+            return []
+        for _ in range(2):
+            try:
+                for queue_name in queues:
+                    self.ensure_group(queue_name, group_name)
+                messages = self.REDIS.xreadgroup(group_name, consumer_name, {q: ">" for q in queues}, count=count, block=None)
+                msgs = []
+                for queue_name, element_list in messages or []:
+                    msgs.extend(self.to_msgs(queue_name, group_name, element_list, queues[queue_name]))
+                return msgs
+            except Exception as e:
+                if "NOGROUP" not in str(e):
+                    logging.exception("RedisDB.queue_consumer_streams got exception: " + str(e))
+                    self.__open__()
+                    return []
+                # a drained stream was deleted and queued to again, without the group
+                for queue_name in queues:
+                    self.groups.discard((queue_name, group_name))
+        return []
+
     def queue_consumer(self, queue_name, group_name, consumer_name, msg_id=b">") -> RedisMsg:
         """https://redis.io/docs/latest/commands/xreadgroup/"""
+        msgs = self.queue_consumer_batch(queue_name, group_name, consumer_name, 1, msg_id)
+        return msgs[0] if msgs else None
+
+    def queue_autoclaim(self, queue_name, group_name, consumer_name, min_idle_ms, count=1, delete_on_ack=False) -> list[RedisMsg]:
+        """
+        Take over up to `count` messages that have been pending on any consumer for more than
+        `min_idle_ms`. Live consumers refresh their in-flight messages with queue_touch, so only
+        messages of dead consumers get this idle.
+        https://redis.io/docs/latest/commands/xautoclaim/
+        """
         try:
-            group_info = self.REDIS.xinfo_groups(queue_name)
-            if not any(e["name"] == group_name for e in group_info):
-                self.REDIS.xgroup_create(queue_name, group_name, id="0", mkstream=True)
-            args = {
-                "groupname": group_name,
-                "consumername": consumer_name,
-                "count": 1,
-                "block": 5,
-                "streams": {queue_name: msg_id},
-            }
-            messages = self.REDIS.xreadgroup(**args)
-            if not messages:
-                return None
-            stream, element_list = messages[0]
-            if not element_list:
-                return None
-            msg_id, payload = element_list[0]
-            res = RedisMsg(self.REDIS, queue_name, group_name, msg_id, payload)
-            return res
+            res = self.REDIS.xautoclaim(queue_name, group_name, consumer_name, min_idle_ms, start_id="0-0", count=count)
+            msgs = self.to_msgs(queue_name, group_name, [e for e in res[1] if e], delete_on_ack)
+            for msg in msgs:
+                logging.info(f"RedisDB.queue_autoclaim {consumer_name} claimed msg_id {msg.get_msg_id()}")
+            return msgs
         except Exception as e:
-            if "key" in str(e):
-                pass
-            else:
-                logging.exception(
-                    "RedisDB.queue_consumer "
-                    + str(queue_name)
-                    + " got exception: "
-                    + str(e)
-                )
-        return None
+            if "key" not in str(e) and "NOGROUP" not in str(e):
+                logging.exception("RedisDB.queue_autoclaim " + str(queue_name) + " got exception: " + str(e))
+                self.__open__()
+        return []
+
+    def queue_touch(self, queue_name, group_name, consumer_name, msg_ids):
+        """Reset the idle time of messages this consumer is still working on, so they are not reclaimed."""
+        if not msg_ids:
+            return True
+        try:
+            self.REDIS.xclaim(queue_name, group_name, consumer_name, 0, msg_ids, justid=True)
+            return True
+        except Exception as e:
+            logging.warning("RedisDB.queue_touch " + str(queue_name) + " got exception: " + str(e))
+            self.__open__()
+        return False
 
     def get_unacked_iterator(self, queue_name, group_name, consumer_name):
         try:
@@ -263,6 +448,79 @@ class RedisDB:
             )
             self.__open__()
 
+    def queue_len(self, queue) -> int:
+        try:
+            return self.REDIS.xlen(queue)
+        except Exception as e:
+            logging.warning("RedisDB.queue_len " + str(queue) + " got exception: " + str(e))
+            self.__open__()
+        return 0
+
+    def queue_lens(self, queues: list[str]) -> list[int]:
+        if not queues:
+            return []
+        try:
+            pipeline = self.REDIS.pipeline(transaction=False)
+            for queue in queues:
+                pipeline.xlen(queue)
+            return pipeline.execute()
+        except Exception as e:
+            logging.warning("RedisDB.queue_lens got exception: " + str(e))
+            self.__open__()
+        return [0] * len(queues)
+
+    def queue_delete_empty(self, queues: list[str]) -> list[str]:
+        """Delete the streams of `queues` holding no message, atomically against producers. Return the deleted ones."""
+        if not queues:
+            return []
+        script = "if redis.call('XLEN', KEYS[1]) == 0 then return redis.call('DEL', KEYS[1]) end return 0"
+        try:
+            pipeline = self.REDIS.pipeline(transaction=False)
+            for queue in queues:
+                pipeline.eval(script, 1, queue)
+            deleted = [q for q, n in zip(queues, pipeline.execute()) if n]
+        except Exception as e:
+            logging.warning("RedisDB.queue_delete_empty got exception: " + str(e))
+            self.__open__()
+            return []
+        # their consumer groups went with them
+        self.groups = set([g for g in self.groups if g[0] not in deleted])
+        return deleted
+
+    def queue_with_pending(self, queues: list[str], group_name, consumer_name=None, min_idle_ms=None) -> list[str]:
+        """
+        The streams of `queues` with pending messages, of `consumer_name` only if given and idle for
+        more than `min_idle_ms` if given, found in one round trip.
+        """
+        if not queues:
+            return []
+        try:
+            pipeline = self.REDIS.pipeline(transaction=False)
+            for queue in queues:
+                pipeline.xpending_range(queue, group_name, min="-", max="+", count=1, consumername=consumer_name, idle=min_idle_ms)
+            # streams without the group yet answer with an error
+            res = pipeline.execute(raise_on_error=False)
+            return [q for q, r in zip(queues, res) if r and not isinstance(r, Exception)]
+        except Exception as e:
+            logging.warning("RedisDB.queue_with_pending got exception: " + str(e))
+            self.__open__()
+        return []
+
+    def queue_infos(self, queues: list[str], group_name) -> list[dict | None]:
+        """The `group_name` group info of each of `queues`, None where the stream or group is missing."""
+        if not queues:
+            return []
+        try:
+            pipeline = self.REDIS.pipeline(transaction=False)
+            for queue in queues:
+                pipeline.xinfo_groups(queue)
+            res = pipeline.execute(raise_on_error=False)
+            return [next((g for g in r if g["name"] == group_name), None) if isinstance(r, list) else None for r in res]
+        except Exception as e:
+            logging.warning("RedisDB.queue_infos got exception: " + str(e))
+            self.__open__()
+        return [None] * len(queues)
+
     def queue_info(self, queue, group_name) -> dict | None:
         try:
             groups = self.REDIS.xinfo_groups(queue)
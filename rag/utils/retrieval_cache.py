@@ -0,0 +1,190 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import atexit
+import functools
+import inspect
+import json
+import os
+import re
+import threading
+import time
+
+import xxhash
+from cachetools import TTLCache
+
+from rag.utils import singleton
+from rag.utils.redis_conn import REDIS_CONN
+
+RETRIEVAL_CACHE_ENABLED = int(os.environ.get("RETRIEVAL_CACHE_ENABLED", "1"))
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RETRIEVAL_CACHE_SIZE", "2048"))
+RETRIEVAL_CACHE_TTL = int(os.environ.get("RETRIEVAL_CACHE_TTL", "600"))
+# Results computed this soon after a write are not cached, the doc store may not have refreshed yet.
+RETRIEVAL_CACHE_SETTLE = float(os.environ.get("RETRIEVAL_CACHE_SETTLE", "2"))
+
+# Version bumps are written to Redis in one pipeline at most this many seconds after the write.
+KB_VERSION_FLUSH_INTERVAL = float(os.environ.get("KB_VERSION_FLUSH_INTERVAL", "0.2"))
+
+KB_VERSION_PREFIX = "rag_flow_kb_chunks_version"
+KB_VERSION_TTL = 30 * 24 * 3600
+
+PENDING_KB_VERSIONS = {}
+PENDING_KB_VERSIONS_LOCK = threading.Lock()
+PENDING_KB_VERSIONS_EVENT = threading.Event()
+PENDING_KB_VERSIONS_FLUSHER = None
+
+
+def kb_version_key(index_name, kb_id=None):
+    # writes without a knowledge base are versioned per index
+    return f"{KB_VERSION_PREFIX}:{kb_id}" if kb_id else f"{KB_VERSION_PREFIX}:{index_name}"
+
+
+def bump_kb_version(index_name, kb_id=None):
+    """
+    Mark the chunks of the index, and of `kb_id` if given, as changed. Versions are write timestamps
+    in microseconds; they are queued here and written to Redis by a background thread.
+    """
+    global PENDING_KB_VERSIONS_FLUSHER
+    version = str(int(time.time() * 1e6))
+    with PENDING_KB_VERSIONS_LOCK:
+        PENDING_KB_VERSIONS[kb_version_key(index_name)] = version
+        if kb_id:
+            PENDING_KB_VERSIONS[kb_version_key(index_name, kb_id)] = version
+        if PENDING_KB_VERSIONS_FLUSHER is None:
+            PENDING_KB_VERSIONS_FLUSHER = threading.Thread(target=flush_kb_versions_loop, daemon=True)
+            PENDING_KB_VERSIONS_FLUSHER.start()
+            atexit.register(flush_kb_versions)
+    PENDING_KB_VERSIONS_EVENT.set()
+
+
+def flush_kb_versions():
+    with PENDING_KB_VERSIONS_LOCK:
+        pending = dict(PENDING_KB_VERSIONS)
+        PENDING_KB_VERSIONS.clear()
+    if pending and not REDIS_CONN.set_many(pending, KB_VERSION_TTL):
+        # keep them for the next flush unless bumped again meanwhile
+        with PENDING_KB_VERSIONS_LOCK:
+            for k, v in pending.items():
+                PENDING_KB_VERSIONS.setdefault(k, v)
+        PENDING_KB_VERSIONS_EVENT.set()
+
+
+def flush_kb_versions_loop():
+    while True:
+        PENDING_KB_VERSIONS_EVENT.wait()
+        PENDING_KB_VERSIONS_EVENT.clear()
+        # let the bumps of a burst of writes coalesce into one pipeline
+        time.sleep(KB_VERSION_FLUSH_INTERVAL)
+        flush_kb_versions()
+
+
+def pending_kb_version(key):
+    with PENDING_KB_VERSIONS_LOCK:
+        return PENDING_KB_VERSIONS.get(key)
+
+
+def bumps_kb_version(func):
+    """Decorate the insert/update/delete methods of a DocStoreConnection to bump the version of the written KB once done."""
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            bump_kb_version(bound.arguments["indexName"], bound.arguments.get("knowledgebaseId"))
+
+    return wrapper
+
+
+@singleton
+class RetrievalCache:
+    """
+    Cache of ranked retrieval results, keyed by the normalized question and every parameter that
+    shapes the ranking.
+
+    Only chunk ids and scores are kept. Each entry remembers the versions of the knowledge bases and
+    indices it was computed from, and is dropped on lookup once any of them was written to since.
+    """
+
+    def __init__(self):
+        self.local = TTLCache(maxsize=max(RETRIEVAL_CACHE_SIZE, 1), ttl=RETRIEVAL_CACHE_TTL)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    @staticmethod
+    def key(question, params: dict) -> str:
+        hasher = xxhash.xxh128()
+        hasher.update(re.sub(r"\s+", " ", str(question)).strip().lower().encode("utf-8"))
+        hasher.update(b"\0" + json.dumps(params, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+        return hasher.hexdigest()
+
+    @staticmethod
+    def versions(index_names: list[str], kb_ids: list[str]) -> list:
+        keys = [kb_version_key(i) for i in index_names] + [kb_version_key(None, kb_id) for kb_id in kb_ids or []]
+        versions = REDIS_CONN.mget(keys)
+        # bumps of this process not flushed yet
+        for i, k in enumerate(keys):
+            pending = pending_kb_version(k)
+            if pending and (not versions[i] or int(pending) > int(versions[i])):
+                versions[i] = pending
+        return versions
+
+    def get(self, key, versions):
+        if not RETRIEVAL_CACHE_ENABLED:
+            return None
+        with self.lock:
+            entry = self.local.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] != versions:
+                self.local.pop(key, None)
+                self.stale += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, versions, value):
+        if not RETRIEVAL_CACHE_ENABLED:
+            return
+        latest = max([int(v) for v in versions if v] or [0])
+        if time.time() - latest / 1e6 < RETRIEVAL_CACHE_SETTLE:
+            return
+        with self.lock:
+            self.local[key] = (versions, value)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.local.pop(key, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.local),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+RETRIEVAL_CACHE = RetrievalCache()
@@ -112,6 +112,14 @@ class RAGFlowS3:
                 time.sleep(1)
         return
 
+    def get_size(self, bucket, fnm):
+        return self.conn.head_object(Bucket=bucket, Key=fnm)['ContentLength']
+
+    def get_range(self, bucket, fnm, offset, length):
+        """Read `length` bytes of the object from `offset`, without fetching the rest of it."""
+        r = self.conn.get_object(Bucket=bucket, Key=fnm, Range=f"bytes={offset}-{offset + length - 1}")
+        return r['Body'].read()
+
     def obj_exist(self, bucket, fnm):
         try:
 
@@ -0,0 +1,215 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import json
+import os
+from collections import Counter
+
+from rag.settings import SVR_QUEUE_NAME
+from rag.utils.redis_conn import REDIS_CONN
+
+SVR_CONSUMER_GROUP = "rag_flow_svr_task_broker"
+# Redis set of the names of live task executors.
+EXECUTORS_KEY = "TASKEXE"
+
+LANE_INTERACTIVE = "interactive"
+LANE_BULK = "bulk"
+LANE_BACKGROUND = "background"
+LANE_WEIGHTS = {
+    LANE_INTERACTIVE: int(os.environ.get("TASK_LANE_WEIGHT_INTERACTIVE", "6")),
+    LANE_BULK: int(os.environ.get("TASK_LANE_WEIGHT_BULK", "3")),
+    LANE_BACKGROUND: int(os.environ.get("TASK_LANE_WEIGHT_BACKGROUND", "1")),
+}
+# Documents split into more tasks than this are queued on the bulk lane.
+TASK_BULK_THRESHOLD = int(os.environ.get("TASK_BULK_THRESHOLD", "8"))
+# Tasks of one tenant running at once across all executors, 0 for no cap.
+TENANT_MAX_RUNNING_TASKS = int(os.environ.get("TENANT_MAX_RUNNING_TASKS", "8"))
+# Executors refresh their running counts with every heartbeat, so a dead executor's expire.
+RUNNING_TTL = 90
+
+
+def lane_stream(lane, tenant_id):
+    return f"{SVR_QUEUE_NAME}:{lane}:{tenant_id}"
+
+
+def lane_tenants(lane):
+    return f"{SVR_QUEUE_NAME}:{lane}:tenants"
+
+
+def running_key(consumer_name):
+    return f"{SVR_QUEUE_NAME}:running:{consumer_name}"
+
+
+def queue_task(task: dict, tenant_id: str, lane=LANE_INTERACTIVE) -> bool:
+    """Queue `task` on the stream of `tenant_id` in `lane`."""
+    if not REDIS_CONN.queue_product(lane_stream(lane, tenant_id), message=task):
+        return False
+    # the tenant is registered after its message is added, see TaskQueue.retire
+    return REDIS_CONN.sadd(lane_tenants(lane), tenant_id)
+
+
+class TaskQueue:
+    """
+    Consumer side of the task queue for one executor.
+
+    Every (lane, tenant) pair has its own stream. Each read favors lanes by smooth weighted
+    round robin over LANE_WEIGHTS, so bulk and background work keeps a share without starving
+    interactive uploads, and rotates over the tenants of a lane, skipping those that already run
+    TENANT_MAX_RUNNING_TASKS tasks across the cluster. The cap is soft: executors reading at the
+    same moment may overshoot it by a batch. Messages queued on the plain SVR_QUEUE_NAME stream
+    before lanes existed are still consumed.
+
+    The streams of a lane are read with a single XREADGROUP and drained streams are deleted, so
+    the Redis round trips of a read do not grow with the number of tenants.
+    """
+
+    def __init__(self, consumer_name):
+        self.consumer_name = consumer_name
+        self.credits = {lane: 0 for lane in LANE_WEIGHTS}
+        self.cursor = Counter()
+        self.running = Counter()
+        self.pending = None
+
+    def lanes(self):
+        total = sum(LANE_WEIGHTS.values())
+        for lane, weight in LANE_WEIGHTS.items():
+            self.credits[lane] += weight
+        first = max(self.credits, key=lambda lane: self.credits[lane])
+        self.credits[first] -= total
+        return [first] + [lane for lane in LANE_WEIGHTS if lane != first]
+
+    def tenants(self, lane):
+        return sorted(REDIS_CONN.smembers(lane_tenants(lane)) or [])
+
+    def streams(self):
+        """(stream, delete_on_ack) of every stream that may hold messages."""
+        return [(SVR_QUEUE_NAME, False)] + [(lane_stream(lane, t), True) for lane in LANE_WEIGHTS for t in self.tenants(lane)]
+
+    def running_by_tenant(self) -> Counter:
+        consumers = sorted(REDIS_CONN.smembers(EXECUTORS_KEY) or [])
+        running = Counter()
+        for value in REDIS_CONN.mget([running_key(c) for c in consumers]):
+            if value:
+                running.update(json.loads(value))
+        return running
+
+    def read(self, count):
+        """Read up to `count` new messages."""
+        msgs = []
+        running = None
+        for lane in self.lanes():
+            tenants = self.tenants(lane)
+            if not tenants or len(msgs) >= count:
+                continue
+            if running is None and TENANT_MAX_RUNNING_TASKS > 0:
+                running = self.running_by_tenant()
+            start = self.cursor[lane] % len(tenants)
+            self.cursor[lane] += 1
+            tenants = tenants[start:] + tenants[:start]
+            if running is not None:
+                tenants = [t for t in tenants if running[t] < TENANT_MAX_RUNNING_TASKS]
+            if not tenants:
+                continue
+            # the same count applies to every stream of one XREADGROUP
+            n = count - len(msgs)
+            share = max(1, n // len(tenants))
+            tenants = tenants[:n // share]
+            got = REDIS_CONN.queue_consumer_streams({lane_stream(lane, t): True for t in tenants}, SVR_CONSUMER_GROUP, self.consumer_name, share)
+            served = Counter([m.get_queue_name() for m in got])
+            self.retire(lane, [t for t in tenants if not served[lane_stream(lane, t)]])
+            if running is not None:
+                for t in tenants:
+                    running[t] += served[lane_stream(lane, t)]
+            msgs.extend(got)
+        if len(msgs) < count:
+            msgs.extend(REDIS_CONN.queue_consumer_batch(SVR_QUEUE_NAME, SVR_CONSUMER_GROUP, self.consumer_name, count - len(msgs), ">", None))
+        return msgs
+
+    def retire(self, lane, tenant_ids):
+        """Delete the drained streams of `tenant_ids` and drop them from their lane, re-adding those a producer raced."""
+        drained = REDIS_CONN.queue_delete_empty([lane_stream(lane, t) for t in tenant_ids])
+        if not drained:
+            return
+        drained = [t for t in tenant_ids if lane_stream(lane, t) in drained]
+        REDIS_CONN.srem_many(lane_tenants(lane), drained)
+        raced = [t for t, n in zip(drained, REDIS_CONN.queue_lens([lane_stream(lane, t) for t in drained])) if n]
+        if raced:
+            REDIS_CONN.sadd_many(lane_tenants(lane), raced)
+
+    def read_pending(self, count):
+        """This executor's own pending messages, e.g. after a restart. Empty once all were re-read."""
+        if self.pending is None:
+            streams = dict(self.streams())
+            self.pending = [[stream, streams[stream], "0"] for stream in
+                            REDIS_CONN.queue_with_pending(list(streams), SVR_CONSUMER_GROUP, self.consumer_name)]
+        while self.pending:
+            stream, delete_on_ack, last_id = self.pending[0]
+            msgs = REDIS_CONN.queue_consumer_batch(stream, SVR_CONSUMER_GROUP, self.consumer_name, count, last_id, None, delete_on_ack)
+            if msgs:
+                self.pending[0][2] = msgs[-1].get_msg_id()
+                return msgs
+            self.pending.pop(0)
+        return []
+
+    def reclaim(self, count, min_idle_ms):
+        """Take over messages left pending on dead executors."""
+        streams = dict(self.streams())
+        for stream in REDIS_CONN.queue_with_pending(list(streams), SVR_CONSUMER_GROUP, min_idle_ms=min_idle_ms):
+            msgs = REDIS_CONN.queue_autoclaim(stream, SVR_CONSUMER_GROUP, self.consumer_name, min_idle_ms, count, streams[stream])
+            if msgs:
+                return msgs
+        return []
+
+    def touch(self, msgs):
+        """Keep the (stream, msg_id) messages being worked on from looking idle to reclaim."""
+        by_stream = {}
+        for stream, msg_id in msgs:
+            by_stream.setdefault(stream, []).append(msg_id)
+        for stream, msg_ids in by_stream.items():
+            REDIS_CONN.queue_touch(stream, SVR_CONSUMER_GROUP, self.consumer_name, msg_ids)
+
+    def start(self, tenant_id) -> dict:
+        """Count a task of `tenant_id` as running, return the counts to publish."""
+        self.running[tenant_id] += 1
+        return dict(self.running)
+
+    def finish(self, tenant_id) -> dict:
+        self.running[tenant_id] -= 1
+        if self.running[tenant_id] <= 0:
+            del self.running[tenant_id]
+        return dict(self.running)
+
+    def publish_running(self, running=None):
+        """Publish the running counts, `running` being a snapshot taken by start/finish when called from another thread."""
+        REDIS_CONN.set_obj(running_key(self.consumer_name), dict(self.running) if running is None else running, RUNNING_TTL)
+
+    def depths(self) -> dict:
+        """Queued and in-flight messages per lane, for the executor heartbeat.
+
+        `pending` were delivered and not acked yet, `lag` not delivered yet. Acked messages are deleted
+        from lane streams, so the lag is what the stream holds beyond the pending ones.
+        """
+        res = {}
+        for lane in LANE_WEIGHTS:
+            streams = [lane_stream(lane, t) for t in self.tenants(lane)]
+            depth, pending, lag = 0, 0, 0
+            for n, group in zip(REDIS_CONN.queue_lens(streams), REDIS_CONN.queue_infos(streams, SVR_CONSUMER_GROUP)):
+                p = int(group.get("pending", 0)) if group else 0
+                depth += n
+                pending += p
+                lag += max(0, n - p)
+            res[lane] = {"tenants": len(streams), "depth": depth, "pending": pending, "lag": lag}
+        return res
@@ -0,0 +1,113 @@
+#
+#  Copyright 2025 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Equivalence check of RagTokenizer.segment_ in "compat" mode against the exhaustive
+sortTks_(dfs_()) ranking it replaces.
+
+tokenize takes the best segmentation and fine_grained_tokenize the second best, so the
+top two of both rankings must be the same tokens with the same scores.
+
+By default random strings are segmented against random dictionaries over a small alphabet,
+which makes the lattice dense with ambiguous spans. With --corpus, every span of up to
+--max-len characters of the lines of a text file is segmented against the loaded dictionary.
+
+Run it from the project root:
+
+    PYTHONPATH=. python scripts/rag_tokenizer_check.py -n 6000
+    PYTHONPATH=. python scripts/rag_tokenizer_check.py --corpus golden.txt
+"""
+
+import argparse
+import math
+import random
+import re
+import string
+
+import datrie
+
+from rag.nlp.rag_tokenizer import RagTokenizer, tokenizer
+
+HANZI = [chr(c) for c in range(0x4e00, 0x4e00 + 3000)]
+
+
+def random_tokenizer(alphabet):
+    tknzr = RagTokenizer.__new__(RagTokenizer)
+    tknzr.SEGMENTER = "compat"
+    tknzr.trie_ = datrie.Trie(string.printable)
+    for _ in range(random.randint(1, 4 * len(alphabet))):
+        word = "".join(random.choices(alphabet, k=random.randint(1, 4)))
+        # same quantization as loadDict_
+        tknzr.trie_[tknzr.key_(word)] = (int(math.log(random.randint(1, 10**6) / 10**6) + 0.5), "n")
+    return tknzr
+
+
+def compare(tknzr, chars):
+    """Returns None if both rankings agree on the top two, else a description of the difference."""
+    tkslist = []
+    tknzr.dfs_(chars, 0, [], tkslist)
+    expected = tknzr.sortTks_(tkslist)[:2]
+    actual = tknzr.segment_(chars, topn=2)
+    if len(expected) == len(actual) and all(e[0] == a[0] and math.isclose(e[1], a[1]) for e, a in zip(expected, actual)):
+        return None
+    return f"{chars}: dfs {expected} != dp {actual}"
+
+
+def check_random(n):
+    mismatches = []
+    for _ in range(n):
+        # a few characters outside the dictionary take the -12 single character path of dfs_
+        alphabet = random.sample(HANZI, random.randint(2, 6))
+        tknzr = random_tokenizer(alphabet)
+        chars = "".join(random.choices(alphabet + random.sample(HANZI, 1), k=random.randint(1, 12)))
+        diff = compare(tknzr, chars)
+        if diff:
+            mismatches.append(diff)
+    return n, mismatches
+
+
+def check_corpus(path, max_len):
+    tokenizer.SEGMENTER = "compat"
+    n, mismatches = 0, []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            for run in re.findall(r"[一-龥]+", line):
+                for s in range(0, len(run), max_len):
+                    n += 1
+                    diff = compare(tokenizer, run[s : s + max_len])
+                    if diff:
+                        mismatches.append(diff)
+    return n, mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--strings", type=int, default=6000, help="Number of random strings")
+    parser.add_argument("-s", "--seed", type=int, default=1, help="Random seed")
+    parser.add_argument("--corpus", help="Text file to segment against the loaded dictionary instead")
+    parser.add_argument("--max-len", type=int, default=10, help="Longest corpus span, dfs_ is exponential in it")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    n, mismatches = check_corpus(args.corpus, args.max_len) if args.corpus else check_random(args.strings)
+    print(f"{n} strings, {len(mismatches)} mismatches")
+    for diff in mismatches[:10]:
+        print(diff)
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()